@@ -27,10 +27,12 @@ __usage__ = f"""
 牌谱分析：
 {default_command_start}naga <雀魂牌谱链接> <东/南x局x本场>：消耗10NP解析雀魂小局
 {default_command_start}naga <天凤牌谱链接>：消耗50NP解析天凤半庄
+可在一条消息中发送多个牌谱链接进行批量解析
 
 使用情况：
 {default_command_start}naga本月使用情况
 {default_command_start}naga上月使用情况
+{default_command_start}naga使用统计 <开始日期> [结束日期]
 
 以上命令格式中，以<>包裹的表示一个参数。
 
@@ -8,6 +8,36 @@ from pydantic import BaseSettings, root_validator
 class Config(BaseSettings):
     naga_fake_api: bool = False
     naga_timeout: float = 60 * 10
+    naga_majsoul_order_stale_timeout: float = 90  # 超时仍未分析完成的订单将被替换
+    naga_tenhou_order_stale_timeout: float = 300
+    naga_order_reaper_interval: float = 60
+    naga_order_claim: Optional[bool] = None  # 跨进程防止重复下单，默认仅postgresql启用
+    naga_order_claim_timeout: float = 60
+    naga_order_flush_interval: float = 1  # 已完成订单合并写入的间隔
+    naga_order_flush_batch_size: int = 64
+    naga_order_flush_max_attempts: int = (
+        5  # 多次写入失败的订单交由过期订单的清理任务处理
+    )
+    naga_paipu_shared_cache: bool = True  # 在数据库中缓存牌谱，供多个Bot共享
+    naga_paipu_shared_cache_retention_days: int = 30
+    naga_report_cache_size: int = 1024
+    naga_rest_np_ttl: float = 60 * 5  # 剩余NP与NAGA校正的间隔
+    naga_report_archive_months: int = 6  # 归档早于该月数的报告
+    naga_report_archive_batch_size: int = 200
+    naga_analyze_batch_max_targets: int = 10  # 一条消息中最多解析的牌谱数
+    naga_analyze_user_concurrency: int = 2  # 每个用户同时进行的解析数
+    naga_export_chunk_size: int = 500  # 导出订单时每次从数据库读取的行数
+    naga_nickname_cache_ttl: float = 60 * 10
+    naga_nickname_concurrency: int = 8
+    naga_serialization_offload_threshold: int = 64 * 1024  # 负数表示不放到线程池执行
+    naga_trace: bool = True  # 记录解析请求的各阶段耗时
+    naga_trace_retention_days: int = 7
+    naga_profiler: bool = False  # 启动时是否开启采样分析，运行时可通过指令切换
+    naga_profiler_threshold: float = 10  # 耗时超过该秒数的请求写入调用栈采样
+    naga_profiler_stall_threshold: float = 0.5  # 事件循环阻塞超过该秒数时写入调用栈采样
+    naga_profiler_interval: float = 0.01  # 采样间隔
+    naga_profiler_max_files: int = 50
+    naga_metrics_path: Optional[str] = None  # 提供HTTP接口的路径，接口不做鉴权
 
     access_control_reply_on_permission_denied: Optional[str]
     access_control_reply_on_rate_limited: Optional[str]
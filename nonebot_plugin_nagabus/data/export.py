@@ -0,0 +1,154 @@
+import os
+import csv
+from uuid import uuid4
+from io import StringIO
+from pathlib import Path
+from datetime import datetime, timezone
+from typing import Optional, NamedTuple
+
+import aiofiles
+from nonebot import logger
+from nonebot_plugin_orm import AsyncSession
+from nonebot_plugin_datastore.db import get_engine
+from nonebot_plugin_localstore import get_data_dir
+
+from ..config import conf
+from ..naga.model import NagaReport, NagaOrderStatus
+from ..utils.serialization import dumps_sync, run_serialization
+from .naga import NagaRepository, NagaOrderSource, _decode_report, _decompress_report
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+_FIELDS = (
+    "haihu_id",
+    "customer_id",
+    "source",
+    "model_type",
+    "status",
+    "cost_np",
+    "create_time",
+    "update_time",
+    "paipu_uuid",
+    "kyoku",
+    "honba",
+)
+
+
+class OrderExportResult(NamedTuple):
+    path: Path
+    count: int
+
+
+def _get_export_dir() -> Path:
+    export_dir = get_data_dir("nonebot_plugin_nagabus") / "export"
+    export_dir.mkdir(parents=True, exist_ok=True)
+    return export_dir
+
+
+def _report_to_dict(report: NagaReport) -> dict:
+    return {
+        "haihu_id": report.haihu_id,
+        "players": [p._asdict() for p in report.players],
+        "report_id": report.report_id,
+        "seat": report.seat,
+        "model": report.model._asdict(),
+        "rule": report.rule.name,
+    }
+
+
+def _to_record(row: dict, with_report: bool) -> dict:
+    record = {k: row[k] for k in _FIELDS}
+    record["source"] = NagaOrderSource(row["source"]).name
+    record["status"] = NagaOrderStatus(row["status"]).name
+    record["create_time"] = row["create_time"].isoformat()
+    record["update_time"] = row["update_time"].isoformat()
+
+    if with_report:
+        raw_report = row["naga_report"]
+        if raw_report is None and row["archived_report"] is not None:
+            raw_report = _decompress_report(row["archived_report"])
+        if raw_report is not None:
+            record["naga_report"] = _report_to_dict(_decode_report(raw_report))
+        else:
+            record["naga_report"] = None
+
+    return record
+
+
+def _encode_chunk(rows: list[dict], fmt: str, with_report: bool) -> str:
+    records = [_to_record(row, with_report) for row in rows]
+
+    if fmt == "jsonl":
+        return "".join(dumps_sync(record) + "\n" for record in records)
+
+    with StringIO() as sio:
+        writer = csv.writer(sio)
+        for record in records:
+            if with_report and record["naga_report"] is not None:
+                record["naga_report"] = dumps_sync(record["naga_report"])
+            writer.writerow(record.values())
+        return sio.getvalue()
+
+
+def _encode_csv_header(with_report: bool) -> str:
+    with StringIO() as sio:
+        fields = (*_FIELDS, "naga_report") if with_report else _FIELDS
+        csv.writer(sio).writerow(fields)
+        return sio.getvalue()
+
+
+async def export_orders(
+    t_begin: datetime, t_end: datetime, fmt: str = "csv", with_report: bool = False
+) -> OrderExportResult:
+    """
+    将时间段内的订单导出到数据目录下的CSV或JSONL文件。
+    按固定大小分页读取并逐页写入文件，内存占用与订单总数无关
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unsupported export format: {fmt}")
+
+    chunk_size = conf().naga_export_chunk_size
+    now = datetime.now(timezone.utc)
+    path = _get_export_dir() / f"orders-{now:%Y%m%d%H%M%S}-{uuid4().hex[:8]}.{fmt}"
+    # 导出完成后再重命名，避免留下不完整的文件
+    tmp_path = path.with_name(f".{path.name}.tmp")
+
+    count = 0
+    try:
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            if fmt == "csv":
+                await f.write(_encode_csv_header(with_report))
+
+            after: Optional[tuple[datetime, str]] = None
+            while True:
+                # 每页使用单独的会话，不长时间占用连接
+                async with AsyncSession(get_engine()) as sess:
+                    rows = await NagaRepository(sess).get_orders_page(
+                        t_begin, t_end, after, chunk_size, with_report
+                    )
+                if len(rows) == 0:
+                    break
+
+                # 包含报告时解码开销较大，放到线程池执行
+                content = await run_serialization(
+                    "order_export",
+                    None if with_report else 0,
+                    _encode_chunk,
+                    rows,
+                    fmt,
+                    with_report,
+                )
+                await f.write(content)
+
+                count += len(rows)
+                after = (rows[-1]["create_time"], rows[-1]["haihu_id"])
+                if len(rows) < chunk_size:
+                    break
+
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    logger.opt(colors=True).info(f"Exported <y>{count}</y> naga orders to {path}")
+    return OrderExportResult(path=path, count=count)
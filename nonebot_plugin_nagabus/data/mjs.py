@@ -1,25 +1,143 @@
-import json
-from typing import Any, Callable
+import os
+import zlib
+import asyncio
+from uuid import uuid4
+from zlib import crc32
+from pathlib import Path
+from time import monotonic
 from collections.abc import Awaitable
-from typing_extensions import deprecated
+from datetime import datetime, timezone, timedelta
+from typing import Any, Callable, Optional, NamedTuple
 
 import aiofiles
 from nonebot import logger
+from nonebot_plugin_orm import AsyncSession
+from sqlalchemy import delete, select, update
 from sqlalchemy.orm import Mapped, mapped_column
+from nonebot_plugin_datastore.db import get_engine
 from nonebot_plugin_localstore import get_cache_dir
+from tensoul.downloader import MajsoulDownloadError
 from nonebot_plugin_majsoul.paipu import download_paipu
+from pydantic import BaseModel, PrivateAttr, ValidationError
 
+from ..config import conf
 from .base import SqlModel
-from .utils.atomic_cache import get_atomic_cache
+from ..utils import metrics
+from ..naga.model import NagaGameRule
+from .utils.atomic_cache import AtomicCache
+from .utils import BLOB, UTCDateTime, insert
+from ..utils.serialization import loads, dumps_sync, run_serialization
 
 
-@deprecated("")
 class MajsoulPaipuOrm(SqlModel):
+    """
+    多个Bot共享的牌谱缓存，作为本地文件缓存之后的第二级缓存
+    """
+
     __tablename__ = "nonebot_plugin_nagabus_majsoul_paipu"
     __table_args__ = {"extend_existing": True}
 
     paipu_uuid: Mapped[str] = mapped_column(primary_key=True)
-    content: Mapped[str]
+    content: Mapped[bytes] = mapped_column(BLOB)  # zlib压缩后的牌谱JSON
+    create_time: Mapped[datetime] = mapped_column(UTCDateTime)
+    access_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
+
+
+class MajsoulPaipuRepository:
+    # 距上次访问超过该时间才更新访问时间，避免每次访问都写库
+    _TOUCH_INTERVAL = timedelta(hours=1)
+
+    def __init__(self, sess: AsyncSession):
+        self.sess = sess
+
+    async def get_paipu(self, paipu_uuid: str) -> Optional[bytes]:
+        stmt = select(MajsoulPaipuOrm.content).where(
+            MajsoulPaipuOrm.paipu_uuid == paipu_uuid
+        )
+        return (await self.sess.execute(stmt)).scalar_one_or_none()
+
+    async def touch_paipu(self, paipu_uuid: str):
+        now = datetime.now(timezone.utc)
+        stmt = (
+            update(MajsoulPaipuOrm)
+            .where(
+                MajsoulPaipuOrm.paipu_uuid == paipu_uuid,
+                MajsoulPaipuOrm.access_time < now - self._TOUCH_INTERVAL,
+            )
+            .values(access_time=now)
+        )
+        await self.sess.execute(stmt)
+        await self.sess.commit()
+
+    async def put_paipu(self, paipu_uuid: str, content: bytes):
+        now = datetime.now(timezone.utc)
+        stmt = insert(MajsoulPaipuOrm).values(
+            paipu_uuid=paipu_uuid,
+            content=content,
+            create_time=now,
+            access_time=now,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[MajsoulPaipuOrm.paipu_uuid],
+            set_={"content": stmt.excluded.content, "access_time": now},
+        )
+        await self.sess.execute(stmt)
+        await self.sess.commit()
+
+    async def sweep_paipu(self, access_before: datetime) -> int:
+        stmt = delete(MajsoulPaipuOrm).where(
+            MajsoulPaipuOrm.access_time < access_before
+        )
+        result = await self.sess.execute(stmt)
+        await self.sess.commit()
+        return result.rowcount
+
+
+class MajsoulKyokuIndex(NamedTuple):
+    kyoku: int
+    honba: int
+    offset: int  # 该小局的log在牌谱缓存文件中的字节偏移
+    length: int
+    crc32: int
+
+
+class MajsoulPaipuIndex(BaseModel):
+    title: list
+    name: list
+    rule: dict
+    game_rule: NagaGameRule
+    kyoku: list[MajsoulKyokuIndex]
+    size: int  # 牌谱缓存文件的字节数
+    crc32: int  # 牌谱缓存文件的CRC32
+
+    _lookup: Optional[dict[int, dict[int, MajsoulKyokuIndex]]] = PrivateAttr(None)
+
+    def header(self) -> dict:
+        return {"title": self.title, "name": self.name, "rule": self.rule}
+
+    @property
+    def available_kyoku_honba(self) -> list[tuple[int, int]]:
+        return [(x.kyoku, x.honba) for x in self.kyoku]
+
+    def find_kyoku(self, kyoku: int, honba: int) -> Optional[MajsoulKyokuIndex]:
+        """
+        查找指定场次本场的小局。honba为-1时表示未指定本场，仅当该场次只存在一个本场时能找到。
+        """
+        if self._lookup is None:
+            self._lookup = {}
+            for x in self.kyoku:
+                self._lookup.setdefault(x.kyoku, {})[x.honba] = x
+
+        honba_lookup = self._lookup.get(kyoku)
+        if honba_lookup is None:
+            return None
+
+        if honba == -1:
+            if len(honba_lookup) == 1:
+                return next(iter(honba_lookup.values()))
+            return None
+
+        return honba_lookup.get(honba)
 
 
 # 为了方便单测时mock实现
@@ -31,24 +149,346 @@ def _set_download_paipu_delegate(download_paipu_delegate):
     _download_paipu_delegate = download_paipu_delegate
 
 
-async def _do_get_majsoul_paipu(uuid: str):
+class _CorruptedPaipuCacheError(Exception): ...
+
+
+def _paipu_negative_ttl(e: BaseException) -> Optional[float]:
+    # 1203表示牌谱不存在，短时间内重复请求也不会有结果
+    if isinstance(e, MajsoulDownloadError) and e.code == 1203:
+        return 60
+    return None
+
+
+_paipu_index_cache: AtomicCache[MajsoulPaipuIndex] = AtomicCache(
+    ttl=600, retain=True, negative_ttl=_paipu_negative_ttl, max_size=256
+)
+metrics.register_cache("majsoul_paipu_index", _paipu_index_cache)
+
+# 内存缓存未命中时，牌谱的来源
+_paipu_loads = metrics.counter(
+    "nagabus_majsoul_paipu_loads_total",
+    "Majsoul paipu loaded on memory cache misses by source",
+    ("source",),
+)
+
+
+def _get_paipu_dir() -> Path:
     mjs_paipu_dir = get_cache_dir("nonebot_plugin_nagabus") / "mjs_paipu"
     mjs_paipu_dir.mkdir(parents=True, exist_ok=True)
+    return mjs_paipu_dir
+
+
+def _get_paipu_file(uuid: str) -> Path:
+    return _get_paipu_dir() / f"{uuid}.json"
+
 
-    paipu_file = mjs_paipu_dir / f"{uuid}.json"
-    if paipu_file.exists():
-        logger.opt(colors=True).info(f"Use cached majsoul paipu <y>{uuid}</y>")
-        async with aiofiles.open(paipu_file, "r", encoding="utf-8") as f:
-            return json.loads(await f.read())
+def _get_index_file(uuid: str) -> Path:
+    return _get_paipu_dir() / f"{uuid}.index.json"
+
+
+def _get_game_rule(rule: dict) -> NagaGameRule:
+    if "東" in rule["disp"]:
+        return NagaGameRule.tonpuu
     else:
-        logger.opt(colors=True).info(f"Downloading majsoul paipu <y>{uuid}</y> ...")
-        data = await _download_paipu_delegate(uuid)
-        async with aiofiles.open(paipu_file, "w+", encoding="utf-8") as f:
-            await f.write(json.dumps(data))
-        return data
+        return NagaGameRule.hanchan
 
 
-async def get_majsoul_paipu(uuid: str):
-    return await get_atomic_cache(
-        f"mjs_paipu_{uuid}", lambda: _do_get_majsoul_paipu(uuid)
+def _encode_paipu(data: dict) -> tuple[bytes, MajsoulPaipuIndex]:
+    """
+    将牌谱编码为JSON，并记录每个小局的log在其中的字节偏移，以便之后单独读取某个小局
+    """
+    buf = bytearray(b'{"log": [')
+    kyoku = []
+    for i, log in enumerate(data["log"]):
+        if i != 0:
+            buf += b", "
+        raw_log = dumps_sync(log).encode("utf-8")
+        kyoku.append(
+            MajsoulKyokuIndex(
+                kyoku=log[0][0],
+                honba=log[0][1],
+                offset=len(buf),
+                length=len(raw_log),
+                crc32=crc32(raw_log),
+            )
+        )
+        buf += raw_log
+    buf += b"]"
+
+    for k, v in data.items():
+        if k != "log":
+            buf += b", " + dumps_sync(k).encode("utf-8") + b": "
+            buf += dumps_sync(v).encode("utf-8")
+    buf += b"}"
+
+    index = MajsoulPaipuIndex(
+        title=data["title"],
+        name=data["name"],
+        rule=data["rule"],
+        game_rule=_get_game_rule(data["rule"]),
+        kyoku=kyoku,
+        size=len(buf),
+        crc32=crc32(buf),
+    )
+    return bytes(buf), index
+
+
+def _write_file_atomic(path: Path, content: bytes):
+    # 先写入临时文件再重命名，避免崩溃或多进程并发写入时留下不完整的文件
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+async def _save_paipu(
+    uuid: str, data: dict, *, share: bool = False
+) -> MajsoulPaipuIndex:
+    content, index = await run_serialization(
+        "mjs_paipu.encode", None, _encode_paipu, data
+    )
+
+    # 索引最后写入，存在索引即代表牌谱已完整写入
+    await asyncio.to_thread(_write_file_atomic, _get_paipu_file(uuid), content)
+    await asyncio.to_thread(
+        _write_file_atomic,
+        _get_index_file(uuid),
+        index.json(ensure_ascii=False).encode("utf-8"),
+    )
+
+    if share and conf().naga_paipu_shared_cache:
+        await _put_shared_paipu(uuid, content)
+
+    return index
+
+
+@logger.catch
+async def _put_shared_paipu(uuid: str, content: bytes):
+    compressed = await run_serialization(
+        "mjs_paipu.compress", len(content), zlib.compress, content
     )
+    async with AsyncSession(get_engine()) as sess:
+        await MajsoulPaipuRepository(sess).put_paipu(uuid, compressed)
+
+
+# 本进程上次更新各牌谱访问时间的时刻，窗口内的访问不再访问数据库
+_shared_paipu_touched: dict[str, float] = {}
+_SHARED_PAIPU_TOUCHED_MAX_SIZE = 4096
+
+
+@logger.catch
+async def _touch_shared_paipu(uuid: str):
+    now = monotonic()
+    interval = MajsoulPaipuRepository._TOUCH_INTERVAL.total_seconds()
+    last_touched = _shared_paipu_touched.get(uuid)
+    if last_touched is not None and now - last_touched < interval:
+        return
+
+    if len(_shared_paipu_touched) >= _SHARED_PAIPU_TOUCHED_MAX_SIZE:
+        for k, t in list(_shared_paipu_touched.items()):
+            if now - t >= interval:
+                del _shared_paipu_touched[k]
+        if len(_shared_paipu_touched) >= _SHARED_PAIPU_TOUCHED_MAX_SIZE:
+            # 都在窗口内时丢弃最早记录的一半
+            for k in list(_shared_paipu_touched)[: _SHARED_PAIPU_TOUCHED_MAX_SIZE // 2]:
+                del _shared_paipu_touched[k]
+
+    _shared_paipu_touched[uuid] = now
+    async with AsyncSession(get_engine()) as sess:
+        await MajsoulPaipuRepository(sess).touch_paipu(uuid)
+
+
+async def _get_shared_paipu(uuid: str) -> Optional[dict]:
+    try:
+        async with AsyncSession(get_engine()) as sess:
+            compressed = await MajsoulPaipuRepository(sess).get_paipu(uuid)
+        if compressed is None:
+            return None
+
+        content = await run_serialization(
+            "mjs_paipu.decompress", len(compressed), zlib.decompress, compressed
+        )
+        data = await loads(content, site="mjs_paipu.decode")
+    except Exception as e:
+        logger.opt(colors=True, exception=e).warning(
+            f"Failed to get majsoul paipu <y>{uuid}</y> from shared cache"
+        )
+        return None
+
+    await _touch_shared_paipu(uuid)
+    return data
+
+
+async def sweep_shared_majsoul_paipu() -> int:
+    """
+    删除共享缓存中长时间未访问的牌谱，返回删除的数量
+    """
+    access_before = datetime.now(timezone.utc) - timedelta(
+        days=conf().naga_paipu_shared_cache_retention_days
+    )
+    async with AsyncSession(get_engine()) as sess:
+        cnt = await MajsoulPaipuRepository(sess).sweep_paipu(access_before)
+    if cnt > 0:
+        logger.info(f"Swept {cnt} majsoul paipu from shared cache")
+    return cnt
+
+
+def _move_paipu_to_quarantine(uuid: str):
+    quarantine_dir = _get_paipu_dir() / "quarantine"
+    quarantine_dir.mkdir(parents=True, exist_ok=True)
+
+    suffix = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    for path in (_get_index_file(uuid), _get_paipu_file(uuid)):
+        try:
+            os.replace(path, quarantine_dir / f"{path.name}.{suffix}")
+        except FileNotFoundError:
+            pass
+
+
+async def _quarantine_paipu(uuid: str):
+    """
+    将损坏的牌谱缓存文件移至quarantine目录。
+    不会使内存中的索引失效，以免在_paipu_index_cache的producer中调用时破坏正在进行的加载
+    """
+    await asyncio.to_thread(_move_paipu_to_quarantine, uuid)
+
+
+async def _load_paipu_index(uuid: str) -> MajsoulPaipuIndex:
+    async with aiofiles.open(_get_index_file(uuid), "rb") as f:
+        raw_index = await f.read()
+
+    try:
+        index = MajsoulPaipuIndex.parse_raw(raw_index)
+    except ValidationError as e:
+        raise _CorruptedPaipuCacheError("invalid index") from e
+
+    try:
+        size = _get_paipu_file(uuid).stat().st_size
+    except FileNotFoundError as e:
+        raise _CorruptedPaipuCacheError("paipu file not found") from e
+
+    if size != index.size:
+        raise _CorruptedPaipuCacheError(
+            f"size mismatch (expected: {index.size}, actual: {size})"
+        )
+
+    return index
+
+
+async def _do_get_majsoul_paipu_index(uuid: str) -> MajsoulPaipuIndex:
+    paipu_file = _get_paipu_file(uuid)
+    index_file = _get_index_file(uuid)
+
+    if index_file.exists():
+        try:
+            index = await _load_paipu_index(uuid)
+            logger.opt(colors=True).info(f"Use cached majsoul paipu <y>{uuid}</y>")
+            if conf().naga_paipu_shared_cache:
+                await _touch_shared_paipu(uuid)
+            _paipu_loads.inc(source="file")
+            return index
+        except _CorruptedPaipuCacheError as e:
+            logger.opt(colors=True).warning(
+                f"Cached majsoul paipu <y>{uuid}</y> is corrupted ({e}), "
+                "quarantine it and download again"
+            )
+            await _quarantine_paipu(uuid)
+    elif paipu_file.exists():
+        # 旧版本缓存没有索引，重新编码一次
+        logger.opt(colors=True).info(f"Indexing cached majsoul paipu <y>{uuid}</y>")
+        try:
+            async with aiofiles.open(paipu_file, "rb") as f:
+                data = await loads(await f.read(), site="mjs_paipu.decode")
+            _paipu_loads.inc(source="file")
+            return await _save_paipu(uuid, data, share=True)
+        except ValueError:
+            logger.opt(colors=True).warning(
+                f"Cached majsoul paipu <y>{uuid}</y> is corrupted, "
+                "quarantine it and download again"
+            )
+            await _quarantine_paipu(uuid)
+
+    if conf().naga_paipu_shared_cache:
+        data = await _get_shared_paipu(uuid)
+        if data is not None:
+            logger.opt(colors=True).info(
+                f"Use shared cached majsoul paipu <y>{uuid}</y>"
+            )
+            _paipu_loads.inc(source="shared")
+            return await _save_paipu(uuid, data)
+
+    logger.opt(colors=True).info(f"Downloading majsoul paipu <y>{uuid}</y> ...")
+    data = await _download_paipu_delegate(uuid)
+    _paipu_loads.inc(source="download")
+    return await _save_paipu(uuid, data, share=True)
+
+
+async def get_majsoul_paipu_index(uuid: str) -> MajsoulPaipuIndex:
+    return await _paipu_index_cache.get(uuid, lambda: _do_get_majsoul_paipu_index(uuid))
+
+
+async def _read_kyoku_log(uuid: str, kyoku: MajsoulKyokuIndex) -> list:
+    async with aiofiles.open(_get_paipu_file(uuid), "rb") as f:
+        await f.seek(kyoku.offset)
+        raw_log = await f.read(kyoku.length)
+
+    if len(raw_log) != kyoku.length or crc32(raw_log) != kyoku.crc32:
+        raise _CorruptedPaipuCacheError(
+            f"checksum mismatch (kyoku: {kyoku.kyoku}, honba: {kyoku.honba})"
+        )
+    return await loads(raw_log, site="mjs_paipu.decode_kyoku")
+
+
+async def get_majsoul_kyoku_log(uuid: str, kyoku: MajsoulKyokuIndex) -> list:
+    """
+    只读取牌谱中的单个小局，调用前需先通过get_majsoul_paipu_index确保牌谱已缓存
+    """
+    try:
+        return await _read_kyoku_log(uuid, kyoku)
+    except (_CorruptedPaipuCacheError, FileNotFoundError) as e:
+        logger.opt(colors=True).warning(
+            f"Cached majsoul paipu <y>{uuid}</y> is corrupted ({e}), "
+            "quarantine it and download again"
+        )
+        await _quarantine_paipu(uuid)
+        _paipu_index_cache.invalidate(uuid)
+
+    index = await get_majsoul_paipu_index(uuid)
+    new_kyoku = index.find_kyoku(kyoku.kyoku, kyoku.honba)
+    if new_kyoku is None:
+        raise _CorruptedPaipuCacheError(
+            f"kyoku not found after download again "
+            f"(kyoku: {kyoku.kyoku}, honba: {kyoku.honba})"
+        )
+    return await _read_kyoku_log(uuid, new_kyoku)
+
+
+async def _read_paipu(uuid: str, index: MajsoulPaipuIndex):
+    async with aiofiles.open(_get_paipu_file(uuid), "rb") as f:
+        content = await f.read()
+
+    if len(content) != index.size or crc32(content) != index.crc32:
+        raise _CorruptedPaipuCacheError("checksum mismatch")
+    return await loads(content, site="mjs_paipu.decode")
+
+
+async def get_majsoul_paipu(uuid: str):
+    index = await get_majsoul_paipu_index(uuid)
+    try:
+        return await _read_paipu(uuid, index)
+    except (_CorruptedPaipuCacheError, FileNotFoundError) as e:
+        logger.opt(colors=True).warning(
+            f"Cached majsoul paipu <y>{uuid}</y> is corrupted ({e}), "
+            "quarantine it and download again"
+        )
+        await _quarantine_paipu(uuid)
+        _paipu_index_cache.invalidate(uuid)
+
+    index = await get_majsoul_paipu_index(uuid)
+    return await _read_paipu(uuid, index)
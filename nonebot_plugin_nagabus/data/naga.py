@@ -1,17 +1,42 @@
-import json
+import zlib
+import asyncio
 from enum import IntEnum
 from typing import Optional
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone, timedelta
 
 from nonebot import logger
-from pydantic import BaseModel
 from nonebot_plugin_orm import AsyncSession
-from sqlalchemy import ForeignKey, select, update
-from sqlalchemy.orm import Mapped, relationship, mapped_column
+from nonebot_plugin_datastore.db import get_engine
+from sqlalchemy.orm import Mapped, defer, joinedload, relationship, mapped_column
+from sqlalchemy import (
+    Row,
+    Enum,
+    Index,
+    Select,
+    ForeignKey,
+    or_,
+    and_,
+    func,
+    null,
+    delete,
+    select,
+    update,
+    bindparam,
+)
 
+from ..config import conf
 from .base import SqlModel
-from .utils import UTCDateTime
-from ..naga.model import NagaReport, NagaGameRule, NagaOrderStatus
+from ..utils import metrics
+from .utils.atomic_cache import AtomicCache
+from .utils import BLOB, JSON, UTCDateTime, insert
+from ..utils.serialization import dumps_sync, loads_sync, run_serialization
+from ..naga.model import (
+    NagaModel,
+    NagaReport,
+    NagaGameRule,
+    NagaOrderStatus,
+    NagaReportPlayer,
+)
 
 
 class NagaOrderSource(IntEnum):
@@ -21,7 +46,15 @@ class NagaOrderSource(IntEnum):
 
 class NagaOrderOrm(SqlModel):
     __tablename__ = "nonebot_plugin_nagabus_order"
-    __table_args__ = {"extend_existing": True}
+    __table_args__ = (
+        # NagaRepository.get_stale_orders、NagaRepository.archive_reports
+        Index(
+            "ix_nonebot_plugin_nagabus_order_status_create_time",
+            "status",
+            "create_time",
+        ),
+        {"extend_existing": True},
+    )
 
     haihu_id: Mapped[str] = mapped_column(primary_key=True)
     customer_id: Mapped[int]
@@ -29,20 +62,30 @@ class NagaOrderOrm(SqlModel):
     source: Mapped[NagaOrderSource]
     model_type: Mapped[str]
     status: Mapped[NagaOrderStatus]
-    naga_report: Mapped[Optional[str]]  # json of NagaReport
+    naga_report: Mapped[Optional[list]] = mapped_column(JSON)  # NagaReport
     create_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
     update_time: Mapped[datetime] = mapped_column(UTCDateTime)
 
 
 class MajsoulOrderOrm(SqlModel):
     __tablename__ = "nonebot_plugin_nagabus_majsoul_order"
-    __table_args__ = {"extend_existing": True}
+    __table_args__ = (
+        # NagaRepository.get_local_majsoul_order
+        Index(
+            "ix_nonebot_plugin_nagabus_majsoul_order_lookup",
+            "paipu_uuid",
+            "kyoku",
+            "honba",
+            "model_type",
+        ),
+        {"extend_existing": True},
+    )
 
     naga_haihu_id: Mapped[str] = mapped_column(
         ForeignKey("nonebot_plugin_nagabus_order.haihu_id", ondelete="cascade"),
         primary_key=True,
     )
-    paipu_uuid: Mapped[str] = mapped_column(index=True)
+    paipu_uuid: Mapped[str]
     kyoku: Mapped[int]
     honba: Mapped[int]
     model_type: Mapped[str]
@@ -55,56 +98,290 @@ class MajsoulOrderOrm(SqlModel):
     )
 
 
-class NagaReportWrapper(BaseModel):
-    report: NagaReport
+class NagaMonthlyUsageOrm(SqlModel):
+    """
+    按月汇总的使用情况，在订单完成时增量更新
+    """
+
+    __tablename__ = "nonebot_plugin_nagabus_monthly_usage"
+    __table_args__ = {"extend_existing": True}
+
+    customer_id: Mapped[int] = mapped_column(primary_key=True)
+    month: Mapped[int] = mapped_column(primary_key=True)  # year * 100 + month
+    source: Mapped[NagaOrderSource] = mapped_column(
+        Enum(NagaOrderSource, native_enum=False, length=16), primary_key=True
+    )
+    cost_np: Mapped[int]
+    order_count: Mapped[int]
+
+
+class NagaDailyUsageOrm(SqlModel):
+    """
+    按日汇总的使用情况，在订单完成时增量更新，用于任意时间段的统计
+    """
+
+    __tablename__ = "nonebot_plugin_nagabus_daily_usage"
+    __table_args__ = {"extend_existing": True}
+
+    day: Mapped[int] = mapped_column(primary_key=True)  # yyyymmdd
+    customer_id: Mapped[int] = mapped_column(primary_key=True)
+    source: Mapped[NagaOrderSource] = mapped_column(
+        Enum(NagaOrderSource, native_enum=False, length=16), primary_key=True
+    )
+    model_type: Mapped[str] = mapped_column(primary_key=True)
+    cost_np: Mapped[int]
+    order_count: Mapped[int]
+
+
+class NagaReportArchiveOrm(SqlModel):
+    """
+    归档的报告，订单表中保留不含报告的记录用于统计
+    """
+
+    __tablename__ = "nonebot_plugin_nagabus_report_archive"
+    __table_args__ = {"extend_existing": True}
+
+    haihu_id: Mapped[str] = mapped_column(primary_key=True)
+    content: Mapped[bytes] = mapped_column(BLOB)  # zlib压缩后的报告JSON
+    archive_time: Mapped[datetime] = mapped_column(UTCDateTime)
+
+
+class NagaOrderClaimOrm(SqlModel):
+    """
+    下单权，用于多个进程共享数据库时防止重复下单
+    """
+
+    __tablename__ = "nonebot_plugin_nagabus_order_claim"
+    __table_args__ = {"extend_existing": True}
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    owner: Mapped[str]
+    claim_time: Mapped[datetime] = mapped_column(UTCDateTime)
+
+
+def _month_key(dt: datetime) -> int:
+    # 与UTCDateTime一致，不带时区的datetime按本地时区处理
+    dt = dt.astimezone(UTCDateTime.LOCAL_TIMEZONE)
+    return dt.year * 100 + dt.month
+
+
+def _day_key(d: date) -> int:
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def _stale_timeout(source: NagaOrderSource) -> timedelta:
+    if source == NagaOrderSource.majsoul:
+        return timedelta(seconds=conf().naga_majsoul_order_stale_timeout)
+    else:
+        return timedelta(seconds=conf().naga_tenhou_order_stale_timeout)
+
+
+_UNFINISHED_STATUS = (NagaOrderStatus.pending, NagaOrderStatus.analyzing)
+
+
+def _is_stale(order_orm: NagaOrderOrm, now: datetime) -> bool:
+    # 超时仍未分析完成
+    return (
+        order_orm.status in _UNFINISHED_STATUS
+        and now - order_orm.update_time >= _stale_timeout(order_orm.source)
+    )
+
+
+def _is_reusable(order_orm: NagaOrderOrm, now: datetime) -> bool:
+    if order_orm.status == NagaOrderStatus.ok:
+        return True
+    return order_orm.status in _UNFINISHED_STATUS and not _is_stale(order_orm, now)
+
+
+def _decode_report(raw_report: list) -> NagaReport:
+    # 按NagaReport的字段顺序存储，直接构造而不经过pydantic校验
+    haihu_id, players, report_id, seat, model, rule = raw_report
+    return NagaReport(
+        haihu_id=haihu_id,
+        players=[NagaReportPlayer(*p) for p in players],
+        report_id=report_id,
+        seat=seat,
+        model=NagaModel(*model),
+        rule=NagaGameRule(rule),
+    )
+
+
+def _compress_reports(rows: list[tuple[str, list]]) -> list[tuple[str, bytes]]:
+    return [
+        (haihu_id, zlib.compress(dumps_sync(raw_report).encode("utf-8")))
+        for haihu_id, raw_report in rows
+    ]
+
+
+def _decompress_report(content: bytes) -> list:
+    return loads_sync(zlib.decompress(content))
+
+
+# 报告生成后不会再变化，以(haihu_id, model_type)为key缓存解析后的报告
+_report_cache: AtomicCache[Optional[NagaReport]] = AtomicCache(
+    ttl=60 * 60 * 24, retain=True, max_size=conf().naga_report_cache_size
+)
+metrics.register_cache("naga_report", _report_cache)
+
+_query_duration = metrics.histogram(
+    "nagabus_db_query_duration_seconds",
+    "Time spent on order and report lookups",
+    ("query",),
+)
 
 
 class NagaRepository:
     def __init__(self, sess: AsyncSession):
         self.sess = sess
 
-    async def get_orders(
-        self, t_begin: datetime, t_end: datetime
-    ) -> list[NagaOrderOrm]:
-        stmt = select(NagaOrderOrm).where(
-            NagaOrderOrm.create_time >= t_begin,
-            NagaOrderOrm.create_time < t_end,
-            NagaOrderOrm.status == NagaOrderStatus.ok,
+    async def get_orders_page(
+        self,
+        t_begin: datetime,
+        t_end: datetime,
+        after: Optional[tuple[datetime, str]],
+        limit: int,
+        with_report: bool = False,
+    ) -> list[dict]:
+        """
+        按(create_time, haihu_id)升序分页获取时间段内的订单（包括未完成的订单），
+        after为上一页最后一个订单的(create_time, haihu_id)。
+        with_report为True时一并返回naga_report与归档的报告archived_report（压缩后的）
+        """
+        columns = [
+            NagaOrderOrm.haihu_id,
+            NagaOrderOrm.customer_id,
+            NagaOrderOrm.source,
+            NagaOrderOrm.model_type,
+            NagaOrderOrm.status,
+            NagaOrderOrm.cost_np,
+            NagaOrderOrm.create_time,
+            NagaOrderOrm.update_time,
+            MajsoulOrderOrm.paipu_uuid,
+            MajsoulOrderOrm.kyoku,
+            MajsoulOrderOrm.honba,
+        ]
+        if with_report:
+            columns.append(NagaOrderOrm.naga_report)
+            columns.append(NagaReportArchiveOrm.content.label("archived_report"))
+
+        stmt = (
+            select(*columns)
+            .outerjoin(
+                MajsoulOrderOrm,
+                MajsoulOrderOrm.naga_haihu_id == NagaOrderOrm.haihu_id,
+            )
+            .where(
+                NagaOrderOrm.create_time >= t_begin,
+                NagaOrderOrm.create_time < t_end,
+            )
+            .order_by(NagaOrderOrm.create_time, NagaOrderOrm.haihu_id)
+            .limit(limit)
+        )
+        if with_report:
+            stmt = stmt.outerjoin(
+                NagaReportArchiveOrm,
+                NagaReportArchiveOrm.haihu_id == NagaOrderOrm.haihu_id,
+            )
+        if after is not None:
+            # 使用keyset分页，避免offset随页数增加而变慢
+            after_create_time, after_haihu_id = after
+            stmt = stmt.where(
+                or_(
+                    NagaOrderOrm.create_time > after_create_time,
+                    and_(
+                        NagaOrderOrm.create_time == after_create_time,
+                        NagaOrderOrm.haihu_id > after_haihu_id,
+                    ),
+                )
+            )
+
+        return [row._asdict() for row in await self.sess.execute(stmt)]
+
+    async def get_monthly_statistic(
+        self, year: int, month: int
+    ) -> list[tuple[int, int]]:
+        """
+        从按月汇总表统计该月每个用户消耗的NP，返回(customer_id, cost_np)并按cost_np降序排列
+        """
+        total_cost_np = func.sum(NagaMonthlyUsageOrm.cost_np)
+        stmt = (
+            select(NagaMonthlyUsageOrm.customer_id, total_cost_np)
+            .where(NagaMonthlyUsageOrm.month == year * 100 + month)
+            .group_by(NagaMonthlyUsageOrm.customer_id)
+            .order_by(total_cost_np.desc())
+        )
+        return [tuple(row) for row in await self.sess.execute(stmt)]
+
+    async def get_daily_usage(
+        self, begin: date, end: date
+    ) -> list[tuple[date, int, NagaOrderSource, str, int, int]]:
+        """
+        从按日汇总表查询[begin, end]内的使用情况，
+        返回(day, customer_id, source, model_type, cost_np, order_count)并按day升序排列
+        """
+        stmt = (
+            select(
+                NagaDailyUsageOrm.day,
+                NagaDailyUsageOrm.customer_id,
+                NagaDailyUsageOrm.source,
+                NagaDailyUsageOrm.model_type,
+                NagaDailyUsageOrm.cost_np,
+                NagaDailyUsageOrm.order_count,
+            )
+            .where(
+                NagaDailyUsageOrm.day >= _day_key(begin),
+                NagaDailyUsageOrm.day <= _day_key(end),
+            )
+            .order_by(NagaDailyUsageOrm.day)
+        )
+        return [
+            (date(day // 10000, day // 100 % 100, day % 100), *row)
+            for day, *row in await self.sess.execute(stmt)
+        ]
+
+    def _apply_pending_completion(self, order_orm: NagaOrderOrm):
+        # 已完成但尚未写入数据库的订单，从会话中移除后修改状态，避免被写入
+        if (
+            order_orm.status != NagaOrderStatus.ok
+            and _completion_buffer.get(order_orm.haihu_id) is not None
+        ):
+            self.sess.expunge(order_orm)
+            order_orm.status = NagaOrderStatus.ok
+
+    @staticmethod
+    def _get_local_majsoul_order_stmt(
+        majsoul_uuid: str, kyoku: int, honba: int, model_type: str
+    ) -> Select:
+        return (
+            select(MajsoulOrderOrm)
+            .where(
+                MajsoulOrderOrm.paipu_uuid == majsoul_uuid,
+                MajsoulOrderOrm.kyoku == kyoku,
+                MajsoulOrderOrm.honba == honba,
+                MajsoulOrderOrm.model_type == model_type,
+            )
+            .options(joinedload(MajsoulOrderOrm.order).defer(NagaOrderOrm.naga_report))
         )
-        return list((await self.sess.execute(stmt)).scalars())
 
     async def get_local_majsoul_order(
         self, majsoul_uuid: str, kyoku: int, honba: int, model_type: str
     ) -> Optional[NagaOrderOrm]:
-        stmt = select(MajsoulOrderOrm).where(
-            MajsoulOrderOrm.paipu_uuid == majsoul_uuid,
-            MajsoulOrderOrm.kyoku == kyoku,
-            MajsoulOrderOrm.honba == honba,
-            MajsoulOrderOrm.model_type == model_type,
+        stmt = self._get_local_majsoul_order_stmt(
+            majsoul_uuid, kyoku, honba, model_type
         )
 
-        order_orm: Optional[MajsoulOrderOrm] = (
-            await self.sess.execute(stmt)
-        ).scalar_one_or_none()
+        with _query_duration.time(query="get_local_majsoul_order"):
+            order_orm: Optional[MajsoulOrderOrm] = (
+                await self.sess.execute(stmt)
+            ).scalar_one_or_none()
         if order_orm is not None:
-            if (
-                order_orm.order.status == NagaOrderStatus.ok
-                or datetime.now(tz=timezone.utc).timestamp()
-                - order_orm.order.update_time.timestamp()
-                < 90
-            ):
-                return order_orm.order
-            else:  # 超过90s仍未分析完成则删除重来
-                logger.opt(colors=True).info(
-                    f"Delete majsoul paipu <y>{majsoul_uuid} "
-                    f"(kyoku: {kyoku}, honba: {honba})</y> "
-                    f"analyze order: {order_orm.naga_haihu_id}, "
-                    f"because it takes over 90 seconds and still not done"
-                )
-                await self.sess.delete(order_orm.order)
-                await self.sess.delete(order_orm)
-                await self.sess.commit()
-                return None
+            self._apply_pending_completion(order_orm.order)
+        # 超时仍未分析完成或已失败的订单视为不存在，由新订单替换，清理交给后台任务
+        if order_orm is not None and _is_reusable(
+            order_orm.order, datetime.now(tz=timezone.utc)
+        ):
+            return order_orm.order
+        return None
 
     async def new_local_majsoul_order(
         self,
@@ -114,7 +391,24 @@ class NagaRepository:
         kyoku: int,
         honba: int,
         model_type: str,
-    ):
+    ) -> int:
+        """
+        创建订单，返回订单消耗的NP
+        """
+        # 替换该小局之前超时或失败的订单
+        stmt = (
+            select(MajsoulOrderOrm.naga_haihu_id)
+            .join(MajsoulOrderOrm.order)
+            .where(
+                MajsoulOrderOrm.paipu_uuid == majsoul_uuid,
+                MajsoulOrderOrm.kyoku == kyoku,
+                MajsoulOrderOrm.honba == honba,
+                MajsoulOrderOrm.model_type == model_type,
+                NagaOrderOrm.status != NagaOrderStatus.ok,
+            )
+        )
+        await self._delete_orders(list((await self.sess.execute(stmt)).scalars()))
+
         order_orm = NagaOrderOrm(
             haihu_id=haihu_id,
             customer_id=customer_id,
@@ -135,41 +429,53 @@ class NagaRepository:
             order=order_orm,
         )
 
+        cost_np = order_orm.cost_np
+
         self.sess.add(order_orm)
         self.sess.add(majsoul_order_orm)
         await self.sess.commit()
 
+        return cost_np
+
+    @staticmethod
+    def _get_local_order_stmt(haihu_id: str, model_type: str) -> Select:
+        # haihu_id为主键，无需额外索引
+        return (
+            select(NagaOrderOrm)
+            .where(
+                NagaOrderOrm.haihu_id == haihu_id,
+                NagaOrderOrm.model_type == model_type,
+            )
+            .options(defer(NagaOrderOrm.naga_report))
+        )
+
     async def get_local_order(
         self, haihu_id: str, model_type: str
     ) -> Optional[NagaOrderOrm]:
-        stmt = select(NagaOrderOrm).where(
-            NagaOrderOrm.haihu_id == haihu_id,
-            NagaOrderOrm.model_type == model_type,
-        )
+        stmt = self._get_local_order_stmt(haihu_id, model_type)
 
-        order_orm: Optional[NagaOrderOrm] = (
-            await self.sess.execute(stmt)
-        ).scalar_one_or_none()
+        with _query_duration.time(query="get_local_order"):
+            order_orm: Optional[NagaOrderOrm] = (
+                await self.sess.execute(stmt)
+            ).scalar_one_or_none()
         if order_orm is not None:
-            if (
-                order_orm.status == NagaOrderStatus.ok
-                or datetime.now(tz=timezone.utc).timestamp()
-                - order_orm.update_time.timestamp()
-                < 300
-            ):
-                return order_orm
-            else:  # 超过90s仍未分析完成则删除重来
-                logger.opt(colors=True).info(
-                    f"Delete tenhou paipu <y>{haihu_id}</y> analyze order "
-                    f"because it takes over 90 seconds and still not done"
-                )
-                await self.sess.delete(order_orm)
-                await self.sess.commit()
-                return None
+            self._apply_pending_completion(order_orm)
+        # 超时仍未分析完成或已失败的订单视为不存在，由新订单替换，清理交给后台任务
+        if order_orm is not None and _is_reusable(
+            order_orm, datetime.now(tz=timezone.utc)
+        ):
+            return order_orm
+        return None
 
     async def new_local_order(
         self, haihu_id: str, customer_id: int, rule: NagaGameRule, model_type: str
-    ):
+    ) -> int:
+        """
+        创建订单，返回订单消耗的NP
+        """
+        # 替换之前超时或失败的订单
+        await self._delete_orders([haihu_id])
+
         order_orm = NagaOrderOrm(
             haihu_id=haihu_id,
             customer_id=customer_id,
@@ -181,23 +487,477 @@ class NagaRepository:
             update_time=datetime.now(tz=timezone.utc),
         )
 
+        cost_np = order_orm.cost_np
+
         self.sess.add(order_orm)
         await self.sess.commit()
 
+        return cost_np
+
+    async def _add_usage(self, orders: list[Row]):
+        """
+        将订单计入按月与按日的汇总，相同汇总项的订单合并后各执行一次upsert
+        """
+        monthly: dict[tuple, tuple[int, int]] = {}
+        daily: dict[tuple, tuple[int, int]] = {}
+        for order in orders:
+            key = (order.customer_id, _month_key(order.create_time), order.source)
+            cost_np, order_count = monthly.get(key, (0, 0))
+            monthly[key] = (cost_np + order.cost_np, order_count + 1)
+
+            day = _day_key(order.create_time.astimezone(UTCDateTime.LOCAL_TIMEZONE))
+            key = (day, order.customer_id, order.source, order.model_type)
+            cost_np, order_count = daily.get(key, (0, 0))
+            daily[key] = (cost_np + order.cost_np, order_count + 1)
+
+        stmt = insert(NagaMonthlyUsageOrm).values(
+            [
+                {
+                    "customer_id": customer_id,
+                    "month": month,
+                    "source": source,
+                    "cost_np": cost_np,
+                    "order_count": order_count,
+                }
+                for (customer_id, month, source), (
+                    cost_np,
+                    order_count,
+                ) in monthly.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[
+                NagaMonthlyUsageOrm.customer_id,
+                NagaMonthlyUsageOrm.month,
+                NagaMonthlyUsageOrm.source,
+            ],
+            set_={
+                "cost_np": NagaMonthlyUsageOrm.cost_np + stmt.excluded.cost_np,
+                "order_count": NagaMonthlyUsageOrm.order_count
+                + stmt.excluded.order_count,
+            },
+        )
+        await self.sess.execute(stmt)
+
+        stmt = insert(NagaDailyUsageOrm).values(
+            [
+                {
+                    "day": day,
+                    "customer_id": customer_id,
+                    "source": source,
+                    "model_type": model_type,
+                    "cost_np": cost_np,
+                    "order_count": order_count,
+                }
+                for (day, customer_id, source, model_type), (
+                    cost_np,
+                    order_count,
+                ) in daily.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[
+                NagaDailyUsageOrm.day,
+                NagaDailyUsageOrm.customer_id,
+                NagaDailyUsageOrm.source,
+                NagaDailyUsageOrm.model_type,
+            ],
+            set_={
+                "cost_np": NagaDailyUsageOrm.cost_np + stmt.excluded.cost_np,
+                "order_count": NagaDailyUsageOrm.order_count
+                + stmt.excluded.order_count,
+            },
+        )
+        await self.sess.execute(stmt)
+
+    async def _delete_orders(self, haihu_ids: list[str]):
+        """
+        删除未完成的订单
+        """
+        if len(haihu_ids) == 0:
+            return
+
+        # sqlite默认不启用外键约束，需要手动删除
+        await self.sess.execute(
+            delete(MajsoulOrderOrm).where(
+                MajsoulOrderOrm.naga_haihu_id.in_(
+                    select(NagaOrderOrm.haihu_id).where(
+                        NagaOrderOrm.haihu_id.in_(haihu_ids),
+                        NagaOrderOrm.status != NagaOrderStatus.ok,
+                    )
+                )
+            )
+        )
+        await self.sess.execute(
+            delete(NagaOrderOrm).where(
+                NagaOrderOrm.haihu_id.in_(haihu_ids),
+                NagaOrderOrm.status != NagaOrderStatus.ok,
+            )
+        )
+
+    async def _complete_orders(self, reports: list[NagaReport]) -> dict[str, str]:
+        """
+        将报告对应的订单标记为已完成，返回{haihu_id: model_type}，不包含不存在的订单
+        """
+        if len(reports) == 0:
+            return {}
+
+        report_by_id = {report.haihu_id: report for report in reports}
+        stmt = (
+            select(
+                NagaOrderOrm.haihu_id,
+                NagaOrderOrm.model_type,
+                NagaOrderOrm.customer_id,
+                NagaOrderOrm.source,
+                NagaOrderOrm.status,
+                NagaOrderOrm.cost_np,
+                NagaOrderOrm.create_time,
+            ).where(NagaOrderOrm.haihu_id.in_(report_by_id))
+            # 锁定订单，避免并发完成同一个订单时重复计入汇总
+            .with_for_update()
+        )
+        orders = list(await self.sess.execute(stmt))
+
+        # 仅在订单首次完成时计入汇总
+        unfinished = [order for order in orders if order.status != NagaOrderStatus.ok]
+        if len(unfinished) != 0:
+            # 每个订单的报告不同，以executemany的方式批量执行同一条语句
+            order_table = NagaOrderOrm.__table__
+            await self.sess.execute(
+                update(order_table)
+                .where(
+                    order_table.c.haihu_id == bindparam("b_haihu_id"),
+                    order_table.c.status != NagaOrderStatus.ok,
+                )
+                .values(
+                    status=NagaOrderStatus.ok,
+                    naga_report=bindparam("b_naga_report"),
+                    update_time=datetime.now(timezone.utc),
+                ),
+                [
+                    {
+                        "b_haihu_id": order.haihu_id,
+                        "b_naga_report": report_by_id[order.haihu_id],
+                    }
+                    for order in unfinished
+                ],
+            )
+            await self._add_usage(unfinished)
+
+        return {order.haihu_id: order.model_type for order in orders}
+
     async def update_local_order(self, haihu_id: str, report: NagaReport):
+        """
+        将订单标记为已完成。写入会被缓冲，与其他订单合并为一个事务
+        """
+        await _completion_buffer.add(haihu_id, report)
+
+    @staticmethod
+    async def flush_local_orders():
+        """
+        立即写入缓冲中的已完成订单
+        """
+        await _completion_buffer.flush()
+
+    @staticmethod
+    async def close_local_orders():
+        """
+        停止后台写入任务，并写入缓冲中的已完成订单
+        """
+        await _completion_buffer.close()
+
+    @staticmethod
+    def _get_stale_orders_stmt() -> Select:
+        return (
+            select(NagaOrderOrm)
+            .where(NagaOrderOrm.status.in_(_UNFINISHED_STATUS))
+            .options(defer(NagaOrderOrm.naga_report))
+        )
+
+    async def get_stale_orders(self) -> list[NagaOrderOrm]:
+        """
+        获取超时仍未分析完成的订单
+        """
+        stmt = self._get_stale_orders_stmt()
+        now = datetime.now(tz=timezone.utc)
+        return [
+            order_orm
+            for order_orm in (await self.sess.execute(stmt)).scalars()
+            if _is_stale(order_orm, now)
+        ]
+
+    async def archive_reports(self, before: datetime, limit: int) -> int:
+        """
+        将create_time早于before的订单的报告移入归档表，每次最多处理limit个，返回处理的数量
+        """
         stmt = (
-            update(NagaOrderOrm)
-            .where(NagaOrderOrm.haihu_id == haihu_id)
-            .values(
-                status=NagaOrderStatus.ok,
-                naga_report=json.dumps(report),
-                update_time=datetime.now(timezone.utc),
+            select(NagaOrderOrm.haihu_id, NagaOrderOrm.naga_report)
+            .where(
+                NagaOrderOrm.status == NagaOrderStatus.ok,
+                NagaOrderOrm.create_time < before,
+                NagaOrderOrm.naga_report.is_not(None),
             )
+            .limit(limit)
+        )
+        rows = [tuple(row) for row in await self.sess.execute(stmt)]
+        if len(rows) == 0:
+            return 0
+
+        compressed = await run_serialization(
+            "naga_report.archive", None, _compress_reports, rows
+        )
+
+        archive_time = datetime.now(timezone.utc)
+        stmt = insert(NagaReportArchiveOrm).values(
+            [
+                {"haihu_id": haihu_id, "content": content, "archive_time": archive_time}
+                for haihu_id, content in compressed
+            ]
+        )
+        stmt = stmt.on_conflict_do_nothing(
+            index_elements=[NagaReportArchiveOrm.haihu_id]
         )
         await self.sess.execute(stmt)
+
+        # 使用SQL NULL而非JSON null
+        await self.sess.execute(
+            update(NagaOrderOrm)
+            .where(NagaOrderOrm.haihu_id.in_([haihu_id for haihu_id, _ in rows]))
+            .values(naga_report=null())
+        )
+        await self.sess.commit()
+
+        return len(rows)
+
+    async def claim_order(self, key: str, owner: str, timeout: float) -> bool:
+        """
+        尝试获取下单权，已被其他进程获取且未超时时返回False
+        """
+        now = datetime.now(timezone.utc)
+        stmt = insert(NagaOrderClaimOrm).values(key=key, owner=owner, claim_time=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[NagaOrderClaimOrm.key],
+            set_={"owner": owner, "claim_time": now},
+            where=NagaOrderClaimOrm.claim_time < now - timedelta(seconds=timeout),
+        )
+        result = await self.sess.execute(stmt)
+        await self.sess.commit()
+        return result.rowcount == 1
+
+    async def refresh_order_claim(self, key: str, owner: str):
+        """
+        续期已获取的下单权
+        """
+        await self.sess.execute(
+            update(NagaOrderClaimOrm)
+            .where(NagaOrderClaimOrm.key == key, NagaOrderClaimOrm.owner == owner)
+            .values(claim_time=datetime.now(timezone.utc))
+        )
+        await self.sess.commit()
+
+    async def release_order_claim(self, key: str, owner: str):
+        await self.sess.execute(
+            delete(NagaOrderClaimOrm).where(
+                NagaOrderClaimOrm.key == key, NagaOrderClaimOrm.owner == owner
+            )
+        )
         await self.sess.commit()
 
+    async def get_incomplete_order_ids(self) -> list[str]:
+        """
+        获取所有未完成（包括失败）的订单
+        """
+        stmt = select(NagaOrderOrm.haihu_id).where(
+            NagaOrderOrm.status != NagaOrderStatus.ok
+        )
+        return list((await self.sess.execute(stmt)).scalars())
+
+    async def reap_local_orders(
+        self,
+        completed: list[NagaReport],
+        failed: list[str],
+        lost: list[str],
+    ):
+        """
+        在同一个事务中批量处理订单：将completed中的报告对应的订单标记为已完成，
+        将failed中的订单标记为失败，删除lost中的订单
+        """
+        model_types = await self._complete_orders(completed)
+
+        if len(failed) != 0:
+            await self.sess.execute(
+                update(NagaOrderOrm)
+                .where(
+                    NagaOrderOrm.haihu_id.in_(failed),
+                    NagaOrderOrm.status.in_(_UNFINISHED_STATUS),
+                )
+                .values(
+                    status=NagaOrderStatus.failed,
+                    update_time=datetime.now(timezone.utc),
+                )
+            )
+
+        await self._delete_orders(lost)
+
+        await self.sess.commit()
+
+        for report in completed:
+            model_type = model_types.get(report.haihu_id)
+            if model_type is not None:
+                _report_cache.set((report.haihu_id, model_type), report)
+
+    @staticmethod
+    async def _load_report(haihu_id: str) -> Optional[NagaReport]:
+        # 使用独立的会话，因为结果会被并发的其他调用者共享
+        with _query_duration.time(query="load_report"):
+            async with AsyncSession(get_engine()) as sess:
+                stmt = select(NagaOrderOrm.naga_report).where(
+                    NagaOrderOrm.haihu_id == haihu_id
+                )
+                raw_report = (await sess.execute(stmt)).scalar_one_or_none()
+
+                if raw_report is None:
+                    # 报告可能已被归档
+                    stmt = select(NagaReportArchiveOrm.content).where(
+                        NagaReportArchiveOrm.haihu_id == haihu_id
+                    )
+                    content = (await sess.execute(stmt)).scalar_one_or_none()
+                    if content is not None:
+                        raw_report = await run_serialization(
+                            "naga_report.unarchive",
+                            len(content),
+                            _decompress_report,
+                            content,
+                        )
+
+        if raw_report is None:
+            return None
+        return _decode_report(raw_report)
+
     @staticmethod
-    def parse_report(raw_report: str) -> NagaReport:
-        wrapper_dict = {"report": json.loads(raw_report)}
-        return NagaReportWrapper.parse_obj(wrapper_dict).report
+    async def get_report(haihu_id: str, model_type: str) -> Optional[NagaReport]:
+        """
+        获取已完成订单的报告，订单不存在或未完成时返回None
+        """
+        report = _completion_buffer.get(haihu_id)
+        if report is not None:
+            return report
+
+        report = await _report_cache.get(
+            (haihu_id, model_type), lambda: NagaRepository._load_report(haihu_id)
+        )
+        if report is None:
+            _report_cache.invalidate((haihu_id, model_type))
+        return report
+
+
+class _OrderCompletionBuffer:
+    """
+    已完成订单的写入缓冲，每隔naga_order_flush_interval秒或缓冲满时合并为一个事务写入
+    """
+
+    # 连续写入失败时重试间隔的上限（秒）
+    MAX_BACKOFF = 60
+
+    def __init__(self):
+        self._reports: dict[str, NagaReport] = {}
+        self._flushing: dict[str, NagaReport] = {}
+        self._attempts: dict[str, int] = {}
+        self._failures = 0  # 连续写入失败的次数
+        self._flush_worker: Optional[asyncio.Task] = None
+
+    def get(self, haihu_id: str) -> Optional[NagaReport]:
+        report = self._reports.get(haihu_id)
+        if report is None:
+            report = self._flushing.get(haihu_id)
+        return report
+
+    async def add(self, haihu_id: str, report: NagaReport):
+        self._reports[haihu_id] = report
+
+        # 订单已经完成，写入失败不应影响本次请求，交由后台任务退避重试
+        if len(self._reports) >= conf().naga_order_flush_batch_size and (
+            self._failures == 0
+        ):
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+        if len(self._reports) != 0 and self._flush_worker is None:
+            self._flush_worker = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        try:
+            while len(self._reports) != 0:
+                await asyncio.sleep(
+                    min(
+                        conf().naga_order_flush_interval * 2**self._failures,
+                        self.MAX_BACKOFF,
+                    )
+                )
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.exception(e)
+        finally:
+            self._flush_worker = None
+
+    def _requeue(self, reports: dict[str, NagaReport]):
+        # 写入失败时放回缓冲等待重试，超过重试次数的订单在数据库中仍为未完成，
+        # 之后由过期订单的清理任务向NAGA查询并完成
+        dropped = []
+        for haihu_id, report in reports.items():
+            attempts = self._attempts.get(haihu_id, 0) + 1
+            if attempts < conf().naga_order_flush_max_attempts:
+                self._attempts[haihu_id] = attempts
+                self._reports.setdefault(haihu_id, report)
+            else:
+                self._attempts.pop(haihu_id, None)
+                dropped.append(haihu_id)
+
+        if len(dropped) != 0:
+            logger.opt(colors=True).error(
+                f"Gave up writing <y>{len(dropped)}</y> completed orders "
+                f"after {conf().naga_order_flush_max_attempts} attempts: "
+                f"{', '.join(dropped)}"
+            )
+
+    async def flush(self):
+        if len(self._reports) == 0:
+            return
+
+        reports, self._reports = self._reports, {}
+        self._flushing.update(reports)
+        try:
+            async with AsyncSession(get_engine()) as sess:
+                await NagaRepository(sess).reap_local_orders(
+                    list(reports.values()), [], []
+                )
+        except BaseException:
+            self._failures += 1
+            self._requeue(reports)
+            raise
+        else:
+            self._failures = 0
+            for haihu_id in reports:
+                self._attempts.pop(haihu_id, None)
+        finally:
+            for haihu_id in reports:
+                self._flushing.pop(haihu_id, None)
+
+    async def close(self):
+        if self._flush_worker is not None:
+            # 写入中被取消的订单会放回缓冲，随后一并写入
+            self._flush_worker.cancel()
+            await asyncio.gather(self._flush_worker, return_exceptions=True)
+            self._flush_worker = None
+        await self.flush()
+
+
+_completion_buffer = _OrderCompletionBuffer()
+metrics.gauge(
+    "nagabus_order_completion_buffer_size", "Completed orders waiting to be written"
+).set_function(
+    lambda: len(_completion_buffer._reports) + len(_completion_buffer._flushing)
+)
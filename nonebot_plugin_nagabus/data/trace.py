@@ -0,0 +1,191 @@
+import asyncio
+from typing import Optional
+from datetime import datetime, timezone, timedelta
+
+from nonebot import logger
+from nonebot_plugin_orm import AsyncSession
+from sqlalchemy import Enum, delete, select
+from sqlalchemy.orm import Mapped, mapped_column
+from nonebot_plugin_datastore.db import get_engine
+
+from ..config import conf
+from .base import SqlModel
+from .naga import NagaOrderSource
+from ..utils.trace import Trace, TraceSpan
+from .utils import JSON, UTCDateTime, insert
+
+
+class NagaTraceOrm(SqlModel):
+    """
+    解析请求的各阶段耗时，用于分析延迟
+    """
+
+    __tablename__ = "nonebot_plugin_nagabus_trace"
+    __table_args__ = {"extend_existing": True}
+
+    trace_id: Mapped[str] = mapped_column(primary_key=True)
+    source: Mapped[NagaOrderSource] = mapped_column(
+        Enum(NagaOrderSource, native_enum=False, length=16)
+    )
+    haihu_id: Mapped[Optional[str]]
+    result: Mapped[Optional[str]]  # new、cached、joined，失败时为None
+    error: Mapped[Optional[str]]  # 失败时的异常类型
+    begin_time: Mapped[datetime] = mapped_column(UTCDateTime, index=True)
+    duration: Mapped[float]
+    spans: Mapped[list] = mapped_column(JSON)  # [(phase, offset, duration), ...]
+
+
+class TraceRepository:
+    def __init__(self, sess: AsyncSession):
+        self.sess = sess
+
+    async def add_traces(self, rows: list[dict]):
+        await self.sess.execute(insert(NagaTraceOrm), rows)
+        await self.sess.commit()
+
+    async def get_traces(
+        self,
+        t_begin: datetime,
+        t_end: datetime,
+        source: Optional[NagaOrderSource] = None,
+    ) -> list[tuple[float, list[TraceSpan]]]:
+        """
+        返回时间段内开始的请求的(总耗时, 各阶段耗时)
+        """
+        stmt = select(NagaTraceOrm.duration, NagaTraceOrm.spans).where(
+            NagaTraceOrm.begin_time >= t_begin, NagaTraceOrm.begin_time < t_end
+        )
+        if source is not None:
+            stmt = stmt.where(NagaTraceOrm.source == source)
+
+        return [
+            (duration, [TraceSpan(*s) for s in spans])
+            for duration, spans in await self.sess.execute(stmt)
+        ]
+
+    async def sweep_traces(self, begin_before: datetime) -> int:
+        stmt = delete(NagaTraceOrm).where(NagaTraceOrm.begin_time < begin_before)
+        result = await self.sess.execute(stmt)
+        await self.sess.commit()
+        return result.rowcount
+
+
+class _TraceBuffer:
+    """
+    请求记录的写入缓冲，与已完成订单一样每隔naga_order_flush_interval秒合并写入。
+    写入只在后台任务中进行，缓冲满时唤醒后台任务提前写入，不增加请求的耗时
+    """
+
+    def __init__(self):
+        self._rows: list[dict] = []
+        self._flush_worker: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Future] = None
+        self._closing = False
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def add(self, row: dict):
+        self._rows.append(row)
+
+        if self._flush_worker is None:
+            self._flush_worker = asyncio.create_task(self._flush_periodically())
+        elif len(self._rows) >= conf().naga_order_flush_batch_size:
+            self._wake()
+
+    async def _flush_periodically(self):
+        try:
+            while len(self._rows) != 0:
+                if (
+                    len(self._rows) < conf().naga_order_flush_batch_size
+                    and not self._closing
+                ):
+                    self._wakeup = asyncio.get_running_loop().create_future()
+                    try:
+                        await asyncio.wait(
+                            (self._wakeup,), timeout=conf().naga_order_flush_interval
+                        )
+                    finally:
+                        self._wakeup = None
+                await self.flush()
+        finally:
+            self._flush_worker = None
+
+    async def flush(self):
+        if len(self._rows) == 0:
+            return
+
+        rows, self._rows = self._rows, []
+        # 请求记录仅用于诊断，写入失败时直接丢弃
+        try:
+            async with AsyncSession(get_engine()) as sess:
+                await TraceRepository(sess).add_traces(rows)
+        except Exception as e:
+            logger.opt(exception=e).warning(f"Failed to write {len(rows)} traces")
+
+    async def close(self):
+        """
+        唤醒后台任务写入缓冲中的请求记录，并等待其结束
+        """
+        worker = self._flush_worker
+        if worker is None:
+            return
+
+        self._closing = True
+        try:
+            self._wake()
+            await worker
+        finally:
+            self._closing = False
+
+
+_trace_buffer = _TraceBuffer()
+
+
+def record_trace(trace: Trace, source: NagaOrderSource):
+    if not conf().naga_trace:
+        return
+
+    trace.finish()
+    _trace_buffer.add(
+        {
+            "trace_id": trace.trace_id,
+            "source": source,
+            "haihu_id": trace.attributes.get("haihu_id"),
+            "result": trace.attributes.get("result"),
+            "error": trace.attributes.get("error"),
+            "begin_time": trace.begin_time,
+            "duration": trace.duration,
+            "spans": [list(s) for s in trace.spans],
+        }
+    )
+
+
+async def flush_traces():
+    """
+    写入缓冲中的请求记录，并等待后台写入任务结束
+    """
+    await _trace_buffer.close()
+
+
+async def get_traces(
+    t_begin: datetime, t_end: datetime, source: Optional[NagaOrderSource] = None
+) -> list[tuple[float, list[TraceSpan]]]:
+    await _trace_buffer.flush()
+    async with AsyncSession(get_engine()) as sess:
+        return await TraceRepository(sess).get_traces(t_begin, t_end, source)
+
+
+async def sweep_traces() -> int:
+    """
+    删除超过naga_trace_retention_days天的请求记录，返回删除的数量
+    """
+    begin_before = datetime.now(timezone.utc) - timedelta(
+        days=conf().naga_trace_retention_days
+    )
+    async with AsyncSession(get_engine()) as sess:
+        cnt = await TraceRepository(sess).sweep_traces(begin_before)
+    if cnt > 0:
+        logger.info(f"Swept {cnt} traces")
+    return cnt
@@ -1,21 +1,178 @@
-from typing import Callable
-from collections.abc import Coroutine
-from asyncio import Future, create_task
-
-_cache: dict[str, Future] = {}
-_cache_consumers: dict[str, int] = {}
-
-
-async def get_atomic_cache(key: str, get_cache: Callable[[], Coroutine]):
-    if key not in _cache:
-        _cache_consumers[key] = 0
-        _cache[key] = create_task(get_cache())
-
-    _cache_consumers[key] += 1
-    try:
-        return await _cache[key]
-    finally:
-        _cache_consumers[key] -= 1
-        if _cache_consumers[key] == 0:
-            del _cache[key]
-            del _cache_consumers[key]
+from time import monotonic
+from collections import OrderedDict
+from collections.abc import Hashable, Coroutine
+from asyncio import Future, create_task, get_running_loop
+from typing import Any, Generic, TypeVar, Callable, Optional, NamedTuple
+
+T = TypeVar("T")
+
+
+class AtomicCacheStatistic(NamedTuple):
+    hits: int  # 命中已完成的结果
+    joins: int  # 加入进行中的任务
+    misses: int  # 新建任务
+    negative_hits: int  # 命中缓存的异常
+    evictions: int  # 因过期、超出容量或手动失效而移除
+    size: int
+
+
+class _Entry:
+    __slots__ = ("task", "consumers", "expire_at")
+
+    def __init__(self, task: Future):
+        self.task = task
+        self.consumers = 0
+        # 任务完成后才会设置，为None表示不保留结果（最后一个使用者离开时移除）
+        self.expire_at: Optional[float] = None
+
+
+class AtomicCache(Generic[T]):
+    """
+    异步记忆化缓存：同一个key同时只会执行一次获取操作，其余调用者共享该次结果。
+
+    :param ttl: 默认的结果保留时间（秒），仅当retain为True时生效
+    :param retain: 最后一个使用者离开后是否继续保留结果
+    :param negative_ttl: 根据获取时抛出的异常返回其缓存时间（秒），返回None表示不缓存该异常
+    :param max_size: 最多保留的已完成结果数，超出时移除最久未使用的
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: float = 0,
+        retain: bool = False,
+        negative_ttl: Optional[Callable[[BaseException], Optional[float]]] = None,
+        max_size: Optional[int] = None,
+    ):
+        self.ttl = ttl
+        self.retain = retain
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+
+        self._hits = 0
+        self._joins = 0
+        self._misses = 0
+        self._negative_hits = 0
+        self._evictions = 0
+
+    @property
+    def statistic(self) -> AtomicCacheStatistic:
+        return AtomicCacheStatistic(
+            hits=self._hits,
+            joins=self._joins,
+            misses=self._misses,
+            negative_hits=self._negative_hits,
+            evictions=self._evictions,
+            size=len(self._entries),
+        )
+
+    def set(self, key: Hashable, value: T, *, ttl: Optional[float] = None):
+        """
+        直接写入结果，仅当retain为True时生效
+        """
+        if not self.retain:
+            return
+
+        fut = get_running_loop().create_future()
+        fut.set_result(value)
+
+        entry = _Entry(fut)
+        entry.expire_at = monotonic() + (ttl if ttl is not None else self.ttl)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._evict_overflow()
+
+    def invalidate(self, key: Hashable):
+        if self._entries.pop(key, None) is not None:
+            self._evictions += 1
+
+    def clear(self):
+        self._evictions += len(self._entries)
+        self._entries.clear()
+
+    def _on_done(self, key: Hashable, entry: _Entry, ttl: float):
+        if self._entries.get(key) is not entry:
+            return
+
+        if entry.task.cancelled():
+            expire_in = None
+        elif entry.task.exception() is not None:
+            if self.negative_ttl is not None:
+                expire_in = self.negative_ttl(entry.task.exception())
+            else:
+                expire_in = None
+        elif self.retain and ttl > 0:
+            expire_in = ttl
+        else:
+            expire_in = None
+
+        if expire_in is not None:
+            entry.expire_at = monotonic() + expire_in
+            self._evict_overflow()
+        elif entry.consumers == 0:
+            del self._entries[key]
+
+    def _evict_overflow(self):
+        if self.max_size is None:
+            return
+
+        retained = [
+            k for k, v in self._entries.items() if v.expire_at is not None
+        ]  # 按最近使用排序
+        for k in retained[: max(0, len(retained) - self.max_size)]:
+            if self._entries[k].consumers == 0:
+                self.invalidate(k)
+
+    def _lookup(self, key: Hashable) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if entry.expire_at is not None and entry.expire_at <= monotonic():
+            self.invalidate(key)
+            return None
+
+        self._entries.move_to_end(key)
+        if not entry.task.done():
+            self._joins += 1
+        elif entry.task.cancelled() or entry.task.exception() is None:
+            self._hits += 1
+        else:
+            self._negative_hits += 1
+        return entry
+
+    async def get(
+        self,
+        key: Hashable,
+        get_value: Callable[[], Coroutine[Any, Any, T]],
+        *,
+        ttl: Optional[float] = None,
+    ) -> T:
+        """
+        :param ttl: 覆盖默认的结果保留时间
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            self._misses += 1
+            entry = _Entry(create_task(get_value()))
+            self._entries[key] = entry
+            entry.task.add_done_callback(
+                lambda _: self._on_done(
+                    key, entry, ttl if ttl is not None else self.ttl
+                )
+            )
+
+        entry.consumers += 1
+        try:
+            return await entry.task
+        finally:
+            entry.consumers -= 1
+            if (
+                entry.consumers == 0
+                and entry.expire_at is None
+                and entry.task.done()
+                and self._entries.get(key) is entry
+            ):
+                del self._entries[key]
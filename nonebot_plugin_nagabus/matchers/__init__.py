@@ -1,3 +1,8 @@
+from . import naga_trace  # noqa
+from . import naga_export  # noqa
 from . import naga_analyze  # noqa
+from . import naga_archive  # noqa
+from . import naga_metrics  # noqa
+from . import naga_profiler  # noqa
 from . import naga_statistic  # noqa
 from . import naga_set_cookies  # noqa
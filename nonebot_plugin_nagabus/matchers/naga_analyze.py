@@ -1,15 +1,19 @@
 import re
+import asyncio
+from io import StringIO
+from weakref import WeakValueDictionary
 from urllib.parse import parse_qs, urlparse
+from typing import Union, Optional, NamedTuple
 
 from nonebot import on_command
 from nonebot.params import CommandArg
 from nonebot.internal.params import Depends
 from nonebot_plugin_saa import MessageFactory
 from ssttkkl_nonebot_utils.integer import decode_integer
-from nonebot_plugin_session import Session, extract_session
 from ssttkkl_nonebot_utils.errors.errors import BadRequestError
 from ssttkkl_nonebot_utils.nonebot import default_command_start
 from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
+from nonebot_plugin_session import Session, SessionIdType, extract_session
 from nonebot_plugin_access_control_api.service.contextvars import (
     current_rate_limit_token,
 )
@@ -22,8 +26,12 @@ from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
 
 from ..ac import ac
 from ..naga import naga
+from ..config import conf
 from .errors import error_handlers
+from ..utils.profiler import profiler
+from ..naga.service import T_ProgressCallback
 from ..naga.errors import InvalidKyokuHonbaError
+from ..naga.model import NagaOrderStatus, NagaAnalyzeStage, NagaAnalyzeProgress
 
 analyze_srv = ac.create_subservice("analyze")
 
@@ -36,9 +44,34 @@ async def _retire_token():
         pass
 
 
+def _format_invalid_kyoku_honba(e: InvalidKyokuHonbaError) -> str:
+    kyoku_honba = []
+    for kyoku, honba in e.available_kyoku_honba:
+        if kyoku <= 3:
+            kyoku_honba.append(f"东{kyoku + 1}局{honba}本场")
+        elif kyoku <= 7:
+            kyoku_honba.append(f"南{kyoku - 3}局{honba}本场")
+        else:
+            kyoku_honba.append(f"西{kyoku - 7}局{honba}本场")
+    return f"请输入正确的场次与本场（{'、'.join(kyoku_honba)}）"
+
+
+async def _reply_progress(event: NagaAnalyzeProgress):
+    # 解析可能需要数分钟，提前告知用户，避免用户以为没有响应而重试
+    if event.stage == NagaAnalyzeStage.order_placed:
+        await MessageFactory("已提交解析，请耐心等待").send(reply=True)
+    elif (
+        event.stage == NagaAnalyzeStage.status_changed
+        and event.status == NagaOrderStatus.analyzing
+    ):
+        await MessageFactory("NAGA正在解析中……").send(reply=True)
+
+
 async def analyze_majsoul(session: Session, uuid: str, kyoku: int, honba: int):
     try:
-        report, cost_np = await naga.analyze_majsoul(uuid, kyoku, honba, session)
+        report, cost_np = await naga.analyze_majsoul(
+            uuid, kyoku, honba, session, progress=_reply_progress
+        )
         await MessageFactory(
             f"https://naga.dmv.nico/htmls/{report.report_id}.html?tw=0"
         ).send(reply=True)
@@ -51,22 +84,13 @@ async def analyze_majsoul(session: Session, uuid: str, kyoku: int, honba: int):
         else:
             await MessageFactory(f"本次解析消耗{cost_np}NP").send(reply=True)
     except InvalidKyokuHonbaError as e:
-        kyoku_honba = []
-        for kyoku, honba in e.available_kyoku_honba:
-            if kyoku <= 3:
-                kyoku_honba.append(f"东{kyoku + 1}局{honba}本场")
-            elif kyoku <= 7:
-                kyoku_honba.append(f"南{kyoku - 3}局{honba}本场")
-            else:
-                kyoku_honba.append(f"西{kyoku - 7}局{honba}本场")
-
-        raise BadRequestError(
-            f"请输入正确的场次与本场（{'、'.join(kyoku_honba)}）"
-        ) from e
+        raise BadRequestError(_format_invalid_kyoku_honba(e)) from e
 
 
 async def analyze_tenhou(session: Session, haihu_id: str, seat: int):
-    report, cost_np = await naga.analyze_tenhou(haihu_id, seat, session)
+    report, cost_np = await naga.analyze_tenhou(
+        haihu_id, seat, session, progress=_reply_progress
+    )
     await MessageFactory(
         f"https://naga.dmv.nico/htmls/{report.report_id}.html?tw={seat}"
     ).send(reply=True)
@@ -89,7 +113,184 @@ kyoku_honba_reg = re.compile(
 )
 
 
+class MajsoulTarget(NamedTuple):
+    uuid: str
+    kyoku: int  # -1表示未指定
+    honba: int
+
+
+class TenhouTarget(NamedTuple):
+    haihu_id: str
+    seat: int
+
+
+AnalyzeTarget = Union[MajsoulTarget, TenhouTarget]
+
+
+def _parse_kyoku_honba(text: str) -> Optional[tuple[int, int]]:
+    mat = kyoku_honba_reg.search(text)
+    if not mat:
+        return None
+
+    raw_wind, raw_kyoku, _, raw_honba = mat.groups()
+
+    try:
+        kyoku = decode_integer(raw_kyoku) - 1
+        if raw_wind == "南":
+            kyoku += 4
+        elif raw_wind == "西":
+            kyoku += 8
+
+        honba = -1
+        if raw_honba is not None:
+            honba = decode_integer(raw_honba)
+    except ValueError:
+        return None
+
+    return kyoku, honba
+
+
+def _parse_tenhou_target(url: str) -> TenhouTarget:
+    _, _, _, _, tenhou_query, _ = urlparse(url.strip())
+    tenhou_query = parse_qs(tenhou_query)
+
+    if "log" not in tenhou_query:
+        raise BadRequestError("不正确的天凤牌谱")
+
+    haihu_id = tenhou_query["log"][0]
+    seat = 0
+    if "tw" in tenhou_query and len(tenhou_query["tw"]) > 0:
+        seat = int(tenhou_query["tw"][0])
+
+    return TenhouTarget(haihu_id, seat)
+
+
+def parse_analyze_targets(text: str) -> list[AnalyzeTarget]:
+    """
+    解析消息中的所有牌谱链接。雀魂牌谱链接后可跟随一个或多个场次本场，每个场次本场对应一个解析目标
+    """
+    targets: list[AnalyzeTarget] = []
+    for arg in text.split():
+        if "maj-soul" in arg:
+            mat = uuid_reg.search(arg)
+            if not mat:
+                raise BadRequestError("不正确的雀魂牌谱")
+            targets.append(MajsoulTarget(mat.group(0), -1, -1))
+        elif "tenhou" in arg:
+            targets.append(_parse_tenhou_target(arg))
+        elif len(targets) > 0 and isinstance(targets[-1], MajsoulTarget):
+            kyoku_honba = _parse_kyoku_honba(arg)
+            if kyoku_honba is None:
+                continue
+
+            last = targets[-1]
+            if last.kyoku == -1:
+                targets[-1] = MajsoulTarget(last.uuid, *kyoku_honba)
+            else:
+                targets.append(MajsoulTarget(last.uuid, *kyoku_honba))
+
+    # 去除重复的目标
+    return list(dict.fromkeys(targets))
+
+
+# 按用户限制同时进行的解析数（包括单个解析与批量解析），没有正在进行的解析时自动释放
+_user_semaphores: WeakValueDictionary[str, asyncio.Semaphore] = WeakValueDictionary()
+
+
+def _get_user_semaphore(session: Session) -> asyncio.Semaphore:
+    user_id = session.get_id(SessionIdType.USER)
+    sem = _user_semaphores.get(user_id)
+    if sem is None:
+        sem = asyncio.Semaphore(conf().naga_analyze_user_concurrency)
+        _user_semaphores[user_id] = sem
+    return sem
+
+
+async def _analyze_target(
+    session: Session,
+    sem: asyncio.Semaphore,
+    target: AnalyzeTarget,
+    progress: Optional[T_ProgressCallback] = None,
+) -> tuple[str, int]:
+    """
+    解析单个目标，返回(结果描述, 消耗的NP)
+    """
+    errors = []
+    try:
+        async with error_handlers.run_excepting(errors.append, reraise_unhandled=True):
+            async with sem:
+                try:
+                    if isinstance(target, MajsoulTarget):
+                        report, cost_np = await naga.analyze_majsoul(
+                            target.uuid,
+                            target.kyoku,
+                            target.honba,
+                            session,
+                            progress=progress,
+                        )
+                        seat = 0
+                    else:
+                        report, cost_np = await naga.analyze_tenhou(
+                            target.haihu_id, target.seat, session, progress=progress
+                        )
+                        seat = target.seat
+                except InvalidKyokuHonbaError as e:
+                    return _format_invalid_kyoku_honba(e), 0
+
+            msg = f"https://naga.dmv.nico/htmls/{report.report_id}.html?tw={seat}"
+            if cost_np == 0:
+                msg += "（此前已解析过，消耗0NP）"
+            else:
+                msg += f"（消耗{cost_np}NP）"
+            return msg, cost_np
+    except Exception:
+        # 未处理的异常已被转换为内部错误信息，其余（如MatcherException）照常抛出。
+        # CancelledError不是Exception，批量解析被取消时（如Bot关闭）直接中止
+        if len(errors) == 0:
+            raise
+
+    return errors[0] if len(errors) > 0 else "解析失败", 0
+
+
+async def analyze_single(session: Session, target: AnalyzeTarget):
+    async with _get_user_semaphore(session):
+        if isinstance(target, MajsoulTarget):
+            # 如果未指定场次本场，则让其发送该局的场次本场信息
+            await analyze_majsoul(session, target.uuid, target.kyoku, target.honba)
+        else:
+            await analyze_tenhou(session, target.haihu_id, target.seat)
+
+
+async def analyze_batch(session: Session, targets: list[AnalyzeTarget]):
+    sem = _get_user_semaphore(session)
+    acknowledged = False
+
+    async def progress(event: NagaAnalyzeProgress):
+        nonlocal acknowledged
+        # 批量解析只在首次下单时回复一次，避免刷屏
+        if event.stage == NagaAnalyzeStage.order_placed and not acknowledged:
+            acknowledged = True
+            await MessageFactory(
+                f"已开始解析{len(targets)}个牌谱，全部完成后将合并回复"
+            ).send(reply=True)
+
+    results = await asyncio.gather(
+        *[_analyze_target(session, sem, target, progress) for target in targets]
+    )
+
+    total_cost_np = sum(cost_np for _, cost_np in results)
+    if total_cost_np == 0:
+        await _retire_token()
+
+    with StringIO() as sio:
+        for i, (msg, _) in enumerate(results):
+            sio.write(f"#{i + 1} {msg}\n")
+        sio.write(f"\n本次解析共消耗{total_cost_np}NP")
+        await MessageFactory(sio.getvalue()).send(reply=True)
+
+
 @naga_analyze_matcher.handle()
+@profiler.profiled("naga_analyze")
 @with_graceful_shutdown()
 @handle_error(error_handlers)
 @analyze_srv.patch_handler(retire_on_throw=True)
@@ -97,51 +298,20 @@ kyoku_honba_reg = re.compile(
 async def naga_analyze(
     cmd_args=CommandArg(), session: Session = Depends(extract_session)
 ):
-    args = cmd_args.extract_plain_text().split(" ")
-    if "maj-soul" in args[0]:
-        mat = uuid_reg.search(args[0])
-        if not mat:
-            raise BadRequestError("不正确的雀魂牌谱")
+    targets = parse_analyze_targets(cmd_args.extract_plain_text())
 
-        uuid = mat.group(0)
+    max_targets = conf().naga_analyze_batch_max_targets
+    if len(targets) > max_targets:
+        raise BadRequestError(f"一次最多解析{max_targets}个牌谱")
 
-        kyoku = -1
-        honba = -1
-
-        if len(args) >= 2:
-            mat = kyoku_honba_reg.search(args[1])
-            if mat:
-                raw_wind, raw_kyoku, _, raw_honba = mat.groups()
-
-                try:
-                    kyoku = decode_integer(raw_kyoku) - 1
-                    if raw_wind == "南":
-                        kyoku += 4
-                    elif raw_wind == "西":
-                        kyoku += 8
-
-                    if raw_honba is not None:
-                        honba = decode_integer(raw_honba)
-                except ValueError:
-                    pass
-
-        # 如果未指定场次本场，则让其发送该局的场次本场信息
-        await analyze_majsoul(session, uuid, kyoku, honba)
-    elif "tenhou" in args[0]:
-        tenhou_url = args[0].strip()
-
-        _, _, _, _, tenhou_query, _ = urlparse(tenhou_url)
-        tenhou_query = parse_qs(tenhou_query)
-
-        haihu_id = tenhou_query["log"][0]
-        seat = 0
-        if "tw" in tenhou_query and len(tenhou_query["tw"]) > 0:
-            seat = int(tenhou_query["tw"][0])
-
-        await analyze_tenhou(session, haihu_id, seat)
+    if len(targets) == 1:
+        await analyze_single(session, targets[0])
+    elif len(targets) > 1:
+        await analyze_batch(session, targets)
     else:
         await MessageFactory(
             "用法：\n"
             f"{default_command_start}naga <雀魂牌谱链接> <东/南x局x本场>：消耗10NP解析雀魂小局\n"
-            f"{default_command_start}naga <天凤牌谱链接>：消耗50NP解析天凤半庄"
+            f"{default_command_start}naga <天凤牌谱链接>：消耗50NP解析天凤半庄\n"
+            "可在一条消息中发送多个牌谱链接（雀魂牌谱链接后可跟随多个场次）进行批量解析"
         ).send(reply=True)
@@ -0,0 +1,26 @@
+from nonebot import on_command
+from nonebot.permission import SUPERUSER
+from nonebot.internal.matcher import Matcher
+from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
+from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
+    with_handling_reaction,
+)
+
+from ..ac import ac
+from ..naga import naga
+from .errors import error_handlers
+
+archive_srv = ac.create_subservice("archive")
+
+archive_matcher = on_command(
+    "naga-archive", priority=4, block=True, permission=SUPERUSER
+)
+archive_srv.patch_matcher(archive_matcher)
+
+
+@archive_matcher.handle()
+@handle_error(error_handlers)
+@with_handling_reaction()
+async def naga_archive(matcher: Matcher):
+    cnt = await naga.archive_reports()
+    await matcher.send(f"已归档{cnt}份报告")
@@ -0,0 +1,50 @@
+from datetime import date
+
+from nonebot import on_command
+from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
+from nonebot.internal.matcher import Matcher
+from ssttkkl_nonebot_utils.errors.errors import BadRequestError
+from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
+from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
+    with_handling_reaction,
+)
+
+from ..ac import ac
+from ..naga import naga
+from .errors import error_handlers
+from ..data.export import EXPORT_FORMATS
+
+export_srv = ac.create_subservice("export")
+
+export_matcher = on_command("naga-export", priority=4, block=True, permission=SUPERUSER)
+export_srv.patch_matcher(export_matcher)
+
+
+@export_matcher.handle()
+@handle_error(error_handlers)
+@with_handling_reaction()
+async def naga_export(matcher: Matcher, cmd_args=CommandArg()):
+    args = cmd_args.extract_plain_text().split()
+
+    with_report = "--report" in args
+    args = [x for x in args if x != "--report"]
+
+    fmt = "csv"
+    if len(args) == 3:
+        fmt = args.pop().lower()
+        if fmt not in EXPORT_FORMATS:
+            raise BadRequestError(f"导出格式只支持{'、'.join(EXPORT_FORMATS)}")
+
+    try:
+        if len(args) != 2:
+            raise ValueError()
+        begin, end = date.fromisoformat(args[0]), date.fromisoformat(args[1])
+    except ValueError as e:
+        raise BadRequestError("请输入正确的日期（格式：YYYY-MM-DD）") from e
+
+    if end < begin:
+        raise BadRequestError("结束日期不能早于开始日期")
+
+    result = await naga.export_orders(begin, end, fmt, with_report)
+    await matcher.send(f"已导出{result.count}个订单到{result.path}")
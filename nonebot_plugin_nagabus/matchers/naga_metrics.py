@@ -0,0 +1,59 @@
+from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
+from nonebot.internal.matcher import Matcher
+from nonebot import logger, get_driver, on_command
+from nonebot.drivers import URL, Request, Response
+from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
+from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
+    with_handling_reaction,
+)
+
+from ..ac import ac
+from ..config import conf
+from ..utils import metrics
+from .errors import error_handlers
+
+try:
+    from nonebot.drivers import ASGIMixin, HTTPServerSetup
+except ImportError:  # nonebot2 < 2.1
+    ASGIMixin = HTTPServerSetup = None
+
+
+async def _handle_metrics(request: Request) -> Response:
+    return Response(
+        200, headers={"Content-Type": metrics.CONTENT_TYPE}, content=metrics.render()
+    )
+
+
+_driver = get_driver()
+if conf().naga_metrics_path:
+    if ASGIMixin is not None and isinstance(_driver, ASGIMixin):
+        _driver.setup_http_server(
+            HTTPServerSetup(
+                URL(conf().naga_metrics_path),
+                "GET",
+                "nagabus_metrics",
+                _handle_metrics,
+            )
+        )
+        logger.opt(colors=True).info(
+            f"Serving nagabus metrics at <y>{conf().naga_metrics_path}</y>"
+        )
+    else:
+        logger.info("driver does not support http server, metrics are unavailable")
+
+metrics_srv = ac.create_subservice("metrics")
+
+metrics_matcher = on_command(
+    "naga-metrics", priority=4, block=True, permission=SUPERUSER
+)
+metrics_srv.patch_matcher(metrics_matcher)
+
+
+@metrics_matcher.handle()
+@handle_error(error_handlers)
+@with_handling_reaction()
+async def naga_metrics(matcher: Matcher, cmd_args=CommandArg()):
+    # 可指定指标名前缀，避免消息过长
+    prefix = cmd_args.extract_plain_text().strip()
+    await matcher.send(metrics.render(prefix).strip())
@@ -0,0 +1,35 @@
+from nonebot import on_command
+from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
+from nonebot.internal.matcher import Matcher
+from ssttkkl_nonebot_utils.errors.errors import BadRequestError
+from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
+from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
+    with_handling_reaction,
+)
+
+from ..ac import ac
+from .errors import error_handlers
+from ..utils.profiler import profiler
+
+profiler_srv = ac.create_subservice("profiler")
+
+profiler_matcher = on_command(
+    "naga-profiler", priority=4, block=True, permission=SUPERUSER
+)
+profiler_srv.patch_matcher(profiler_matcher)
+
+
+@profiler_matcher.handle()
+@handle_error(error_handlers)
+@with_handling_reaction()
+async def naga_profiler(matcher: Matcher, cmd_args=CommandArg()):
+    arg = cmd_args.extract_plain_text().strip().lower()
+    if arg == "on":
+        profiler.enable()
+    elif arg == "off":
+        profiler.disable()
+    elif arg != "":
+        raise BadRequestError("请输入on或off")
+
+    await matcher.send(f"采样分析：{'已开启' if profiler.enabled else '已关闭'}")
@@ -1,11 +1,13 @@
+import asyncio
 from io import StringIO
 from typing import Optional
-from datetime import datetime
+from datetime import date, datetime
 
 from monthdelta import monthdelta
 from nonebot import Bot, on_command
+from nonebot.params import CommandArg
 from nonebot_plugin_saa import MessageFactory
-from nonebot_plugin_session_orm import get_session_by_persist_id
+from ssttkkl_nonebot_utils.errors.errors import BadRequestError
 from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
 from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
     with_handling_reaction,
@@ -15,8 +17,14 @@ from ..ac import ac
 from ..naga import naga
 from ..utils.tz import TZ_TOKYO
 from .errors import error_handlers
-from ..utils.nickname import get_nickname
-from ..naga.model import NagaServiceUserStatistic
+from ..utils.profiler import profiler
+from ..utils.nickname import get_customer_nicknames
+from ..naga.model import (
+    NagaUsage,
+    NagaRestNp,
+    NagaServiceUserStatistic,
+    NagaServiceUsageAnalytics,
+)
 
 statistic_srv = ac.create_subservice("statistic")
 
@@ -26,20 +34,24 @@ async def naga_statistic(
     year: int,
     month: int,
     statistic: list[NagaServiceUserStatistic],
-    rest_np: Optional[int] = None,
+    rest_np: Optional[NagaRestNp] = None,
 ):
     total_cost_np = 0
 
+    nicknames = await get_customer_nicknames(bot, [s.customer_id for s in statistic])
+
     with StringIO() as sio:
-        for i, s in enumerate(statistic):
-            session = await get_session_by_persist_id(s.customer_id)
-            sio.write(f"#{i + 1} {await get_nickname(bot, session)}: {s.cost_np}NP\n")
+        for i, (s, nickname) in enumerate(zip(statistic, nicknames)):
+            sio.write(f"#{i + 1} {nickname}: {s.cost_np}NP\n")
 
             total_cost_np += s.cost_np
 
         msg = f"{year}年{month}月共使用{total_cost_np}NP"
         if rest_np is not None:
-            msg += f"，剩余{rest_np}NP"
+            if rest_np.approximate:
+                msg += f"，剩余约{rest_np.value}NP"
+            else:
+                msg += f"，剩余{rest_np.value}NP"
         msg = (msg + "\n\n" + sio.getvalue()).strip()
 
         await MessageFactory(msg).send(reply=True)
@@ -52,12 +64,14 @@ statistic_srv.patch_matcher(naga_statistic_this_month_matcher)
 
 
 @naga_statistic_this_month_matcher.handle()
+@profiler.profiled("naga_statistic")
 @handle_error(error_handlers)
 @with_handling_reaction()
 async def naga_statistic_this_month(bot: Bot):
     cur = datetime.now(tz=TZ_TOKYO)
-    statistic = await naga.statistic(cur.year, cur.month)
-    rest_np = await naga.get_rest_np()
+    statistic, rest_np = await asyncio.gather(
+        naga.statistic(cur.year, cur.month), naga.get_cached_rest_np()
+    )
     await naga_statistic(bot, cur.year, cur.month, statistic, rest_np)
 
 
@@ -68,9 +82,101 @@ statistic_srv.patch_matcher(naga_statistic_prev_month_matcher)
 
 
 @naga_statistic_prev_month_matcher.handle()
+@profiler.profiled("naga_statistic")
 @handle_error(error_handlers)
 @with_handling_reaction()
 async def naga_statistic_prev_month(bot: Bot):
     prev_month = datetime.now(tz=TZ_TOKYO) - monthdelta(months=1)
     statistic = await naga.statistic(prev_month.year, prev_month.month)
     await naga_statistic(bot, prev_month.year, prev_month.month, statistic)
+
+
+_SOURCE_NAME = {"tenhou": "天凤", "majsoul": "雀魂"}
+
+# 超过该天数时，时间序列按月合并显示
+_MAX_DAILY_LINES = 31
+
+
+def _format_usage(usage: NagaUsage) -> str:
+    return f"{usage.cost_np}NP（{usage.order_count}次）"
+
+
+async def naga_analytics(bot: Bot, analytics: NagaServiceUsageAnalytics):
+    nicknames = await get_customer_nicknames(bot, list(analytics.by_customer))
+
+    with StringIO() as sio:
+        sio.write(
+            f"{analytics.begin.isoformat()}至{analytics.end.isoformat()}"
+            f"共使用{_format_usage(analytics.total)}\n"
+        )
+
+        if len(analytics.by_source) > 0:
+            sio.write("\n按来源：\n")
+            for source, usage in analytics.by_source.items():
+                sio.write(
+                    f"{_SOURCE_NAME.get(source, source)}: {_format_usage(usage)}\n"
+                )
+
+        if len(analytics.by_model_type) > 0:
+            sio.write("\n按模型：\n")
+            for model_type, usage in analytics.by_model_type.items():
+                sio.write(f"{model_type}: {_format_usage(usage)}\n")
+
+        if len(analytics.by_customer) > 0:
+            sio.write("\n按用户：\n")
+            for i, (usage, nickname) in enumerate(
+                zip(analytics.by_customer.values(), nicknames)
+            ):
+                sio.write(f"#{i + 1} {nickname}: {_format_usage(usage)}\n")
+
+        if len(analytics.daily) <= _MAX_DAILY_LINES:
+            series = [
+                (d.day.isoformat(), NagaUsage(d.cost_np, d.order_count))
+                for d in analytics.daily
+            ]
+        else:
+            monthly = {}
+            for d in analytics.daily:
+                key = f"{d.day.year}-{d.day.month:02d}"
+                cost_np, order_count = monthly.get(key, (0, 0))
+                monthly[key] = NagaUsage(
+                    cost_np + d.cost_np, order_count + d.order_count
+                )
+            series = list(monthly.items())
+
+        series = [(k, usage) for k, usage in series if usage.order_count > 0]
+        if len(series) > 0:
+            sio.write("\n按时间：\n")
+            for k, usage in series:
+                sio.write(f"{k}: {_format_usage(usage)}\n")
+
+        await MessageFactory(sio.getvalue().strip()).send(reply=True)
+
+
+naga_analytics_matcher = on_command(
+    "naga使用统计", aliases={"naga-analytics"}, priority=5, block=True
+)
+statistic_srv.patch_matcher(naga_analytics_matcher)
+
+
+@naga_analytics_matcher.handle()
+@profiler.profiled("naga_analytics")
+@handle_error(error_handlers)
+@with_handling_reaction()
+async def _(bot: Bot, cmd_args=CommandArg()):
+    args = cmd_args.extract_plain_text().split()
+    try:
+        if len(args) == 1:
+            begin, end = date.fromisoformat(args[0]), date.today()
+        elif len(args) == 2:
+            begin, end = date.fromisoformat(args[0]), date.fromisoformat(args[1])
+        else:
+            raise ValueError()
+    except ValueError as e:
+        raise BadRequestError("请输入正确的日期（格式：YYYY-MM-DD）") from e
+
+    if end < begin:
+        raise BadRequestError("结束日期不能早于开始日期")
+
+    analytics = await naga.analytics(begin, end)
+    await naga_analytics(bot, analytics)
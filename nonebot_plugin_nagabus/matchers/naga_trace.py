@@ -0,0 +1,49 @@
+from io import StringIO
+from datetime import datetime, timezone, timedelta
+
+from nonebot import on_command
+from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
+from nonebot.internal.matcher import Matcher
+from ssttkkl_nonebot_utils.errors.errors import BadRequestError
+from ssttkkl_nonebot_utils.interceptor.handle_error import handle_error
+from ssttkkl_nonebot_utils.interceptor.with_handling_reaction import (
+    with_handling_reaction,
+)
+
+from ..ac import ac
+from ..naga import naga
+from .errors import error_handlers
+
+trace_srv = ac.create_subservice("trace")
+
+trace_matcher = on_command("naga-trace", priority=4, block=True, permission=SUPERUSER)
+trace_srv.patch_matcher(trace_matcher)
+
+
+@trace_matcher.handle()
+@handle_error(error_handlers)
+@with_handling_reaction()
+async def naga_trace(matcher: Matcher, cmd_args=CommandArg()):
+    args = cmd_args.extract_plain_text().strip()
+    try:
+        hours = float(args) if args else 24
+        if hours <= 0:
+            raise ValueError()
+    except ValueError as e:
+        raise BadRequestError("请输入正确的小时数") from e
+
+    t_end = datetime.now(timezone.utc)
+    latency = await naga.trace_latency(t_end - timedelta(hours=hours), t_end)
+    if len(latency) == 0:
+        await matcher.send(f"最近{args or 24}小时没有解析请求")
+        return
+
+    with StringIO() as sio:
+        sio.write(f"最近{args or 24}小时的解析请求耗时（秒）：\n")
+        for phase, x in latency.items():
+            sio.write(
+                f"{phase}: {x.count}次 p50={x.p50:.3f} p90={x.p90:.3f} "
+                f"p99={x.p99:.3f} max={x.max:.3f}\n"
+            )
+        await matcher.send(sio.getvalue().strip())
@@ -0,0 +1,50 @@
+"""composite indexes for order lookup
+
+Revision ID: 31a9e0c3405a
+Revises: c964f898d0a5
+Create Date: 2026-10-19 16:24:37.810592
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "31a9e0c3405a"
+down_revision = "c964f898d0a5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table(
+        "nonebot_plugin_nagabus_majsoul_order", schema=None
+    ) as batch_op:
+        # 被新的复合索引的前缀覆盖
+        batch_op.drop_index("ix_nonebot_plugin_nagabus_majsoul_order_paipu_uuid")
+        batch_op.create_index(
+            "ix_nonebot_plugin_nagabus_majsoul_order_lookup",
+            ["paipu_uuid", "kyoku", "honba", "model_type"],
+            unique=False,
+        )
+
+    with op.batch_alter_table("nonebot_plugin_nagabus_order", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_nonebot_plugin_nagabus_order_status_create_time",
+            ["status", "create_time"],
+            unique=False,
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("nonebot_plugin_nagabus_order", schema=None) as batch_op:
+        batch_op.drop_index("ix_nonebot_plugin_nagabus_order_status_create_time")
+
+    with op.batch_alter_table(
+        "nonebot_plugin_nagabus_majsoul_order", schema=None
+    ) as batch_op:
+        batch_op.drop_index("ix_nonebot_plugin_nagabus_majsoul_order_lookup")
+        batch_op.create_index(
+            "ix_nonebot_plugin_nagabus_majsoul_order_paipu_uuid",
+            ["paipu_uuid"],
+            unique=False,
+        )
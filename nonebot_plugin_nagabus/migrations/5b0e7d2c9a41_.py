@@ -0,0 +1,40 @@
+"""store naga report as json
+
+Revision ID: 5b0e7d2c9a41
+Revises: e3a28f10d91b
+Create Date: 2026-10-19 17:05:26.418303
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "5b0e7d2c9a41"
+down_revision = "e3a28f10d91b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 原本存储的即为json字符串，sqlite中JSON同样以文本存储，无需转换数据
+    with op.batch_alter_table("nonebot_plugin_nagabus_order", schema=None) as batch_op:
+        batch_op.alter_column(
+            "naga_report",
+            existing_type=sa.String(),
+            type_=sa.JSON().with_variant(postgresql.JSONB(), "postgresql"),
+            existing_nullable=True,
+            postgresql_using="naga_report::jsonb",
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("nonebot_plugin_nagabus_order", schema=None) as batch_op:
+        batch_op.alter_column(
+            "naga_report",
+            existing_type=sa.JSON().with_variant(postgresql.JSONB(), "postgresql"),
+            type_=sa.String(),
+            existing_nullable=True,
+            postgresql_using="naga_report::text",
+        )
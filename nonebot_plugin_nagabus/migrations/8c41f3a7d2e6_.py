@@ -0,0 +1,34 @@
+"""naga report archive
+
+Revision ID: 8c41f3a7d2e6
+Revises: 5b0e7d2c9a41
+Create Date: 2026-10-19 17:48:03.557214
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+import nonebot_plugin_nagabus
+
+# revision identifiers, used by Alembic.
+revision = "8c41f3a7d2e6"
+down_revision = "5b0e7d2c9a41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    UTCDateTime = nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime
+
+    op.create_table(
+        "nonebot_plugin_nagabus_report_archive",
+        sa.Column("haihu_id", sa.String(), nullable=False),
+        sa.Column("content", sa.LargeBinary(), nullable=False),
+        sa.Column("archive_time", UTCDateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("haihu_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("nonebot_plugin_nagabus_report_archive")
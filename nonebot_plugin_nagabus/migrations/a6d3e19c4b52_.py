@@ -0,0 +1,57 @@
+"""order trace
+
+Revision ID: a6d3e19c4b52
+Revises: f4b9c2e81a07
+Create Date: 2026-10-19 21:06:44.182937
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+import nonebot_plugin_nagabus
+
+# revision identifiers, used by Alembic.
+revision = "a6d3e19c4b52"
+down_revision = "f4b9c2e81a07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    UTCDateTime = nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime
+
+    op.create_table(
+        "nonebot_plugin_nagabus_trace",
+        sa.Column("trace_id", sa.String(), nullable=False),
+        sa.Column(
+            "source",
+            sa.Enum("tenhou", "majsoul", native_enum=False, length=16),
+            nullable=False,
+        ),
+        sa.Column("haihu_id", sa.String(), nullable=True),
+        sa.Column("result", sa.String(), nullable=True),
+        sa.Column("error", sa.String(), nullable=True),
+        sa.Column("begin_time", UTCDateTime(), nullable=False),
+        sa.Column("duration", sa.Float(), nullable=False),
+        sa.Column(
+            "spans",
+            sa.JSON().with_variant(postgresql.JSONB(), "postgresql"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("trace_id"),
+    )
+    with op.batch_alter_table("nonebot_plugin_nagabus_trace", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_nonebot_plugin_nagabus_trace_begin_time"),
+            ["begin_time"],
+            unique=False,
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("nonebot_plugin_nagabus_trace", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_nonebot_plugin_nagabus_trace_begin_time"))
+
+    op.drop_table("nonebot_plugin_nagabus_trace")
@@ -0,0 +1,64 @@
+"""shared majsoul paipu cache
+
+Revision ID: c964f898d0a5
+Revises: 70ff5fb4923e
+Create Date: 2026-10-19 16:02:11.264153
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+import nonebot_plugin_nagabus
+
+# revision identifiers, used by Alembic.
+revision = "c964f898d0a5"
+down_revision = "70ff5fb4923e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 旧表已弃用且从未写入，直接重建
+    op.drop_table("nonebot_plugin_nagabus_majsoul_paipu")
+    op.create_table(
+        "nonebot_plugin_nagabus_majsoul_paipu",
+        sa.Column("paipu_uuid", sa.String(), nullable=False),
+        sa.Column("content", sa.LargeBinary(), nullable=False),
+        sa.Column(
+            "create_time",
+            nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime(),
+            nullable=False,
+        ),
+        sa.Column(
+            "access_time",
+            nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime(),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("paipu_uuid"),
+    )
+    with op.batch_alter_table(
+        "nonebot_plugin_nagabus_majsoul_paipu", schema=None
+    ) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_nonebot_plugin_nagabus_majsoul_paipu_access_time"),
+            ["access_time"],
+            unique=False,
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table(
+        "nonebot_plugin_nagabus_majsoul_paipu", schema=None
+    ) as batch_op:
+        batch_op.drop_index(
+            batch_op.f("ix_nonebot_plugin_nagabus_majsoul_paipu_access_time")
+        )
+
+    op.drop_table("nonebot_plugin_nagabus_majsoul_paipu")
+    op.create_table(
+        "nonebot_plugin_nagabus_majsoul_paipu",
+        sa.Column("paipu_uuid", sa.String(), nullable=False),
+        sa.Column("content", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("paipu_uuid"),
+    )
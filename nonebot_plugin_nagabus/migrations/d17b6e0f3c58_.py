@@ -0,0 +1,34 @@
+"""order claim
+
+Revision ID: d17b6e0f3c58
+Revises: 8c41f3a7d2e6
+Create Date: 2026-10-19 18:20:41.906385
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+import nonebot_plugin_nagabus
+
+# revision identifiers, used by Alembic.
+revision = "d17b6e0f3c58"
+down_revision = "8c41f3a7d2e6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    UTCDateTime = nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime
+
+    op.create_table(
+        "nonebot_plugin_nagabus_order_claim",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("owner", sa.String(), nullable=False),
+        sa.Column("claim_time", UTCDateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("nonebot_plugin_nagabus_order_claim")
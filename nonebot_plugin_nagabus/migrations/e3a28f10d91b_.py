@@ -0,0 +1,91 @@
+"""monthly usage rollup
+
+Revision ID: e3a28f10d91b
+Revises: 31a9e0c3405a
+Create Date: 2026-10-19 16:41:52.093117
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+import nonebot_plugin_nagabus
+
+# revision identifiers, used by Alembic.
+revision = "e3a28f10d91b"
+down_revision = "31a9e0c3405a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    UTCDateTime = nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime
+
+    usage_table = op.create_table(
+        "nonebot_plugin_nagabus_monthly_usage",
+        sa.Column("customer_id", sa.Integer(), nullable=False),
+        sa.Column("month", sa.Integer(), nullable=False),
+        sa.Column(
+            "source",
+            sa.Enum("tenhou", "majsoul", native_enum=False, length=16),
+            nullable=False,
+        ),
+        sa.Column("cost_np", sa.Integer(), nullable=False),
+        sa.Column("order_count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("customer_id", "month", "source"),
+    )
+
+    # 根据已有的订单生成汇总
+    order_table = sa.table(
+        "nonebot_plugin_nagabus_order",
+        sa.column("customer_id", sa.Integer()),
+        sa.column("cost_np", sa.Integer()),
+        sa.column("source", sa.String()),
+        # postgresql中status为原生枚举类型，需要按枚举绑定参数，否则无法与字符串比较
+        sa.column(
+            "status",
+            sa.Enum(
+                "ok",
+                "pending",
+                "analyzing",
+                "failed",
+                "failed2",
+                name="nagaorderstatus",
+            ),
+        ),
+        sa.column("create_time", UTCDateTime()),
+    )
+    rows = op.get_bind().execute(
+        sa.select(
+            order_table.c.customer_id,
+            order_table.c.source,
+            order_table.c.cost_np,
+            order_table.c.create_time,
+        ).where(order_table.c.status == "ok")
+    )
+
+    usage = {}
+    for customer_id, source, cost_np, create_time in rows:
+        create_time = create_time.astimezone(UTCDateTime.LOCAL_TIMEZONE)
+        key = (customer_id, create_time.year * 100 + create_time.month, source)
+        total_cost_np, order_count = usage.get(key, (0, 0))
+        usage[key] = (total_cost_np + cost_np, order_count + 1)
+
+    usage_rows = []
+    for (customer_id, month, source), (cost_np, order_count) in usage.items():
+        usage_rows.append(
+            {
+                "customer_id": customer_id,
+                "month": month,
+                "source": source,
+                "cost_np": cost_np,
+                "order_count": order_count,
+            }
+        )
+
+    if len(usage_rows) > 0:
+        op.bulk_insert(usage_table, usage_rows)
+
+
+def downgrade() -> None:
+    op.drop_table("nonebot_plugin_nagabus_monthly_usage")
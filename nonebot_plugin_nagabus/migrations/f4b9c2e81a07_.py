@@ -0,0 +1,99 @@
+"""daily usage rollup
+
+Revision ID: f4b9c2e81a07
+Revises: d17b6e0f3c58
+Create Date: 2026-10-19 19:12:08.415230
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+import nonebot_plugin_nagabus
+
+# revision identifiers, used by Alembic.
+revision = "f4b9c2e81a07"
+down_revision = "d17b6e0f3c58"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    UTCDateTime = nonebot_plugin_nagabus.data.utils.utc_datetime.UTCDateTime
+
+    usage_table = op.create_table(
+        "nonebot_plugin_nagabus_daily_usage",
+        sa.Column("day", sa.Integer(), nullable=False),
+        sa.Column("customer_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "source",
+            sa.Enum("tenhou", "majsoul", native_enum=False, length=16),
+            nullable=False,
+        ),
+        sa.Column("model_type", sa.String(), nullable=False),
+        sa.Column("cost_np", sa.Integer(), nullable=False),
+        sa.Column("order_count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("day", "customer_id", "source", "model_type"),
+    )
+
+    # 根据已有的订单生成汇总
+    order_table = sa.table(
+        "nonebot_plugin_nagabus_order",
+        sa.column("customer_id", sa.Integer()),
+        sa.column("cost_np", sa.Integer()),
+        sa.column("source", sa.String()),
+        sa.column("model_type", sa.String()),
+        # postgresql中status为原生枚举类型，需要按枚举绑定参数，否则无法与字符串比较
+        sa.column(
+            "status",
+            sa.Enum(
+                "ok",
+                "pending",
+                "analyzing",
+                "failed",
+                "failed2",
+                name="nagaorderstatus",
+            ),
+        ),
+        sa.column("create_time", UTCDateTime()),
+    )
+    rows = op.get_bind().execute(
+        sa.select(
+            order_table.c.customer_id,
+            order_table.c.source,
+            order_table.c.model_type,
+            order_table.c.cost_np,
+            order_table.c.create_time,
+        ).where(order_table.c.status == "ok")
+    )
+
+    usage = {}
+    for customer_id, source, model_type, cost_np, create_time in rows:
+        create_time = create_time.astimezone(UTCDateTime.LOCAL_TIMEZONE)
+        day = create_time.year * 10000 + create_time.month * 100 + create_time.day
+        key = (day, customer_id, source, model_type)
+        total_cost_np, order_count = usage.get(key, (0, 0))
+        usage[key] = (total_cost_np + cost_np, order_count + 1)
+
+    usage_rows = []
+    for (day, customer_id, source, model_type), (
+        cost_np,
+        order_count,
+    ) in usage.items():
+        usage_rows.append(
+            {
+                "day": day,
+                "customer_id": customer_id,
+                "source": source,
+                "model_type": model_type,
+                "cost_np": cost_np,
+                "order_count": order_count,
+            }
+        )
+
+    if len(usage_rows) > 0:
+        op.bulk_insert(usage_table, usage_rows)
+
+
+def downgrade() -> None:
+    op.drop_table("nonebot_plugin_nagabus_daily_usage")
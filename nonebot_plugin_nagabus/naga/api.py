@@ -1,14 +1,18 @@
 import re
-import json
+from time import perf_counter
 from typing import Union, Callable
 from collections.abc import Sequence
 
 from nonebot import logger
 from pydantic import BaseModel
-from httpx import Cookies, AsyncClient
+from httpx import Cookies, AsyncClient, HTTPStatusError
 
+from ..utils import metrics
+from ..utils.trace import span
 from .utils import model_type_to_str
 from .errors import InvalidTokenError
+from ..utils.serialization import dumps, loads
+from ..data.utils.atomic_cache import AtomicCache
 from .model import (
     NagaOrder,
     NagaReport,
@@ -17,6 +21,12 @@ from .model import (
     NagaHanchanModelType,
 )
 
+_request_duration = metrics.histogram(
+    "nagabus_naga_api_request_duration_seconds",
+    "Time spent on naga http requests",
+    ("path", "status"),
+)
+
 
 class OrderReportList(BaseModel):
     report: list[NagaReport]
@@ -39,15 +49,29 @@ class NagaApi:
     def __init__(self, cookies_getter: Callable[[], Cookies]):
         self.cookies_getter = cookies_getter
 
+        # csrfmiddlewaretoken在csrftoken不变时始终有效，无需每次下单前都请求一次
+        self._csrfmiddlewaretoken_cache: AtomicCache[str] = AtomicCache(
+            ttl=60 * 10, retain=True, max_size=4
+        )
+
         async def req_hook(request):
             # 手动设置cookies
             self.cookies.set_cookie_header(request)
+            request.extensions["nagabus_begin"] = perf_counter()
             logger.trace(
                 f"Request: {request.method} {request.url} - Waiting for response"
             )
 
         async def resp_hook(response):
             request = response.request
+            begin = request.extensions.get("nagabus_begin")
+            if begin is not None:
+                _request_duration.observe(
+                    perf_counter() - begin,
+                    path=request.url.path,
+                    status=response.status_code,
+                )
+
             logger.trace(
                 f"Response: {request.method} {request.url} - Status {response.status_code}"
             )
@@ -81,11 +105,11 @@ class NagaApi:
             headers={"Referer": "https://naga.dmv.nico/naga_report/order_report_list/"},
             params={"year": year, "month": month},
         )
-        resp_json = resp.json()
+        resp_json = await loads(resp.content, site="naga_api.order_report_list")
         assert resp_json["status"] == 200
         return OrderReportList.parse_obj(resp_json)
 
-    async def _get_csrfmiddlewaretoken(self) -> str:
+    async def _do_get_csrfmiddlewaretoken(self) -> str:
         resp = await self.client.get("/order_form/")
         mat = re.search(
             r"<input type=\"hidden\" name=\"csrfmiddlewaretoken\" value=\"(.*)\">",
@@ -95,6 +119,27 @@ class NagaApi:
             raise RuntimeError("cannot get csrfmiddlewaretoken")
         return mat.group(1)
 
+    async def _get_csrfmiddlewaretoken(self) -> str:
+        with span("csrf_fetch"):
+            return await self._csrfmiddlewaretoken_cache.get(
+                self.cookies.get("csrftoken"), self._do_get_csrfmiddlewaretoken
+            )
+
+    async def _post_order_form(self, url: str, data: dict):
+        try:
+            with span("order_post"):
+                return await self.client.post(
+                    url,
+                    headers={
+                        "Referer": "https://naga.dmv.nico/naga_report/order_form/"
+                    },
+                    data=data,
+                )
+        except (HTTPStatusError, InvalidTokenError):
+            # csrfmiddlewaretoken可能已失效
+            self._csrfmiddlewaretoken_cache.clear()
+            raise
+
     async def analyze_tenhou(
         self,
         haihu_id: str,
@@ -111,11 +156,7 @@ class NagaApi:
             "csrfmiddlewaretoken": await self._get_csrfmiddlewaretoken(),
         }
 
-        resp = await self.client.post(
-            "/api/url_analyze/",
-            headers={"Referer": "https://naga.dmv.nico/naga_report/order_form/"},
-            data=data,
-        )
+        resp = await self._post_order_form("/api/url_analyze/", data)
 
         if len(resp.content) > 0:
             return AnalyzeTenhou.parse_obj(resp.json())
@@ -132,7 +173,7 @@ class NagaApi:
         ],
     ):
         if not isinstance(data, str):
-            data = json.dumps(data, ensure_ascii=False)
+            data = await dumps(data, site="naga_api.analyze_custom")
 
         res_data = {
             "json_data": data,
@@ -142,11 +183,7 @@ class NagaApi:
             "csrfmiddlewaretoken": await self._get_csrfmiddlewaretoken(),
         }
 
-        await self.client.post(
-            "/api/custom_haihu_analyze/",
-            headers={"Referer": "https://naga.dmv.nico/naga_report/order_form/"},
-            data=res_data,
-        )
+        await self._post_order_form("/api/custom_haihu_analyze/", res_data)
 
     async def get_rest_np(self) -> int:
         resp = await self.client.get("/order_form/")
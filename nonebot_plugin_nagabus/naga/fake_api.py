@@ -1,15 +1,18 @@
 import random
 import asyncio
-from uuid import uuid4
-from typing import Union
-from datetime import datetime
-from asyncio import create_task
+from uuid import UUID
+from time import monotonic
+from datetime import datetime, timedelta
 from collections.abc import Mapping, Sequence
+from typing import Union, Callable, Optional, Protocol, NamedTuple
 
 from nonebot import logger
+from httpx import Request, Response, HTTPStatusError
 
+from nonebot_plugin_nagabus.utils.trace import span
 from nonebot_plugin_nagabus.utils.tz import TZ_TOKYO
 from nonebot_plugin_nagabus.naga.utils import model_type_to_str
+from nonebot_plugin_nagabus.naga.errors import InvalidTokenError
 from nonebot_plugin_nagabus.naga.api import AnalyzeTenhou, OrderReportList
 from nonebot_plugin_nagabus.naga.model import (
     NagaModel,
@@ -23,78 +26,257 @@ from nonebot_plugin_nagabus.naga.model import (
 )
 
 
+class FakeClock(Protocol):
+    def now(self) -> datetime: ...
+
+    async def sleep(self, seconds: float): ...
+
+
+class RealClock:
+    def now(self) -> datetime:
+        return datetime.now(tz=TZ_TOKYO)
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    虚拟时钟，以speed倍速流逝，并可通过advance手动推进。speed为0时时间只会被手动推进
+    """
+
+    def __init__(self, start: Optional[datetime] = None, speed: float = 0):
+        self.start = start if start is not None else datetime.now(tz=TZ_TOKYO)
+        self.speed = speed
+        self._real_start = monotonic()
+        self._offset = 0.0
+        self._advanced = asyncio.Event()
+
+    def elapsed(self) -> float:
+        return (monotonic() - self._real_start) * self.speed + self._offset
+
+    def now(self) -> datetime:
+        return self.start + timedelta(seconds=self.elapsed())
+
+    def advance(self, seconds: float):
+        self._offset += seconds
+        # 唤醒所有等待中的sleep，重新检查是否到期
+        self._advanced.set()
+        self._advanced = asyncio.Event()
+
+    async def sleep(self, seconds: float):
+        deadline = self.elapsed() + seconds
+        while True:
+            remaining = deadline - self.elapsed()
+            if remaining <= 0:
+                return
+
+            timeout = remaining / self.speed if self.speed > 0 else None
+            try:
+                await asyncio.wait_for(self._advanced.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+# 根据随机数生成器返回一个延迟（秒）
+Latency = Callable[[random.Random], float]
+
+
+def fixed(seconds: float) -> Latency:
+    return lambda rnd: seconds
+
+
+def uniform(low: float, high: float) -> Latency:
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float) -> Latency:
+    # 长尾分布，用于模拟高峰期的排队
+    return lambda rnd: median * rnd.lognormvariate(0, sigma)
+
+
+class FakeErrorRates(NamedTuple):
+    server_error: float = 0  # 请求返回5xx
+    invalid_token: float = 0  # 请求返回302（Token失效）
+    failed_order: float = 0  # 订单解析失败，不产生报告
+
+
 class FakeNagaApi:
-    def __init__(self):
+    ENDPOINTS = ("order_report_list", "analyze_tenhou", "analyze_custom", "get_rest_np")
+
+    def __init__(
+        self,
+        *,
+        clock: Optional[FakeClock] = None,
+        latency: Optional[Mapping[str, Latency]] = None,
+        order_delay: Latency = fixed(1),
+        report_delay: Latency = fixed(5),
+        error_rates: FakeErrorRates = FakeErrorRates(),
+        max_entries: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+        :param clock: 用于模拟延迟的时钟，默认使用真实时间
+        :param latency: 各个接口（见ENDPOINTS）的请求延迟
+        :param order_delay: 下单后到订单出现在订单列表中的延迟
+        :param report_delay: 下单后到报告出现在报告列表中的延迟
+        :param error_rates: 各类错误发生的概率
+        :param max_entries: 订单列表与报告列表保留的最大数量，为None时不限制
+        :param seed: 随机数种子
+        """
+        self.clock = clock if clock is not None else RealClock()
+        self.latency = dict(latency) if latency is not None else {}
+        self.order_delay = order_delay
+        self.report_delay = report_delay
+        self.error_rates = error_rates
+        self.max_entries = max_entries
+        self.random = random.Random(seed)
+
+        # 均按时间倒序排列
         self.report = []
         self.order = []
+        # haihu_id -> seed_history生成的订单的时间，不在其中的视为当前时间产生的
+        self._entry_time: dict[str, datetime] = {}
         self.rest_np = 1500
 
+        self._background_tasks: set[asyncio.Task] = set()
+
     async def start(self): ...
 
-    async def close(self): ...
+    async def close(self):
+        tasks = list(self._background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     async def set_cookies(self, cookies: Mapping[str, str]):
         logger.info(
             f"naga_cookies set to {'; '.join(f'{kv[0]}={kv[1]}' for kv in cookies)}"
         )
 
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _request(self, endpoint: str):
+        """
+        模拟请求的延迟与错误
+        """
+        latency = self.latency.get(endpoint)
+        if latency is not None:
+            await self.clock.sleep(latency(self.random))
+
+        if self.random.random() < self.error_rates.server_error:
+            request = Request("GET", f"https://naga.dmv.nico/naga_report/{endpoint}")
+            response = Response(503, request=request)
+            raise HTTPStatusError(
+                "Service Unavailable", request=request, response=response
+            )
+
+        if self.random.random() < self.error_rates.invalid_token:
+            raise InvalidTokenError()
+
+    def _random_id(self) -> str:
+        return str(UUID(int=self.random.getrandbits(128), version=4))
+
+    def _insert(self, entries: list, entry: Union[NagaOrder, NagaReport]):
+        entries.insert(0, entry)
+        if self.max_entries is not None:
+            del entries[self.max_entries :]
+
+    def _in_month(self, entry: Union[NagaOrder, NagaReport], year: int, month: int):
+        t = self._entry_time.get(entry.haihu_id)
+        if t is None:
+            return True
+        return t.year == year and t.month == month
+
     async def order_report_list(self, year: int, month: int) -> OrderReportList:
-        return OrderReportList(report=self.report, order=self.order)
+        await self._request("order_report_list")
+        # 与NAGA一致，只返回该月的订单与报告
+        return OrderReportList(
+            report=[r for r in self.report if self._in_month(r, year, month)],
+            order=[o for o in self.order if self._in_month(o, year, month)],
+        )
 
     @logger.catch
     async def _produce_order(self, order: NagaOrder):
-        await asyncio.sleep(1)
+        await self.clock.sleep(self.order_delay(self.random))
 
-        self.order.insert(0, order)
+        self._insert(self.order, order)
         logger.debug(f"Insert order (haihu_id: {order.haihu_id})")
 
     @logger.catch
     async def _produce_report(self, report: NagaReport):
-        await asyncio.sleep(5)
+        await self.clock.sleep(self.report_delay(self.random))
 
-        self.report.insert(0, report)
+        self._insert(self.report, report)
         logger.debug(
             f"Insert report (haihu_id: {report.haihu_id}, report_id: {report.report_id})"
         )
 
-    async def analyze_custom(
+    def _place_order(
         self,
-        data: Union[dict, str],
+        haihu_id: str,
         seat: int,
         rule: NagaGameRule,
         model_type: Union[
             Sequence[NagaHanchanModelType], Sequence[NagaTonpuuModelType]
         ],
     ):
-        time = (
-            datetime.now(tz=TZ_TOKYO).replace(tzinfo=None).isoformat(timespec="seconds")
+        model = NagaModel(
+            major=2, minor=2, old_type=0, type=model_type_to_str(model_type)
         )
-        feat = "".join(str(random.randint(1, 9)) for _ in range(16))
-        haihu_id = f"custom_haihu_{time}_{feat}"
+
+        if self.random.random() < self.error_rates.failed_order:
+            order = NagaOrder(
+                haihu_id=haihu_id,
+                status=NagaOrderStatus.failed,
+                model=model,
+                rule=rule,
+            )
+            self._create_task(self._produce_order(order))
+            return
+
         order = NagaOrder(
             haihu_id=haihu_id,
             status=NagaOrderStatus.ok,
-            model=NagaModel(
-                major=2, minor=2, old_type=0, type=model_type_to_str(model_type)
-            ),
+            model=model,
             rule=rule,
         )
-        create_task(self._produce_order(order))
+        self._create_task(self._produce_order(order))
 
-        self.rest_np -= 10
-
-        report_id = str(uuid4())
         report = NagaReport(
             haihu_id=haihu_id,
             players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
-            report_id=report_id,
-            seat=0,
-            model=NagaModel(
-                major=2, minor=2, old_type=0, type=model_type_to_str(model_type)
-            ),
+            report_id=self._random_id(),
+            seat=seat,
+            model=model,
             rule=rule,
         )
-        create_task(self._produce_report(report))
+        self._create_task(self._produce_report(report))
+
+    async def analyze_custom(
+        self,
+        data: Union[dict, str],
+        seat: int,
+        rule: NagaGameRule,
+        model_type: Union[
+            Sequence[NagaHanchanModelType], Sequence[NagaTonpuuModelType]
+        ],
+    ):
+        with span("order_post"):
+            await self._request("analyze_custom")
+
+        # NagaService按真实时间匹配自定义牌谱的订单，因此这里不使用虚拟时钟
+        time = (
+            datetime.now(tz=TZ_TOKYO).replace(tzinfo=None).isoformat(timespec="seconds")
+        )
+        feat = "".join(str(self.random.randint(1, 9)) for _ in range(16))
+        haihu_id = f"custom_haihu_{time}_{feat}"
+
+        self._place_order(haihu_id, 0, rule, model_type)
+        self.rest_np -= 10
 
     async def analyze_tenhou(
         self,
@@ -104,36 +286,55 @@ class FakeNagaApi:
             Sequence[NagaHanchanModelType], Sequence[NagaTonpuuModelType]
         ],
     ) -> AnalyzeTenhou:
+        with span("order_post"):
+            await self._request("analyze_tenhou")
+
         for o in self.order:
             if o.haihu_id == haihu_id:
                 return AnalyzeTenhou(status=400, msg="すでに解析済みの牌譜です")
 
-        order = NagaOrder(
-            haihu_id=haihu_id,
-            status=NagaOrderStatus.ok,
-            model=NagaModel(
-                major=2, minor=2, old_type=0, type=model_type_to_str(model_type)
-            ),
-            rule=NagaGameRule.hanchan,
-        )
-        create_task(self._produce_order(order))
-
+        self._place_order(haihu_id, seat, NagaGameRule.hanchan, model_type)
         self.rest_np -= 50
 
-        report_id = str(uuid4())
-        report = NagaReport(
-            haihu_id=haihu_id,
-            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
-            report_id=report_id,
-            seat=seat,
-            model=NagaModel(
-                major=2, minor=2, old_type=0, type=model_type_to_str(model_type)
-            ),
-            rule=NagaGameRule.hanchan,
-        )
-        create_task(self._produce_report(report))
-
         return AnalyzeTenhou(status=200, msg="")
 
     async def get_rest_np(self) -> int:
+        await self._request("get_rest_np")
         return self.rest_np
+
+    def seed_history(self, count: int, days: int = 60):
+        """
+        生成count个分布在过去days天内的已完成订单与报告，用于模拟长期使用后的订单列表
+        """
+        now = self.clock.now()
+        entries = []
+        for _ in range(count):
+            t = now - timedelta(seconds=self.random.uniform(0, days * 24 * 60 * 60))
+            feat = "".join(self.random.choice("0123456789abcdef") for _ in range(8))
+            haihu_id = f"{t:%Y%m%d%H}gm-0029-0000-{feat}"
+            entries.append((t, haihu_id))
+        entries.sort()
+
+        model = NagaModel(major=2, minor=2, old_type=0, type="2,4")
+        for t, haihu_id in entries:
+            self._entry_time[haihu_id] = t
+            self._insert(
+                self.order,
+                NagaOrder(
+                    haihu_id=haihu_id,
+                    status=NagaOrderStatus.ok,
+                    model=model,
+                    rule=NagaGameRule.hanchan,
+                ),
+            )
+            self._insert(
+                self.report,
+                NagaReport(
+                    haihu_id=haihu_id,
+                    players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+                    report_id=self._random_id(),
+                    seat=0,
+                    model=model,
+                    rule=NagaGameRule.hanchan,
+                ),
+            )
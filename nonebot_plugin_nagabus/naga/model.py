@@ -1,5 +1,6 @@
 from enum import IntEnum
-from typing import NamedTuple
+from datetime import date
+from typing import Optional, NamedTuple
 
 
 class NagaGameRule(IntEnum):
@@ -63,6 +64,53 @@ class NagaServiceOrder(NamedTuple):
     cost_np: int
 
 
+class NagaAnalyzeStage(IntEnum):
+    paipu_downloaded = 0
+    order_placed = 1
+    status_changed = 2
+    report_ready = 3
+
+
+class NagaAnalyzeProgress(NamedTuple):
+    stage: NagaAnalyzeStage
+    haihu_id: Optional[str] = None
+    status: Optional[NagaOrderStatus] = None  # 仅status_changed时有值
+
+
 class NagaServiceUserStatistic(NamedTuple):
     customer_id: int
     cost_np: int
+
+
+class NagaRestNp(NamedTuple):
+    value: int
+    approximate: bool  # 本地记账且超过一段时间未与NAGA校正
+
+
+class NagaUsage(NamedTuple):
+    cost_np: int
+    order_count: int
+
+
+class NagaServiceDailyUsage(NamedTuple):
+    day: date
+    cost_np: int
+    order_count: int
+
+
+class NagaServiceUsageAnalytics(NamedTuple):
+    begin: date
+    end: date
+    total: NagaUsage
+    by_source: dict[str, NagaUsage]  # key为NagaOrderSource的name
+    by_model_type: dict[str, NagaUsage]  # key为model_type，如"2,4"
+    by_customer: dict[int, NagaUsage]
+    daily: list[NagaServiceDailyUsage]  # 包含[begin, end]内的每一天
+
+
+class NagaPhaseLatency(NamedTuple):
+    count: int
+    p50: float
+    p90: float
+    p99: float
+    max: float
@@ -1,10 +1,15 @@
 import re
+import math
 import asyncio
+from uuid import uuid4
 from asyncio import Lock
-from typing import Union
-from datetime import datetime
+from time import monotonic
+from functools import wraps
 from inspect import isawaitable
-from collections.abc import Mapping, Sequence
+from typing import Union, Callable, Optional
+from contextlib import nullcontext, asynccontextmanager
+from datetime import date, time, datetime, timezone, timedelta
+from collections.abc import Mapping, Sequence, Awaitable, AsyncIterator
 
 from httpx import Cookies
 from nonebot import logger
@@ -16,13 +21,22 @@ from tensoul.downloader import MajsoulDownloadError
 from nonebot_plugin_session_orm import get_session_persist_id
 
 from ..config import conf
+from ..utils import metrics
 from ..utils.tz import TZ_TOKYO
 from .fake_api import FakeNagaApi
 from .utils import model_type_to_str
-from ..data.naga import NagaRepository
-from ..data.mjs import get_majsoul_paipu
+from ..utils.profiler import profiler
 from .api import NagaApi, OrderReportList
+from ..data.export import OrderExportResult, export_orders
+from ..utils.trace import span, start_trace, set_attribute
 from ..data.naga_cookies import get_naga_cookies, set_naga_cookies
+from ..data.naga import NagaOrderOrm, NagaRepository, NagaOrderSource
+from ..data.trace import get_traces, flush_traces, record_trace, sweep_traces
+from ..data.mjs import (
+    get_majsoul_kyoku_log,
+    get_majsoul_paipu_index,
+    sweep_shared_majsoul_paipu,
+)
 from .errors import (
     OrderError,
     InvalidGameError,
@@ -31,22 +45,108 @@ from .errors import (
 )
 from .model import (
     NagaOrder,
+    NagaUsage,
     NagaReport,
+    NagaRestNp,
     NagaGameRule,
     NagaOrderStatus,
+    NagaAnalyzeStage,
+    NagaPhaseLatency,
     NagaServiceOrder,
+    NagaAnalyzeProgress,
     NagaTonpuuModelType,
     NagaHanchanModelType,
+    NagaServiceDailyUsage,
     NagaServiceUserStatistic,
+    NagaServiceUsageAnalytics,
 )
 
 DURATION = 2
 
+_order_report_waiters = metrics.gauge(
+    "nagabus_order_report_waiters", "Callers waiting for the naga order report list"
+)
+_order_report_poll_duration = metrics.histogram(
+    "nagabus_order_report_poll_duration_seconds",
+    "Time spent fetching the naga order report list",
+)
+_orders = metrics.counter(
+    "nagabus_orders_total",
+    "Analyze requests by order source and how they were fulfilled",
+    ("source", "result"),
+)
+_np_spent = metrics.counter(
+    "nagabus_np_spent_total", "NP spent on new naga orders", ("source",)
+)
+_rest_np = metrics.gauge("nagabus_rest_np", "Locally accounted rest NP")
+
+TRACE_PHASES = (
+    "db_lookup",
+    "lock_wait",
+    "paipu_download",
+    "order_post",
+    "csrf_fetch",
+    "order_correlation",
+    "report_wait",
+    "db_update",
+)
+
+
+def _traced(source: NagaOrderSource):
+    """
+    记录解析请求的各阶段耗时
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with start_trace() as trace:
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException as e:
+                    set_attribute("error", type(e).__name__)
+                    raise
+                finally:
+                    record_trace(trace, source)
+
+        return wrapper
+
+    return decorator
+
+
+@asynccontextmanager
+async def _traced_lock(lock: Lock) -> AsyncIterator[None]:
+    with span("lock_wait"):
+        await lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+T_ProgressCallback = Callable[[NagaAnalyzeProgress], Union[None, Awaitable[None]]]
+
+
+async def _notify_progress(
+    progress: Optional[T_ProgressCallback], event: NagaAnalyzeProgress
+):
+    if progress is None:
+        return
+
+    # 进度通知失败不影响解析
+    try:
+        x = progress(event)
+        if isawaitable(x):
+            await x
+    except Exception as e:
+        logger.opt(exception=e).warning("Failed to notify analyze progress")
+
 
 class ObservableOrderReport:
     def __init__(self, api: NagaApi):
         self.api = api
         self.value = None
+        self.update_time = None
         self._observers = []
         self._refresh_worker = None
 
@@ -55,15 +155,19 @@ class ObservableOrderReport:
         current = datetime.now(tz=TZ_TOKYO)
         prev_month = current - monthdelta(months=1)
 
-        list_this_month = await self.api.order_report_list(current.year, current.month)
-        list_prev_month = await self.api.order_report_list(
-            prev_month.year, prev_month.month
-        )
+        with _order_report_poll_duration.time():
+            list_this_month = await self.api.order_report_list(
+                current.year, current.month
+            )
+            list_prev_month = await self.api.order_report_list(
+                prev_month.year, prev_month.month
+            )
 
         self.value = OrderReportList(
             report=[*list_this_month.report, *list_prev_month.report],
             order=[*list_this_month.order, *list_prev_month.order],
         )
+        self.update_time = monotonic()
 
     async def _refresh(self):
         while True:
@@ -71,25 +175,44 @@ class ObservableOrderReport:
                 if len(self._observers) != 0:
                     logger.trace("refreshing naga orders and reports...")
 
-                    await self._refresh_once()
+                    async with profiler.profile("order_report_refresh"):
+                        await self._refresh_once()
 
-                    observers = self._observers
-                    self._observers = []
+                        observers = self._observers
+                        self._observers = []
+                        _order_report_waiters.set(0)
 
-                    for ob in observers:
-                        x = ob(self.value)
-                        if isawaitable(x):
-                            await x
+                        for ob in observers:
+                            x = ob(self.value)
+                            if isawaitable(x):
+                                await x
             except BaseException as e:
                 logger.exception(e)
 
             await asyncio.sleep(DURATION)
 
+    async def get_latest(self, max_age: float) -> Optional[OrderReportList]:
+        """
+        获取不早于max_age秒前的订单与报告列表，刷新失败时返回None
+        """
+        if self.update_time is None or monotonic() - self.update_time > max_age:
+            await self._refresh_once()
+        if self.update_time is None or monotonic() - self.update_time > max_age:
+            return None
+        return self.value
+
     def observe_once(self, callback):
         self._observers.append(callback)
+        _order_report_waiters.set(len(self._observers))
         if self._refresh_worker is None:
             self._refresh_worker = asyncio.create_task(self._refresh())
 
+    async def close(self):
+        if self._refresh_worker is not None:
+            self._refresh_worker.cancel()
+            await asyncio.gather(self._refresh_worker, return_exceptions=True)
+            self._refresh_worker = None
+
 
 class NagaService:
     _tenhou_haihu_id_reg = re.compile(
@@ -107,18 +230,154 @@ class NagaService:
 
         self._majsoul_order_mutex = Lock()
         self._tenhou_order_mutex = Lock()
+        # 用于跨进程防止重复下单
+        self._node_id = uuid4().hex
+        self._claim_heartbeats: dict[str, asyncio.Task] = {}
+
+        # 本地记账的剩余NP
+        self._rest_np: Optional[int] = None
+        self._rest_np_update_time: float = 0
+        self._rest_np_refresh_worker: Optional[asyncio.Task] = None
 
         self._last_custom_haihu_id = None
 
         self._order_report = ObservableOrderReport(self.api)
 
+        self._background_tasks: list[asyncio.Task] = []
+
     async def start(self):
         cookies_obj = await get_naga_cookies()
         self.cookies = Cookies(cookies_obj)
 
+        # 指标是进程级的，只暴露已启动的服务（即Bot使用的服务）的剩余NP
+        _rest_np.set_function(lambda: self._rest_np)
+
+        if conf().naga_profiler:
+            profiler.enable()
+
+        self._background_tasks.append(asyncio.create_task(self._sweep_periodically()))
+        self._background_tasks.append(asyncio.create_task(self._reconcile_orders()))
+        self._background_tasks.append(
+            asyncio.create_task(self._reap_stale_orders_periodically())
+        )
+
     async def close(self):
+        tasks = [*self._background_tasks, *self._claim_heartbeats.values()]
+        if self._rest_np_refresh_worker is not None:
+            tasks.append(self._rest_np_refresh_worker)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._background_tasks.clear()
+        self._claim_heartbeats.clear()
+        self._rest_np_refresh_worker = None
+
+        await self._order_report.close()
+        profiler.disable()
+
+        await NagaRepository.close_local_orders()
+        await flush_traces()
         await self.api.close()
 
+    async def _sweep_periodically(self):
+        while True:
+            if conf().naga_paipu_shared_cache:
+                try:
+                    await sweep_shared_majsoul_paipu()
+                except Exception as e:
+                    logger.exception(e)
+
+            try:
+                await sweep_traces()
+            except Exception as e:
+                logger.exception(e)
+
+            await asyncio.sleep(60 * 60)
+
+    @logger.catch
+    async def _reconcile_orders(self):
+        await self.reconcile_orders()
+
+    async def reconcile_orders(self):
+        """
+        将所有未完成的订单与NAGA的报告列表比对，批量更新已有报告的订单。
+        用于启动时处理重启前仍在等待报告的订单
+        """
+        async with self._unit_of_work() as repo:
+            haihu_ids = await repo.get_incomplete_order_ids()
+        if len(haihu_ids) == 0:
+            return
+
+        order_report = await self._order_report.get_latest(DURATION)
+        if order_report is None:
+            logger.warning(
+                "Failed to fetch naga orders and reports, skip reconciling orders"
+            )
+            return
+
+        reports = {r.haihu_id: r for r in order_report.report}
+        completed = [reports[h] for h in haihu_ids if h in reports]
+        if len(completed) == 0:
+            return
+
+        async with self._unit_of_work() as repo:
+            await repo.reap_local_orders(completed, [], [])
+
+        logger.opt(colors=True).info(
+            f"Reconciled <y>{len(completed)}</y> orders completed during downtime"
+        )
+
+    async def _reap_stale_orders_periodically(self):
+        while True:
+            await asyncio.sleep(conf().naga_order_reaper_interval)
+
+            try:
+                await self.reap_stale_orders()
+            except Exception as e:
+                logger.exception(e)
+
+    async def reap_stale_orders(self):
+        """
+        根据NAGA的订单与报告列表处理超时仍未分析完成的订单：
+        已有报告的标记为已完成，NAGA侧失败的标记为失败，NAGA侧不存在的删除
+        """
+        async with self._unit_of_work() as repo:
+            stale_orders = await repo.get_stale_orders()
+        if len(stale_orders) == 0:
+            return
+
+        order_report = await self._order_report.get_latest(DURATION)
+        if order_report is None:
+            logger.warning("Failed to fetch naga orders and reports, skip reaping")
+            return
+
+        reports = {r.haihu_id: r for r in order_report.report}
+        orders = {o.haihu_id: o for o in order_report.order}
+
+        completed = []
+        failed = []
+        lost = []
+        for order_orm in stale_orders:
+            if order_orm.haihu_id in reports:
+                completed.append(reports[order_orm.haihu_id])
+            elif order_orm.haihu_id in orders:
+                if orders[order_orm.haihu_id].status in (
+                    NagaOrderStatus.failed,
+                    NagaOrderStatus.failed2,
+                ):
+                    failed.append(order_orm.haihu_id)
+                # 否则NAGA仍在分析，保留订单
+            else:
+                lost.append(order_orm.haihu_id)
+
+        async with self._unit_of_work() as repo:
+            await repo.reap_local_orders(completed, failed, lost)
+
+        logger.opt(colors=True).info(
+            f"Reaped stale orders: <y>{len(completed)}</y> completed, "
+            f"<y>{len(failed)}</y> failed, <y>{len(lost)}</y> lost"
+        )
+
     async def set_cookies(self, cookies: Mapping[str, str]):
         await set_naga_cookies(cookies)
         self.cookies = Cookies(dict(cookies))
@@ -126,13 +385,39 @@ class NagaService:
             f"naga_cookies set to {'; '.join(f'{kv[0]}={kv[1]}' for kv in cookies.items())}"
         )
 
-    async def _get_report(self, haihu_id: str) -> NagaReport:
+    async def _get_report(
+        self, haihu_id: str, progress: Optional[T_ProgressCallback] = None
+    ) -> NagaReport:
         report = asyncio.get_running_loop().create_future()
         cancel_flag = False
+        status = None
+        # 不在刷新订单列表的回调中等待进度通知，避免阻塞其他订单
+        notify_tasks = []
 
         def _make_callback():
             async def callback(order_report: OrderReportList):
+                nonlocal status
+
                 try:
+                    for order in order_report.order:
+                        if progress is None:
+                            break
+                        if order.haihu_id == haihu_id and order.status != status:
+                            status = order.status
+                            notify_tasks.append(
+                                asyncio.create_task(
+                                    _notify_progress(
+                                        progress,
+                                        NagaAnalyzeProgress(
+                                            NagaAnalyzeStage.status_changed,
+                                            haihu_id,
+                                            status,
+                                        ),
+                                    )
+                                )
+                            )
+                            break
+
                     for r in order_report.report:
                         if r.haihu_id == haihu_id:
                             report.set_result(r)
@@ -150,11 +435,24 @@ class NagaService:
         try:
             timeout = conf().naga_timeout
             if timeout > 0:
-                return await asyncio.wait_for(report, timeout)
+                result = await asyncio.wait_for(report, timeout)
             else:
-                return await report
+                result = await report
+            await asyncio.gather(*notify_tasks)
+            return result
         finally:
             cancel_flag = True
+            for t in notify_tasks:
+                t.cancel()
+
+    @staticmethod
+    async def _get_local_report(haihu_id: str, model_type: str) -> NagaReport:
+        with span("db_lookup"):
+            report = await NagaRepository.get_report(haihu_id, model_type)
+        if report is None:
+            # 订单已完成但本地和归档中都找不到报告（如订单恰好被清理）
+            raise OrderError(f"report of order {haihu_id} not found")
+        return report
 
     async def _order_custom(
         self,
@@ -207,7 +505,8 @@ class NagaService:
 
         self._order_report.observe_once(_make_callback())
 
-        return await order_fut
+        with span("order_correlation"):
+            return await order_fut
 
     @staticmethod
     def _handle_model_type(
@@ -234,6 +533,91 @@ class NagaService:
 
         return model_type
 
+    @staticmethod
+    @asynccontextmanager
+    async def _unit_of_work(
+        phase: Optional[str] = None,
+    ) -> AsyncIterator[NagaRepository]:
+        """
+        :param phase: 记录耗时的阶段名
+        """
+        # 每次数据库操作使用独立的短会话，避免等待网络请求时占用数据库连接
+        with span(phase) if phase is not None else nullcontext():
+            async with AsyncSession(get_engine()) as sess:
+                yield NagaRepository(sess)
+
+    @staticmethod
+    def _order_claim_enabled() -> bool:
+        if conf().naga_order_claim is not None:
+            return conf().naga_order_claim
+        # sqlite不支持多个进程共享，只使用进程内的锁
+        return conf().datastore_database_dialect == "postgresql"
+
+    async def _claim_order(
+        self,
+        claim_key: str,
+        lookup: Callable[[NagaRepository], Awaitable[Optional[NagaOrderOrm]]],
+    ) -> tuple[bool, Optional[NagaOrderOrm]]:
+        """
+        跨进程防止重复下单，返回(是否获得下单权, 其他进程已创建的订单)。
+        获得下单权后需调用_release_order_claim
+        """
+        if not self._order_claim_enabled():
+            return True, None
+
+        async with self._unit_of_work() as repo:
+            if await repo.claim_order(
+                claim_key, self._node_id, conf().naga_order_claim_timeout
+            ):
+                # 获得下单权前，其他进程可能已经完成下单并释放
+                local_order = await lookup(repo)
+                if local_order is not None:
+                    await repo.release_order_claim(claim_key, self._node_id)
+                    return False, local_order
+
+                self._claim_heartbeats[claim_key] = asyncio.create_task(
+                    self._heartbeat_order_claim(claim_key)
+                )
+                return True, None
+
+        logger.opt(colors=True).debug(
+            f"Order <y>{claim_key}</y> is claimed by another node, waiting..."
+        )
+        return False, None
+
+    async def _heartbeat_order_claim(self, claim_key: str):
+        # 下单期间定期续期，避免下单耗时超过naga_order_claim_timeout时被其他进程接管并重复下单
+        while True:
+            await asyncio.sleep(conf().naga_order_claim_timeout / 3)
+            try:
+                async with self._unit_of_work() as repo:
+                    await repo.refresh_order_claim(claim_key, self._node_id)
+            except Exception as e:
+                logger.exception(e)
+
+    async def _wait_claimed_order(
+        self,
+        lookup: Callable[[NagaRepository], Awaitable[Optional[NagaOrderOrm]]],
+    ) -> Optional[NagaOrderOrm]:
+        """
+        等待获得下单权的进程创建订单，调用时不应持有下单锁，避免阻塞本进程的其他订单
+        """
+        await asyncio.sleep(DURATION)
+        async with self._unit_of_work("db_lookup") as repo:
+            return await lookup(repo)
+
+    async def _release_order_claim(self, claim_key: str):
+        if not self._order_claim_enabled():
+            return
+
+        heartbeat = self._claim_heartbeats.pop(claim_key, None)
+        if heartbeat is not None:
+            heartbeat.cancel()
+
+        async with self._unit_of_work() as repo:
+            await repo.release_order_claim(claim_key, self._node_id)
+
+    @_traced(NagaOrderSource.majsoul)
     async def analyze_majsoul(
         self,
         majsoul_uuid: str,
@@ -244,134 +628,157 @@ class NagaService:
         model_type: Union[
             None, Sequence[NagaHanchanModelType], Sequence[NagaTonpuuModelType]
         ] = None,
+        progress: Optional[T_ProgressCallback] = None,
     ) -> NagaServiceOrder:
-        async with AsyncSession(get_engine()) as sess:
-            repo = NagaRepository(sess)
-            try:
-                data = await get_majsoul_paipu(majsoul_uuid)
-            except MajsoulDownloadError as e:
-                logger.opt(colors=True).warning(
-                    f"Failed to download paipu <y>{majsoul_uuid}</y>, code: {e.code}"
-                )
-                if e.code == 1203:
-                    raise InvalidGameError(
-                        f"invalid majsoul_uuid: {majsoul_uuid}"
-                    ) from e
-                else:
-                    raise e
-
-            if len(data["name"]) != 4:
-                raise UnsupportedGameError("only yonma game is supported")
-
-            if "東" in data["rule"]["disp"]:
-                rule = NagaGameRule.tonpuu
+        try:
+            with span("paipu_download"):
+                paipu_index = await get_majsoul_paipu_index(majsoul_uuid)
+        except MajsoulDownloadError as e:
+            logger.opt(colors=True).warning(
+                f"Failed to download paipu <y>{majsoul_uuid}</y>, code: {e.code}"
+            )
+            if e.code == 1203:
+                raise InvalidGameError(f"invalid majsoul_uuid: {majsoul_uuid}") from e
             else:
-                rule = NagaGameRule.hanchan
-
-            log = None
-            for i, log in enumerate(data["log"]):
-                if log[0][0] == kyoku:
-                    if honba == -1:
-                        # 未指定本场
-                        if (i == 0 or data["log"][i - 1][0][0] != kyoku) and (
-                            i == len(data["log"]) - 1
-                            or data["log"][i + 1][0][0] != kyoku
-                        ):
-                            # 该场次只存在一个本场
-                            honba = log[0][1]
-                            log = log
-                        break
-                    elif log[0][1] == honba:
-                        log = log
-                        break
-
-            if log is None:
-                available_kyoku_honba = [(log[0][0], log[0][1]) for log in data["log"]]
-                raise InvalidKyokuHonbaError(available_kyoku_honba)
-
-            model_type = self._handle_model_type(rule, model_type)
-            model_type_str = model_type_to_str(model_type)
-
-            haihu_id = ""
-            new_order = False
-
-            # 加锁防止重复下单
-            local_order = await repo.get_local_majsoul_order(
+                raise e
+
+        await _notify_progress(
+            progress, NagaAnalyzeProgress(NagaAnalyzeStage.paipu_downloaded)
+        )
+
+        if len(paipu_index.name) != 4:
+            raise UnsupportedGameError("only yonma game is supported")
+
+        rule = paipu_index.game_rule
+
+        kyoku_index = paipu_index.find_kyoku(kyoku, honba)
+        if kyoku_index is None:
+            raise InvalidKyokuHonbaError(paipu_index.available_kyoku_honba)
+        honba = kyoku_index.honba
+
+        model_type = self._handle_model_type(rule, model_type)
+        model_type_str = model_type_to_str(model_type)
+
+        haihu_id = ""
+        new_order = False
+
+        def lookup(repo: NagaRepository):
+            return repo.get_local_majsoul_order(
                 majsoul_uuid, kyoku, honba, model_type_str
             )
-            if local_order is None:
-                async with self._majsoul_order_mutex:
-                    local_order = await repo.get_local_majsoul_order(
-                        majsoul_uuid, kyoku, honba, model_type_str
-                    )
-                    if local_order is None:
+
+        claim_key = f"majsoul:{majsoul_uuid}:{kyoku}:{honba}:{model_type_str}"
+
+        # 加锁防止重复下单
+        async with self._unit_of_work("db_lookup") as repo:
+            local_order = await lookup(repo)
+        while local_order is None:
+            async with _traced_lock(self._majsoul_order_mutex):
+                async with self._unit_of_work("db_lookup") as repo:
+                    local_order = await lookup(repo)
+                if local_order is not None:
+                    break
+
+                claimed, local_order = await self._claim_order(claim_key, lookup)
+                if claimed:
+                    try:
                         # 不存在记录，安排解析
                         logger.opt(colors=True).info(
                             f"Ordering majsoul paipu <y>{majsoul_uuid} "
                             f"(kyoku: {kyoku}, honba: {honba})</y> analyze..."
                         )
 
-                        # data["log"] = log
-                        data = {
-                            "title": data["title"],
-                            "name": data["name"],
-                            "rule": data["rule"],
-                            "log": [log],
-                        }
+                        with span("paipu_download"):
+                            log = await get_majsoul_kyoku_log(majsoul_uuid, kyoku_index)
+                        data = {**paipu_index.header(), "log": [log]}
 
                         order = await self._order_custom([data], rule, model_type)
                         haihu_id = order.haihu_id
 
                         new_order = True
+                        _orders.inc(source="majsoul", result="new")
+                        set_attribute("result", "new")
 
                         session_persist_id = await get_session_persist_id(session)
-                        await repo.new_local_majsoul_order(
-                            haihu_id,
-                            session_persist_id,
-                            majsoul_uuid,
-                            kyoku,
-                            honba,
-                            model_type_str,
-                        )
+                        async with self._unit_of_work("db_update") as repo:
+                            cost_np = await repo.new_local_majsoul_order(
+                                haihu_id,
+                                session_persist_id,
+                                majsoul_uuid,
+                                kyoku,
+                                honba,
+                                model_type_str,
+                            )
+                        self._spend_np(cost_np, NagaOrderSource.majsoul)
+                    finally:
+                        await self._release_order_claim(claim_key)
+                    break
 
-            if local_order is not None:
-                # 存在记录
-                if local_order.status == NagaOrderStatus.ok:
-                    logger.opt(colors=True).info(
-                        f"Found a existing majsoul paipu <y>{majsoul_uuid} "
-                        f"(kyoku: {kyoku}, honba: {honba})</y> "
-                        f"analyze report: {local_order.haihu_id}"
-                    )
-                    report = repo.parse_report(local_order.naga_report)
-                    return NagaServiceOrder(report=report, cost_np=0)
-
-                haihu_id = local_order.haihu_id
+            if local_order is None:
+                # 其他进程正在下单，释放锁后再等待
+                local_order = await self._wait_claimed_order(lookup)
+
+        if local_order is not None:
+            # 存在记录
+            if local_order.status == NagaOrderStatus.ok:
+                _orders.inc(source="majsoul", result="cached")
+                set_attribute("result", "cached")
                 logger.opt(colors=True).info(
-                    f"Found a processing majsoul paipu <y>{majsoul_uuid} "
+                    f"Found a existing majsoul paipu <y>{majsoul_uuid} "
                     f"(kyoku: {kyoku}, honba: {honba})</y> "
-                    f"analyze order: {haihu_id}"
+                    f"analyze report: {local_order.haihu_id}"
                 )
+                set_attribute("haihu_id", local_order.haihu_id)
+                report = await self._get_local_report(
+                    local_order.haihu_id, local_order.model_type
+                )
+                await _notify_progress(
+                    progress,
+                    NagaAnalyzeProgress(
+                        NagaAnalyzeStage.report_ready, local_order.haihu_id
+                    ),
+                )
+                return NagaServiceOrder(report=report, cost_np=0)
 
-            assert haihu_id != ""
-
+            _orders.inc(source="majsoul", result="joined")
+            set_attribute("result", "joined")
+            haihu_id = local_order.haihu_id
             logger.opt(colors=True).info(
-                f"Waiting for majsoul paipu <y>{majsoul_uuid} "
+                f"Found a processing majsoul paipu <y>{majsoul_uuid} "
                 f"(kyoku: {kyoku}, honba: {honba})</y> "
-                f"analyze report: {haihu_id} ..."
+                f"analyze order: {haihu_id}"
             )
-            report = await self._get_report(haihu_id)
 
-            if new_order:
-                # 需要更新之前创建的NagaOrderOrm
-                logger.opt(colors=True).debug(
-                    f"Updating majsoul paipu <y>{majsoul_uuid} "
-                    f"(kyoku: {kyoku}, honba: {honba})</y> "
-                    f"analyze report: {haihu_id}..."
-                )
+        assert haihu_id != ""
+
+        await _notify_progress(
+            progress, NagaAnalyzeProgress(NagaAnalyzeStage.order_placed, haihu_id)
+        )
+
+        logger.opt(colors=True).info(
+            f"Waiting for majsoul paipu <y>{majsoul_uuid} "
+            f"(kyoku: {kyoku}, honba: {honba})</y> "
+            f"analyze report: {haihu_id} ..."
+        )
+        set_attribute("haihu_id", haihu_id)
+        with span("report_wait"):
+            report = await self._get_report(haihu_id, progress)
+        await _notify_progress(
+            progress, NagaAnalyzeProgress(NagaAnalyzeStage.report_ready, haihu_id)
+        )
+
+        if new_order:
+            # 需要更新之前创建的NagaOrderOrm
+            logger.opt(colors=True).debug(
+                f"Updating majsoul paipu <y>{majsoul_uuid} "
+                f"(kyoku: {kyoku}, honba: {honba})</y> "
+                f"analyze report: {haihu_id}..."
+            )
+            async with self._unit_of_work("db_update") as repo:
                 await repo.update_local_order(haihu_id, report)
-                return NagaServiceOrder(report=report, cost_np=10)
-            else:
-                return NagaServiceOrder(report=report, cost_np=0)
+            return NagaServiceOrder(report=report, cost_np=10)
+        else:
+            return NagaServiceOrder(report=report, cost_np=0)
 
     async def _order_tenhou(
         self,
@@ -386,6 +793,7 @@ class NagaService:
             raise OrderError(res.msg)
 
     # needs test
+    @_traced(NagaOrderSource.tenhou)
     async def analyze_tenhou(
         self,
         haihu_id: str,
@@ -395,38 +803,49 @@ class NagaService:
         model_type: Union[
             None, Sequence[NagaHanchanModelType], Sequence[NagaTonpuuModelType]
         ] = None,
+        progress: Optional[T_ProgressCallback] = None,
     ) -> NagaServiceOrder:
-        async with AsyncSession(get_engine()) as sess:
-            repo = NagaRepository(sess)
-            if not self._tenhou_haihu_id_reg.match(haihu_id):
-                raise InvalidGameError(f"invalid haihu_id: {haihu_id}")
-
-            haihu_element = haihu_id.split("-")
-            if len(haihu_element) != 4:
-                raise InvalidGameError(f"invalid haihu_id: {haihu_id}")
-
-            haihu_rule = int(haihu_element[1], 16)
-            is_yonma = not bool(haihu_rule & 16)
-            is_hanchan = bool(haihu_rule & 8)
-            is_kuitan = not bool(haihu_rule & 4)
-            is_online = bool(haihu_rule & 1)
-
-            if is_yonma and is_kuitan and is_online:
-                rule = NagaGameRule.hanchan if is_hanchan else NagaGameRule.tonpuu
-            else:
-                raise UnsupportedGameError("only online kuitan yonma game is supported")
+        if not self._tenhou_haihu_id_reg.match(haihu_id):
+            raise InvalidGameError(f"invalid haihu_id: {haihu_id}")
 
-            model_type = self._handle_model_type(rule, model_type)
-            model_type_str = model_type_to_str(model_type)
+        haihu_element = haihu_id.split("-")
+        if len(haihu_element) != 4:
+            raise InvalidGameError(f"invalid haihu_id: {haihu_id}")
 
-            new_order = False
+        haihu_rule = int(haihu_element[1], 16)
+        is_yonma = not bool(haihu_rule & 16)
+        is_hanchan = bool(haihu_rule & 8)
+        is_kuitan = not bool(haihu_rule & 4)
+        is_online = bool(haihu_rule & 1)
 
-            # 加锁防止重复下单
-            local_order = await repo.get_local_order(haihu_id, model_type_str)
-            if local_order is None:
-                async with self._tenhou_order_mutex:
-                    local_order = await repo.get_local_order(haihu_id, model_type_str)
-                    if local_order is None:
+        if is_yonma and is_kuitan and is_online:
+            rule = NagaGameRule.hanchan if is_hanchan else NagaGameRule.tonpuu
+        else:
+            raise UnsupportedGameError("only online kuitan yonma game is supported")
+
+        model_type = self._handle_model_type(rule, model_type)
+        model_type_str = model_type_to_str(model_type)
+
+        new_order = False
+
+        def lookup(repo: NagaRepository):
+            return repo.get_local_order(haihu_id, model_type_str)
+
+        claim_key = f"tenhou:{haihu_id}:{model_type_str}"
+
+        # 加锁防止重复下单
+        async with self._unit_of_work("db_lookup") as repo:
+            local_order = await lookup(repo)
+        while local_order is None:
+            async with _traced_lock(self._tenhou_order_mutex):
+                async with self._unit_of_work("db_lookup") as repo:
+                    local_order = await lookup(repo)
+                if local_order is not None:
+                    break
+
+                claimed, local_order = await self._claim_order(claim_key, lookup)
+                if claimed:
+                    try:
                         # 不存在记录，安排解析
                         logger.opt(colors=True).info(
                             f"Ordering tenhou paipu <y>{haihu_id}</y> analyze..."
@@ -435,63 +854,245 @@ class NagaService:
                         await self._order_tenhou(haihu_id, seat, model_type)
 
                         new_order = True
+                        _orders.inc(source="tenhou", result="new")
+                        set_attribute("result", "new")
 
                         session_persist_id = await get_session_persist_id(session)
-                        await repo.new_local_order(
-                            haihu_id, session_persist_id, rule, model_type_str
-                        )
-
-            if local_order is not None:
-                # 存在记录
-                if local_order.status == NagaOrderStatus.ok:
-                    logger.opt(colors=True).info(
-                        f"Found a existing tenhou paipu <y>{haihu_id})</y> "
-                        "analyze report"
-                    )
-                    report = repo.parse_report(local_order.naga_report)
-                    return NagaServiceOrder(report=report, cost_np=0)
+                        async with self._unit_of_work("db_update") as repo:
+                            cost_np = await repo.new_local_order(
+                                haihu_id, session_persist_id, rule, model_type_str
+                            )
+                        self._spend_np(cost_np, NagaOrderSource.tenhou)
+                    finally:
+                        await self._release_order_claim(claim_key)
+                    break
 
+            if local_order is None:
+                # 其他进程正在下单，释放锁后再等待
+                local_order = await self._wait_claimed_order(lookup)
+
+        if local_order is not None:
+            # 存在记录
+            if local_order.status == NagaOrderStatus.ok:
+                _orders.inc(source="tenhou", result="cached")
+                set_attribute("result", "cached")
                 logger.opt(colors=True).info(
-                    f"Found a processing tenhou paipu <y>{haihu_id})</y> "
-                    "analyze order"
+                    f"Found a existing tenhou paipu <y>{haihu_id})</y> "
+                    "analyze report"
+                )
+                set_attribute("haihu_id", local_order.haihu_id)
+                report = await self._get_local_report(
+                    local_order.haihu_id, local_order.model_type
+                )
+                await _notify_progress(
+                    progress,
+                    NagaAnalyzeProgress(
+                        NagaAnalyzeStage.report_ready, local_order.haihu_id
+                    ),
                 )
+                return NagaServiceOrder(report=report, cost_np=0)
 
+            _orders.inc(source="tenhou", result="joined")
+            set_attribute("result", "joined")
             logger.opt(colors=True).info(
-                f"Waiting for tenhou paipu <y>{haihu_id})</y> " f"analyze report..."
+                f"Found a processing tenhou paipu <y>{haihu_id})</y> " "analyze order"
             )
-            report = await self._get_report(haihu_id)
 
-            if new_order:
-                # 需要更新之前创建的NagaOrderOrm
-                logger.opt(colors=True).debug(
-                    f"Updating tenhou paipu <y>{haihu_id})</y> " "analyze report..."
-                )
+        await _notify_progress(
+            progress, NagaAnalyzeProgress(NagaAnalyzeStage.order_placed, haihu_id)
+        )
+
+        logger.opt(colors=True).info(
+            f"Waiting for tenhou paipu <y>{haihu_id})</y> " f"analyze report..."
+        )
+        set_attribute("haihu_id", haihu_id)
+        with span("report_wait"):
+            report = await self._get_report(haihu_id, progress)
+        await _notify_progress(
+            progress, NagaAnalyzeProgress(NagaAnalyzeStage.report_ready, haihu_id)
+        )
+
+        if new_order:
+            # 需要更新之前创建的NagaOrderOrm
+            logger.opt(colors=True).debug(
+                f"Updating tenhou paipu <y>{haihu_id})</y> " "analyze report..."
+            )
+            async with self._unit_of_work("db_update") as repo:
                 await repo.update_local_order(haihu_id, report)
 
-                return NagaServiceOrder(report=report, cost_np=50)
-            else:
-                return NagaServiceOrder(report=report, cost_np=0)
+            return NagaServiceOrder(report=report, cost_np=50)
+        else:
+            return NagaServiceOrder(report=report, cost_np=0)
 
     async def statistic(self, year: int, month: int) -> list[NagaServiceUserStatistic]:
-        async with AsyncSession(get_engine()) as sess:
-            repo = NagaRepository(sess)
-            t_begin = datetime(year, month, 1)
-            t_end = datetime(year, month, 1) + monthdelta(months=1)
-            orders = await repo.get_orders(t_begin, t_end)
-
-            statistic = {}
-
-            for order in orders:
-                if order.customer_id not in statistic:
-                    statistic[order.customer_id] = 0
-                statistic[order.customer_id] += order.cost_np
-
-            statistic = [
-                NagaServiceUserStatistic(customer_id=x[0], cost_np=x[1])
-                for x in statistic.items()
+        # 确保缓冲中的已完成订单计入统计
+        await NagaRepository.flush_local_orders()
+        async with self._unit_of_work() as repo:
+            statistic = await repo.get_monthly_statistic(year, month)
+            return [
+                NagaServiceUserStatistic(customer_id=customer_id, cost_np=cost_np)
+                for customer_id, cost_np in statistic
             ]
-            statistic.sort(key=lambda x: x.cost_np, reverse=True)
-            return statistic
+
+    async def analytics(self, begin: date, end: date) -> NagaServiceUsageAnalytics:
+        """
+        统计[begin, end]（本地时区）内的使用情况，按来源、模型类型、用户分别汇总并给出每日的使用量
+        """
+        if end < begin:
+            raise ValueError("end must not be earlier than begin")
+
+        # 确保缓冲中的已完成订单计入统计
+        await NagaRepository.flush_local_orders()
+        async with self._unit_of_work() as repo:
+            rows = await repo.get_daily_usage(begin, end)
+
+        def add(usage: dict, key, cost_np: int, order_count: int):
+            total_cost_np, total_order_count = usage.get(key, (0, 0))
+            usage[key] = NagaUsage(
+                total_cost_np + cost_np, total_order_count + order_count
+            )
+
+        def sort(usage: dict) -> dict:
+            return dict(sorted(usage.items(), key=lambda x: x[1].cost_np, reverse=True))
+
+        total = {}
+        by_source = {}
+        by_model_type = {}
+        by_customer = {}
+        by_day = {}
+        for day, customer_id, source, model_type, cost_np, order_count in rows:
+            add(total, None, cost_np, order_count)
+            add(by_source, NagaOrderSource(source).name, cost_np, order_count)
+            add(by_model_type, model_type, cost_np, order_count)
+            add(by_customer, customer_id, cost_np, order_count)
+            add(by_day, day, cost_np, order_count)
+
+        daily = []
+        day = begin
+        while day <= end:
+            cost_np, order_count = by_day.get(day, (0, 0))
+            daily.append(NagaServiceDailyUsage(day, cost_np, order_count))
+            day += timedelta(days=1)
+
+        return NagaServiceUsageAnalytics(
+            begin=begin,
+            end=end,
+            total=total.get(None, NagaUsage(0, 0)),
+            by_source=sort(by_source),
+            by_model_type=sort(by_model_type),
+            by_customer=sort(by_customer),
+            daily=daily,
+        )
+
+    async def trace_latency(
+        self,
+        t_begin: datetime,
+        t_end: datetime,
+        source: Optional[NagaOrderSource] = None,
+    ) -> dict[str, NagaPhaseLatency]:
+        """
+        统计[t_begin, t_end)内开始的解析请求各阶段耗时（秒）的分位数，total为请求的总耗时。
+        同一请求中多次进入的阶段（如查询订单）按总和计算
+        """
+        traces = await get_traces(t_begin, t_end, source)
+
+        durations: dict[str, list[float]] = {}
+        for duration, spans in traces:
+            per_phase = {"total": duration}
+            for s in spans:
+                per_phase[s.phase] = per_phase.get(s.phase, 0) + s.duration
+            for phase, d in per_phase.items():
+                durations.setdefault(phase, []).append(d)
+
+        def percentile(values: list[float], p: float) -> float:
+            # 最近秩法
+            return values[max(0, math.ceil(len(values) * p) - 1)]
+
+        latency = {}
+        for phase in ("total", *TRACE_PHASES):
+            values = durations.get(phase)
+            if values is None:
+                continue
+            values.sort()
+            latency[phase] = NagaPhaseLatency(
+                count=len(values),
+                p50=percentile(values, 0.5),
+                p90=percentile(values, 0.9),
+                p99=percentile(values, 0.99),
+                max=values[-1],
+            )
+        return latency
+
+    async def export_orders(
+        self, begin: date, end: date, fmt: str = "csv", with_report: bool = False
+    ) -> OrderExportResult:
+        """
+        将[begin, end]（本地时区）内的订单导出为CSV或JSONL文件
+        """
+        # 确保缓冲中的已完成订单被导出
+        await NagaRepository.flush_local_orders()
+        # 不带时区的datetime按本地时区处理
+        return await export_orders(
+            datetime.combine(begin, time()),
+            datetime.combine(end + timedelta(days=1), time()),
+            fmt,
+            with_report,
+        )
+
+    async def archive_reports(self) -> int:
+        """
+        分批归档早于naga_report_archive_months个月的报告，返回归档的数量
+        """
+        before = datetime.now(tz=timezone.utc) - monthdelta(
+            months=conf().naga_report_archive_months
+        )
+        batch_size = conf().naga_report_archive_batch_size
+
+        total = 0
+        while True:
+            # 每批使用单独的事务，避免长时间锁表
+            async with self._unit_of_work() as repo:
+                cnt = await repo.archive_reports(before, batch_size)
+            total += cnt
+
+            if cnt < batch_size:
+                break
+            await asyncio.sleep(0)
+
+        logger.opt(colors=True).info(f"Archived <y>{total}</y> naga reports")
+        return total
+
+    def _spend_np(self, cost_np: int, source: NagaOrderSource):
+        _np_spent.inc(cost_np, source=source.name)
+        # 本地记账，下次从NAGA获取时校正
+        if self._rest_np is not None:
+            self._rest_np -= cost_np
 
     async def get_rest_np(self) -> int:
-        return await self.api.get_rest_np()
+        """
+        从NAGA获取剩余NP
+        """
+        rest_np = await self.api.get_rest_np()
+        self._rest_np = rest_np
+        self._rest_np_update_time = monotonic()
+        return rest_np
+
+    @logger.catch
+    async def _refresh_rest_np(self):
+        await self.get_rest_np()
+
+    async def get_cached_rest_np(self) -> NagaRestNp:
+        """
+        获取本地记账的剩余NP，超过naga_rest_np_ttl秒未校正时在后台从NAGA获取，
+        并将本次返回的值标记为近似值
+        """
+        if self._rest_np is None:
+            return NagaRestNp(value=await self.get_rest_np(), approximate=False)
+
+        stale = monotonic() - self._rest_np_update_time > conf().naga_rest_np_ttl
+        if stale and (
+            self._rest_np_refresh_worker is None or self._rest_np_refresh_worker.done()
+        ):
+            self._rest_np_refresh_worker = asyncio.create_task(self._refresh_rest_np())
+
+        return NagaRestNp(value=self._rest_np, approximate=stale)
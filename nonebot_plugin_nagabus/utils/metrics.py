@@ -0,0 +1,268 @@
+import math
+from time import perf_counter
+from bisect import bisect_left
+from typing import Union, Callable
+from contextlib import contextmanager
+from collections.abc import Iterator, Sequence
+
+from ..data.utils.atomic_cache import AtomicCache
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+)
+
+_LabelValues = tuple[str, ...]
+_ValueFunction = Callable[[], Union[int, float, None]]
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict[str, object]) -> _LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"metric {self.name} expects labels {self.labelnames}, "
+                f"got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[tuple[str, _LabelValues, tuple, float]]:
+        """
+        返回(后缀, 标签值, 额外标签, 值)
+        """
+        raise NotImplementedError()
+
+    def _render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {_escape_help(self.documentation)}"
+        yield f"# TYPE {self.name} {self.type}"
+        for suffix, key, extra, value in self._samples():
+            labels = [*zip(self.labelnames, key), *extra]
+            if len(labels) != 0:
+                label_str = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels)
+                yield f"{self.name}{suffix}{{{label_str}}} {_format_value(value)}"
+            else:
+                yield f"{self.name}{suffix} {_format_value(value)}"
+
+
+class _ValueMetric(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[_LabelValues, float] = {}
+        self._functions: dict[_LabelValues, _ValueFunction] = {}
+
+    def set_function(self, func: _ValueFunction, **labels):
+        """
+        采集时调用func获取值，用于暴露其他地方已经统计的数据。func返回None时不输出该项
+        """
+        self._functions[self._key(labels)] = func
+
+    def get(self, **labels) -> float:
+        key = self._key(labels)
+        func = self._functions.get(key)
+        if func is not None:
+            return func() or 0
+        return self._values.get(key, 0)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            if key not in self._functions:
+                yield "", key, (), value
+        for key, func in self._functions.items():
+            value = func()
+            if value is not None:
+                yield "", key, (), value
+
+
+class Counter(_ValueMetric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("counter can only be increased")
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_ValueMetric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class _HistogramValue:
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self, n_buckets: int):
+        self.bucket_counts = [0] * n_buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[_LabelValues, _HistogramValue] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        v = self._values.get(key)
+        if v is None:
+            v = _HistogramValue(len(self.buckets))
+            self._values[key] = v
+
+        # 只记录落在哪个桶，输出时再累加
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            v.bucket_counts[i] += 1
+        v.sum += value
+        v.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        记录代码块的耗时（秒），包括抛出异常的情况
+        """
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - begin, **labels)
+
+    def get_count(self, **labels) -> int:
+        v = self._values.get(self._key(labels))
+        return v.count if v is not None else 0
+
+    def _samples(self):
+        for key, v in self._values.items():
+            acc = 0
+            for bound, cnt in zip(self.buckets, v.bucket_counts):
+                acc += cnt
+                yield "_bucket", key, (("le", _format_value(bound)),), acc
+            yield "_bucket", key, (("le", "+Inf"),), v.count
+            yield "_sum", key, (), v.sum
+            yield "_count", key, (), v.count
+
+
+_registry: dict[str, _Metric] = {}
+
+
+def _register(metric_type: type, name: str, documentation: str, labelnames, **kwargs):
+    metric = _registry.get(name)
+    if metric is not None:
+        if type(metric) is not metric_type or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"metric {name} is already registered")
+        return metric
+
+    metric = metric_type(name, documentation, labelnames, **kwargs)
+    _registry[name] = metric
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    labelnames: Sequence[str] = (),
+    buckets: Sequence[float] = DEFAULT_BUCKETS,
+) -> Histogram:
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+_cache_requests = counter(
+    "nagabus_cache_requests_total",
+    "Requests to in-memory caches by result",
+    ("cache", "result"),
+)
+_cache_evictions = counter(
+    "nagabus_cache_evictions_total", "Entries evicted from in-memory caches", ("cache",)
+)
+_cache_size = gauge("nagabus_cache_size", "Entries in in-memory caches", ("cache",))
+
+
+def register_cache(name: str, cache: AtomicCache):
+    """
+    暴露AtomicCache的统计信息
+    """
+    for result in ("hits", "joins", "misses", "negative_hits"):
+        _cache_requests.set_function(
+            lambda result=result: getattr(cache.statistic, result),
+            cache=name,
+            result=result,
+        )
+    _cache_evictions.set_function(lambda: cache.statistic.evictions, cache=name)
+    _cache_size.set_function(lambda: cache.statistic.size, cache=name)
+
+
+def render(prefix: str = "") -> str:
+    """
+    以Prometheus文本格式输出指标
+
+    :param prefix: 只输出名称以此开头的指标
+    """
+    lines = []
+    for name, metric in sorted(_registry.items()):
+        if name.startswith(prefix):
+            lines.extend(metric._render())
+    return "\n".join(lines) + "\n"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def _escape_help(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(s: str) -> str:
+    return s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
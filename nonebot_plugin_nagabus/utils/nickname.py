@@ -1,6 +1,32 @@
+from collections.abc import Sequence
+from asyncio import Semaphore, gather
+
 from nonebot import Bot, logger
+from sqlalchemy.exc import NoResultFound
 from ssttkkl_nonebot_utils.platform import platform_func
 from nonebot_plugin_session import Session, SessionIdType
+from nonebot_plugin_session_orm import get_session_by_persist_id
+
+from ..config import conf
+from ..data.utils.atomic_cache import AtomicCache
+
+# 获取失败的结果也缓存一段时间，避免反复调用平台API
+_NEGATIVE_TTL = 60
+
+# persist_id与session的对应关系不会变化
+_session_cache: AtomicCache[Session] = AtomicCache(
+    ttl=60 * 60 * 24,
+    retain=True,
+    negative_ttl=lambda e: _NEGATIVE_TTL if isinstance(e, NoResultFound) else None,
+    max_size=4096,
+)
+
+_nickname_cache: AtomicCache[str] = AtomicCache(
+    ttl=conf().naga_nickname_cache_ttl,
+    retain=True,
+    negative_ttl=lambda e: _NEGATIVE_TTL,
+    max_size=4096,
+)
 
 
 async def get_nickname(bot: Bot, session: Session):
@@ -10,8 +36,31 @@ async def get_nickname(bot: Bot, session: Session):
 
     if session.bot_type == bot.type:
         try:
-            nickname = await platform_func(bot.type).get_user_nickname(session)
+            nickname = await _nickname_cache.get(
+                (bot.type, bot.self_id, nickname),
+                lambda: platform_func(bot.type).get_user_nickname(session),
+            )
         except BaseException as e:
             logger.opt(exception=e).error("获取用户昵称失败")
 
     return nickname
+
+
+async def get_customer_nicknames(bot: Bot, customer_ids: Sequence[int]) -> list[str]:
+    """
+    并发获取多个用户（session的persist_id）的昵称
+    """
+    sem = Semaphore(conf().naga_nickname_concurrency)
+
+    async def _get(customer_id: int) -> str:
+        async with sem:
+            try:
+                session = await _session_cache.get(
+                    customer_id, lambda: get_session_by_persist_id(customer_id)
+                )
+            except NoResultFound:
+                logger.warning(f"session (persist_id: {customer_id}) not found")
+                return str(customer_id)
+            return await get_nickname(bot, session)
+
+    return list(await gather(*[_get(customer_id) for customer_id in customer_ids]))
@@ -0,0 +1,225 @@
+import os
+import sys
+import asyncio
+import threading
+from pathlib import Path
+from time import monotonic
+from functools import wraps
+from types import FrameType
+from typing import Optional
+from datetime import datetime
+from collections import Counter
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from nonebot import logger
+from nonebot_plugin_localstore import get_data_dir
+
+from . import metrics
+from ..config import conf
+
+# 事件循环的心跳间隔，心跳推迟的时间即为事件循环的延迟
+HEARTBEAT_INTERVAL = 0.1
+
+_loop_lag = metrics.histogram(
+    "nagabus_event_loop_lag_seconds",
+    "Event loop lag measured by a periodic heartbeat (only while profiling)",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+_captured = metrics.counter(
+    "nagabus_profiles_captured_total", "Stack profiles written to disk", ("kind",)
+)
+
+
+def _get_profile_dir() -> Path:
+    profile_dir = get_data_dir("nonebot_plugin_nagabus") / "profile"
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    return profile_dir
+
+
+def _fold_stack(frame: Optional[FrameType]) -> str:
+    # 与flamegraph.pl、speedscope兼容的折叠格式，从外到内以分号分隔
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _write_profile(kind: str, name: str, seconds: float, samples: Counter):
+    profile_dir = _get_profile_dir()
+    now = datetime.now()
+    path = (
+        profile_dir
+        / f"{now:%Y%m%d%H%M%S%f}-{kind}-{name}-{int(seconds * 1000)}ms.folded"
+    )
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, cnt in samples.most_common():
+            f.write(f"{stack} {cnt}\n")
+    _captured.inc(kind=kind)
+
+    # 文件名以时间开头，按文件名排序即按时间排序，只保留最新的若干个
+    files = sorted(profile_dir.glob("*.folded"))
+    for old in files[: max(0, len(files) - conf().naga_profiler_max_files)]:
+        try:
+            old.unlink()
+        except FileNotFoundError:
+            pass
+
+    return path
+
+
+class _ProfileSession:
+    __slots__ = ("name", "samples")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: Counter = Counter()
+
+
+class Profiler:
+    """
+    采样分析器：在后台线程中定时采样事件循环线程的调用栈。
+    耗时超过naga_profiler_threshold秒的请求、事件循环阻塞超过naga_profiler_stall_threshold秒时，
+    将期间采到的调用栈写入数据目录下的profile文件夹
+    """
+
+    def __init__(self):
+        self._loop_thread_id: Optional[int] = None
+        # 保护_sessions及其中的samples，移出_sessions的请求不再被采样线程修改
+        self._lock = threading.Lock()
+        self._sessions: set[_ProfileSession] = set()
+        self._heartbeat = 0.0
+        self._heartbeat_worker: Optional[asyncio.Task] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._stop: Optional[threading.Event] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._sampler is not None
+
+    def enable(self):
+        """
+        开始采样，需要在事件循环线程中调用
+        """
+        if self.enabled:
+            return
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = monotonic()
+        self._heartbeat_worker = asyncio.create_task(self._beat())
+
+        # 每个采样线程使用各自的停止信号，避免重新启用时旧线程继续运行
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample,
+            args=(self._stop,),
+            name="nagabus-profiler",
+            daemon=True,
+        )
+        self._sampler.start()
+        logger.info("profiler enabled")
+
+    def disable(self):
+        if not self.enabled:
+            return
+
+        self._stop.set()
+        self._stop = None
+        self._sampler = None
+        if self._heartbeat_worker is not None:
+            self._heartbeat_worker.cancel()
+            self._heartbeat_worker = None
+        with self._lock:
+            self._sessions.clear()
+        logger.info("profiler disabled")
+
+    async def _beat(self):
+        while True:
+            begin = monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            self._heartbeat = monotonic()
+            _loop_lag.observe(max(0.0, self._heartbeat - begin - HEARTBEAT_INTERVAL))
+
+    def _sample(self, stop: threading.Event):
+        stall_samples: Counter = Counter()
+        stall_begin = 0.0
+
+        while not stop.wait(conf().naga_profiler_interval):
+            with self._lock:
+                profiling = len(self._sessions) != 0
+            # 距上次心跳的时间超出间隔的部分即为事件循环已经阻塞的时间
+            lag = monotonic() - self._heartbeat - HEARTBEAT_INTERVAL
+            stalled = lag >= conf().naga_profiler_stall_threshold
+
+            if profiling or stalled:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = _fold_stack(frame)
+                del frame
+
+                # 只记录到仍在进行的请求中，已结束的请求的samples可能正在写入文件
+                with self._lock:
+                    for s in self._sessions:
+                        s.samples[stack] += 1
+                if stalled:
+                    if len(stall_samples) == 0:
+                        stall_begin = self._heartbeat
+                    stall_samples[stack] += 1
+
+            if not stalled and len(stall_samples) != 0:
+                seconds = monotonic() - stall_begin
+                try:
+                    path = _write_profile("stall", "loop", seconds, stall_samples)
+                    logger.warning(
+                        f"Event loop stalled for {seconds:.3f}s, profile: {path}"
+                    )
+                except Exception as e:
+                    logger.exception(e)
+                stall_samples = Counter()
+
+    @asynccontextmanager
+    async def profile(self, name: str) -> AsyncIterator[None]:
+        """
+        采样代码块执行期间事件循环线程的调用栈，耗时超过阈值时写入文件。未启用时不做任何事
+        """
+        if not self.enabled:
+            yield
+            return
+
+        session = _ProfileSession(name)
+        with self._lock:
+            self._sessions.add(session)
+        begin = monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._sessions.discard(session)
+            seconds = monotonic() - begin
+            if seconds >= conf().naga_profiler_threshold and len(session.samples) != 0:
+                try:
+                    path = await asyncio.get_running_loop().run_in_executor(
+                        None, _write_profile, "slow", name, seconds, session.samples
+                    )
+                    logger.opt(colors=True).info(
+                        f"Slow <y>{name}</y> took {seconds:.3f}s, profile: {path}"
+                    )
+                except Exception as e:
+                    logger.exception(e)
+
+    def profiled(self, name: str):
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with self.profile(name):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+profiler = Profiler()
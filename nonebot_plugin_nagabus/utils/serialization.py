@@ -0,0 +1,104 @@
+import json
+import asyncio
+from functools import partial
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Union, TypeVar, Callable, Optional, NamedTuple
+
+from ..config import conf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+T = TypeVar("T")
+
+
+class SerializationStatistic(NamedTuple):
+    calls: int
+    offloaded_calls: int
+    total_seconds: float
+    max_seconds: float
+
+
+_statistic: dict[str, SerializationStatistic] = {}
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="nagabus-serialization"
+        )
+    return _executor
+
+
+def _record(site: str, offloaded: bool, seconds: float):
+    calls, offloaded_calls, total_seconds, max_seconds = _statistic.get(
+        site, (0, 0, 0.0, 0.0)
+    )
+    _statistic[site] = SerializationStatistic(
+        calls=calls + 1,
+        offloaded_calls=offloaded_calls + int(offloaded),
+        total_seconds=total_seconds + seconds,
+        max_seconds=max(max_seconds, seconds),
+    )
+
+
+def _orjson_default(obj):
+    # orjson不直接支持NamedTuple
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError
+
+
+def dumps_sync(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default).decode("utf-8")
+    else:
+        return json.dumps(obj, ensure_ascii=False)
+
+
+def loads_sync(s: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(s)
+    else:
+        return json.loads(s)
+
+
+async def run_serialization(
+    site: str, size: Optional[int], func: Callable[..., T], *args
+) -> T:
+    """
+    执行（反）序列化操作，size超过阈值（或未知）时将其放到线程池中执行，避免阻塞事件循环
+
+    :param site: 调用位置，用于统计耗时
+    :param size: 数据大小（字节），为None时表示未知
+    """
+    threshold = conf().naga_serialization_offload_threshold
+    offload = threshold >= 0 and (size is None or size >= threshold)
+
+    begin = perf_counter()
+    try:
+        if offload:
+            return await asyncio.get_running_loop().run_in_executor(
+                _get_executor(), partial(func, *args)
+            )
+        else:
+            return func(*args)
+    finally:
+        _record(site, offload, perf_counter() - begin)
+
+
+async def dumps(obj: Any, *, site: str, size_hint: Optional[int] = None) -> str:
+    return await run_serialization(site, size_hint, dumps_sync, obj)
+
+
+async def loads(s: Union[str, bytes], *, site: str) -> Any:
+    return await run_serialization(site, len(s), loads_sync, s)
+
+
+def get_serialization_statistic() -> dict[str, SerializationStatistic]:
+    return dict(_statistic)
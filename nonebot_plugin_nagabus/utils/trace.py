@@ -0,0 +1,80 @@
+from uuid import uuid4
+from time import perf_counter
+from contextvars import ContextVar
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional, NamedTuple
+
+
+class TraceSpan(NamedTuple):
+    phase: str
+    offset: float  # 相对于请求开始的秒数
+    duration: float
+
+
+class Trace:
+    """
+    一次请求的各阶段耗时。阶段之间不互相嵌套，各阶段耗时之和不超过请求的总耗时
+    """
+
+    def __init__(self):
+        self.trace_id = uuid4().hex
+        self.begin_time = datetime.now(timezone.utc)
+        self.duration: Optional[float] = None
+        self.spans: list[TraceSpan] = []
+        self.attributes: dict[str, str] = {}
+        self._begin = perf_counter()
+
+    def elapsed(self) -> float:
+        return perf_counter() - self._begin
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = self.elapsed()
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar(
+    "nagabus_current_trace", default=None
+)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace() -> Iterator[Trace]:
+    """
+    开始记录一次请求，期间（包括其创建的任务中）的span都会记录到该请求中
+    """
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+
+
+@contextmanager
+def span(phase: str) -> Iterator[None]:
+    """
+    记录代码块的耗时，不在请求中时不做任何事
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    offset = trace.elapsed()
+    try:
+        yield
+    finally:
+        trace.spans.append(TraceSpan(phase, offset, trace.elapsed() - offset))
+
+
+def set_attribute(key: str, value: str):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[key] = value
@@ -0,0 +1,121 @@
+import json
+import asyncio
+from uuid import uuid4
+from pathlib import Path
+from time import perf_counter
+
+import pytest
+from nonebug import App
+
+CONCURRENCY = 16
+KYOKU_REPEAT = 200
+
+
+async def _measure_lag(stop: asyncio.Event, interval: float = 0.005) -> list[float]:
+    lags = []
+    while not stop.is_set():
+        begin = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - begin - interval)
+    return lags
+
+
+def _offloaded_calls() -> int:
+    from nonebot_plugin_nagabus.utils.serialization import get_serialization_statistic
+
+    return sum(x.offloaded_calls for x in get_serialization_statistic().values())
+
+
+async def _run_load(threshold: int) -> dict:
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.naga.errors import InvalidKyokuHonbaError
+    from nonebot_plugin_nagabus.data.mjs import _get_paipu_dir, get_majsoul_paipu
+
+    conf().naga_serialization_offload_threshold = threshold
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    uuids = [f"bench-{uuid4()}" for _ in range(CONCURRENCY)]
+
+    async def request(uuid: str):
+        # 未指定场次，走完下载、编码、建立索引的流程后直接返回可选的场次
+        with pytest.raises(InvalidKyokuHonbaError):
+            await naga.analyze_majsoul(uuid, -1, -1, session)
+        await get_majsoul_paipu(uuid)
+
+    offloaded_calls = _offloaded_calls()
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(_measure_lag(stop))
+    await asyncio.sleep(0.05)
+
+    begin = perf_counter()
+    await asyncio.gather(*[request(uuid) for uuid in uuids])
+    elapsed = perf_counter() - begin
+
+    stop.set()
+    lags = sorted(await lag_task)
+
+    for uuid in uuids:
+        for f in _get_paipu_dir().glob(f"{uuid}*"):
+            f.unlink()
+
+    return {
+        "threshold": threshold,
+        "offloaded_calls": _offloaded_calls() - offloaded_calls,
+        "elapsed": elapsed,
+        "lag_p50": lags[len(lags) // 2],
+        "lag_p99": lags[int(len(lags) * 0.99)],
+        "lag_max": lags[-1],
+    }
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_serialization_event_loop_lag(app: App):
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.data.mjs import _set_download_paipu_delegate
+    from nonebot_plugin_nagabus.utils.serialization import get_serialization_statistic
+
+    sample_path = str(Path(__file__).parent.parent / "sample_majsoul_paipu.json")
+    with open(sample_path, encoding="utf-8") as f:
+        sample = json.load(f)
+    sample["log"] = sample["log"] * KYOKU_REPEAT
+
+    async def download_paipu(uuid):
+        return sample
+
+    _set_download_paipu_delegate(download_paipu)
+
+    default_threshold = conf().naga_serialization_offload_threshold
+    try:
+        before = await _run_load(-1)
+        after = await _run_load(default_threshold)
+    finally:
+        conf().naga_serialization_offload_threshold = default_threshold
+
+    # 每个请求的牌谱都远大于默认阈值，编码与解码都应在线程池中执行
+    assert before["offloaded_calls"] == 0
+    assert after["offloaded_calls"] >= CONCURRENCY * 2
+
+    print(
+        json.dumps(
+            {
+                "before": before,
+                "after": after,
+                "statistic": {
+                    k: v._asdict() for k, v in get_serialization_statistic().items()
+                },
+            },
+            indent=2,
+        )
+    )
@@ -0,0 +1,305 @@
+import os
+import json
+import asyncio
+from uuid import uuid4
+from pathlib import Path
+from typing import Optional
+from time import perf_counter
+from collections import Counter
+
+import pytest
+from nonebug import App
+from sqlalchemy import event
+
+TENHOU_CALLS = 32
+TENHOU_DUPLICATE_KEYS = 4
+MAJSOUL_DISTINCT_KEYS = 4
+MAJSOUL_CALLS = 24
+MAJSOUL_DUPLICATE_KEYS = 3
+
+
+def _percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class _LoadProbe:
+    """
+    统计压测期间对NAGA的请求数、数据库查询数以及等待者数量的峰值
+    """
+
+    def __init__(self, naga, engine):
+        self.naga = naga
+        self.engine = engine
+        self.api_calls = Counter()
+        self.db_queries = 0
+        self.peak_report_observers = 0
+        self.peak_mutex_waiters = 0
+        self._stop = asyncio.Event()
+        self._sampler = None
+
+    def _wrap_api(self, monkeypatch: pytest.MonkeyPatch, name: str):
+        func = getattr(self.naga.api, name)
+
+        async def wrapper(*args, **kwargs):
+            self.api_calls[name] += 1
+            return await func(*args, **kwargs)
+
+        monkeypatch.setattr(self.naga.api, name, wrapper)
+
+    def _on_execute(self, *args, **kwargs):
+        self.db_queries += 1
+
+    async def _sample(self):
+        while not self._stop.is_set():
+            self.peak_report_observers = max(
+                self.peak_report_observers, len(self.naga._order_report._observers)
+            )
+            waiters = sum(
+                len(lock._waiters or ())
+                for lock in (
+                    self.naga._majsoul_order_mutex,
+                    self.naga._tenhou_order_mutex,
+                )
+            )
+            self.peak_mutex_waiters = max(self.peak_mutex_waiters, waiters)
+            await asyncio.sleep(0.005)
+
+    def start(self, monkeypatch: pytest.MonkeyPatch):
+        for name in ("order_report_list", "analyze_tenhou", "analyze_custom"):
+            self._wrap_api(monkeypatch, name)
+        event.listen(self.engine.sync_engine, "before_cursor_execute", self._on_execute)
+        self._sampler = asyncio.create_task(self._sample())
+
+    async def stop(self):
+        self._stop.set()
+        await self._sampler
+        event.remove(self.engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+
+async def _run_scenario(
+    name: str,
+    monkeypatch: pytest.MonkeyPatch,
+    calls: list,
+    arrivals: Optional[list[float]] = None,
+) -> dict:
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+
+    # 每个场景使用新的刷新任务与下单锁，与当前事件循环绑定
+    order_report = ObservableOrderReport(naga.api)
+    with monkeypatch.context() as m:
+        m.setattr(naga, "_order_report", order_report)
+        m.setattr(naga, "_majsoul_order_mutex", asyncio.Lock())
+        m.setattr(naga, "_tenhou_order_mutex", asyncio.Lock())
+
+        probe = _LoadProbe(naga, get_engine())
+        probe.start(m)
+        try:
+            latencies = []
+
+            async def timed(call, arrival):
+                if arrival:
+                    # 按FakeNagaApi的时钟模拟请求到达的时间
+                    await naga.api.clock.sleep(arrival)
+                begin = perf_counter()
+                order = await call()
+                latencies.append(perf_counter() - begin)
+                return order
+
+            begin = perf_counter()
+            orders = await asyncio.gather(
+                *[
+                    timed(call, arrivals[i] if arrivals else 0)
+                    for i, call in enumerate(calls)
+                ]
+            )
+            elapsed = perf_counter() - begin
+        finally:
+            await probe.stop()
+            await order_report.close()
+
+    new_orders = sum(1 for order in orders if order.cost_np != 0)
+    analyze_calls = (
+        probe.api_calls["analyze_tenhou"] + probe.api_calls["analyze_custom"]
+    )
+    return {
+        "scenario": name,
+        "calls": len(calls),
+        "new_orders": new_orders,
+        "elapsed": elapsed,
+        "throughput": len(calls) / elapsed,
+        "latency_p50": _percentile(latencies, 0.5),
+        "latency_p95": _percentile(latencies, 0.95),
+        "latency_p99": _percentile(latencies, 0.99),
+        "latency_max": max(latencies),
+        "api_calls": dict(probe.api_calls),
+        "analyze_calls_per_order": analyze_calls / max(new_orders, 1),
+        "api_calls_per_order": sum(probe.api_calls.values()) / max(new_orders, 1),
+        "db_queries": probe.db_queries,
+        "db_queries_per_call": probe.db_queries / len(calls),
+        "peak_report_observers": probe.peak_report_observers,
+        "peak_mutex_waiters": probe.peak_mutex_waiters,
+    }
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_service_concurrent_load(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.data.naga import NagaRepository
+    from nonebot_plugin_nagabus.data.mjs import (
+        _get_paipu_dir,
+        _set_download_paipu_delegate,
+    )
+
+    sample_path = str(Path(__file__).parent.parent / "sample_majsoul_paipu.json")
+    with open(sample_path, encoding="utf-8") as f:
+        sample = json.load(f)
+
+    async def download_paipu(uuid):
+        return sample
+
+    _set_download_paipu_delegate(download_paipu)
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    def tenhou(haihu_id: str):
+        return lambda: naga.analyze_tenhou(haihu_id, 0, session)
+
+    def majsoul(uuid: str):
+        return lambda: naga.analyze_majsoul(uuid, 0, 0, session)
+
+    def tenhou_id() -> str:
+        return f"2023111804gm-0029-0000-{uuid4().hex[:8]}"
+
+    tenhou_keys = [tenhou_id() for _ in range(TENHOU_DUPLICATE_KEYS)]
+    majsoul_keys = [f"bench-{uuid4()}" for _ in range(MAJSOUL_DUPLICATE_KEYS)]
+    majsoul_distinct_keys = [f"bench-{uuid4()}" for _ in range(MAJSOUL_DISTINCT_KEYS)]
+
+    results = [
+        await _run_scenario(
+            "tenhou_distinct",
+            monkeypatch,
+            [tenhou(tenhou_id()) for _ in range(TENHOU_CALLS)],
+        ),
+        await _run_scenario(
+            "tenhou_duplicate",
+            monkeypatch,
+            [
+                tenhou(tenhou_keys[i % TENHOU_DUPLICATE_KEYS])
+                for i in range(TENHOU_CALLS)
+            ],
+        ),
+        await _run_scenario(
+            "majsoul_distinct",
+            monkeypatch,
+            [majsoul(uuid) for uuid in majsoul_distinct_keys],
+        ),
+        await _run_scenario(
+            "majsoul_duplicate",
+            monkeypatch,
+            [
+                majsoul(majsoul_keys[i % MAJSOUL_DUPLICATE_KEYS])
+                for i in range(MAJSOUL_CALLS)
+            ],
+        ),
+    ]
+    await NagaRepository.flush_local_orders()
+
+    for uuid in [*majsoul_keys, *majsoul_distinct_keys]:
+        for f in _get_paipu_dir().glob(f"{uuid}*"):
+            f.unlink()
+
+    # 重复的订单只应下单一次
+    assert results[1]["new_orders"] == TENHOU_DUPLICATE_KEYS
+    assert results[3]["new_orders"] == MAJSOUL_DUPLICATE_KEYS
+
+    output = json.dumps({"results": results}, indent=2)
+    print(output)
+
+    # 指定输出文件时写入，便于持续追踪性能变化
+    output_path = os.environ.get("NAGABUS_BENCHMARK_OUTPUT")
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(output)
+
+
+DAY_TRAFFIC_CALLS = 96
+DAY_TRAFFIC_SPEED = 60 * 60 * 24 / 20  # 20秒模拟一天
+DAY_TRAFFIC_HISTORY = 5000
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_service_day_traffic(app: App, monkeypatch: pytest.MonkeyPatch):
+    from random import Random
+
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.data.naga import NagaRepository
+    from nonebot_plugin_nagabus.naga.fake_api import (
+        FakeNagaApi,
+        VirtualClock,
+        lognormal,
+    )
+
+    # 订单列表中有大量历史订单，NAGA的响应与解析耗时呈长尾分布
+    api = FakeNagaApi(
+        clock=VirtualClock(speed=DAY_TRAFFIC_SPEED),
+        latency={
+            endpoint: lognormal(median=0.5, sigma=0.5)
+            for endpoint in FakeNagaApi.ENDPOINTS
+        },
+        order_delay=lognormal(median=60, sigma=0.5),
+        report_delay=lognormal(median=300, sigma=0.8),
+        seed=0,
+    )
+    api.seed_history(DAY_TRAFFIC_HISTORY)
+    monkeypatch.setattr(naga, "api", api)
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    rnd = Random(0)
+    haihu_ids = [
+        f"2023111804gm-0029-0000-{rnd.getrandbits(32):08x}"
+        for _ in range(DAY_TRAFFIC_CALLS)
+    ]
+    arrivals = sorted(rnd.uniform(0, 60 * 60 * 24) for _ in range(DAY_TRAFFIC_CALLS))
+
+    # 出错时也要取消FakeNagaApi的后台任务，避免影响之后的测试
+    try:
+        result = await _run_scenario(
+            "day_traffic",
+            monkeypatch,
+            [
+                (lambda haihu_id=haihu_id: naga.analyze_tenhou(haihu_id, 0, session))
+                for haihu_id in haihu_ids
+            ],
+            arrivals,
+        )
+        await NagaRepository.flush_local_orders()
+    finally:
+        await api.close()
+
+    assert result["new_orders"] == DAY_TRAFFIC_CALLS
+    print(json.dumps({"results": [result]}, indent=2))
@@ -1,19 +1,45 @@
+import asyncio
+from pathlib import Path
+from tempfile import mkdtemp
+
 import pytest
 import pytest_asyncio
 from nonebug import NONEBOT_INIT_KWARGS
 
 
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--benchmark", action="store_true", default=False, help="run benchmarks"
+    )
+
+
 def pytest_configure(config: pytest.Config) -> None:
+    config.addinivalue_line("markers", "benchmark: run only with --benchmark")
+    # 内存数据库的所有会话共用一个连接，后台写入请求记录会干扰其他测试中的事务，
+    # 因此使用文件数据库，使请求记录与生产环境一样默认开启
+    database_path = Path(mkdtemp(prefix="nagabus-test-")) / "db.sqlite3"
+    database_url = f"sqlite+aiosqlite:///{database_path}"
     config.stash[NONEBOT_INIT_KWARGS] = {
         "log_level": "DEBUG",
-        "datastore_database_url": "sqlite+aiosqlite:///:memory:",
+        "datastore_database_url": database_url,
         "datastore_database_echo": True,
-        "sqlalchemy_database_url": "sqlite+aiosqlite:///:memory:",
+        "sqlalchemy_database_url": database_url,
         "alembic_startup_check": False,
         "naga_fake_api": True,
+        "naga_metrics_path": "/nagabus/metrics",
     }
 
 
+def pytest_collection_modifyitems(config: pytest.Config, items) -> None:
+    if config.getoption("--benchmark"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="need --benchmark option to run")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
 @pytest.fixture(scope="session", autouse=True)
 def _prepare_nonebot():
     import nonebot
@@ -39,3 +65,18 @@ async def _init_dep_plugins(_prepare_nonebot):
         await init_orm()
         await init_db()
         _orm_inited = True
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def _close_naga(_init_dep_plugins, monkeypatch: pytest.MonkeyPatch):
+    # 依赖monkeypatch，使关闭时测试中替换的属性仍然生效
+    yield
+
+    from nonebot_plugin_nagabus.naga import naga
+
+    # 服务的后台任务属于本测试的事件循环，与Bot关闭时一样在测试结束前全部结束
+    await naga.close()
+
+    # 残留的任务会在事件循环关闭后报告"Task was destroyed but it is pending!"
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    assert pending == [], pending
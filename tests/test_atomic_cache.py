@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_atomic_cache(app: App):
+    from nonebot_plugin_nagabus.data.utils.atomic_cache import AtomicCache
+
+    class PermanentError(Exception): ...
+
+    calls = 0
+
+    async def get_value():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return calls
+
+    # 不保留结果时，只有同时进行的调用共享结果
+    cache = AtomicCache()
+    assert await asyncio.gather(*[cache.get("k", get_value) for _ in range(3)]) == [
+        1,
+        1,
+        1,
+    ]
+    assert await cache.get("k", get_value) == 2
+    assert cache.statistic.misses == 2
+    assert cache.statistic.joins == 2
+    assert cache.statistic.size == 0
+
+    # 保留结果直到过期
+    cache = AtomicCache(ttl=0.2, retain=True)
+    assert await cache.get("k", get_value) == 3
+    assert await cache.get("k", get_value) == 3
+    assert cache.statistic.hits == 1
+    await asyncio.sleep(0.3)
+    assert await cache.get("k", get_value) == 4
+    assert cache.statistic.evictions == 1
+
+    # 缓存指定的异常
+    fail_calls = 0
+
+    async def fail(e):
+        nonlocal fail_calls
+        fail_calls += 1
+        raise e
+
+    cache = AtomicCache(
+        negative_ttl=lambda e: 0.2 if isinstance(e, PermanentError) else None
+    )
+    for _ in range(2):
+        with pytest.raises(PermanentError):
+            await cache.get("permanent", lambda: fail(PermanentError()))
+        with pytest.raises(RuntimeError):
+            await cache.get("transient", lambda: fail(RuntimeError()))
+    assert fail_calls == 3
+    assert cache.statistic.negative_hits == 1
+
+    # 直接写入结果
+    cache = AtomicCache(ttl=60, retain=True, max_size=1)
+    cache.set("a", 10)
+    assert await cache.get("a", get_value) == 10
+    cache.set("b", 20)
+    assert cache.statistic.evictions == 1
+    assert await cache.get("b", get_value) == 20
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_fake_api_virtual_clock(app: App):
+    from nonebot_plugin_nagabus.naga.fake_api import FakeNagaApi, VirtualClock, fixed
+    from nonebot_plugin_nagabus.naga.model import NagaOrderStatus, NagaHanchanModelType
+
+    clock = VirtualClock()
+    api = FakeNagaApi(
+        clock=clock, order_delay=fixed(60), report_delay=fixed(600), seed=0
+    )
+    model_type = [NagaHanchanModelType.nishiki, NagaHanchanModelType.kagashi]
+
+    haihu_id = "2023111804gm-0029-0000-fake0000"
+    res = await api.analyze_tenhou(haihu_id, 0, model_type)
+    assert res.status == 200
+
+    now = datetime.now()
+    await asyncio.sleep(0)
+    assert (await api.order_report_list(now.year, now.month)).order == []
+
+    clock.advance(60)
+    await asyncio.sleep(0)
+    order_report = await api.order_report_list(now.year, now.month)
+    assert [o.haihu_id for o in order_report.order] == [haihu_id]
+    assert order_report.order[0].status == NagaOrderStatus.ok
+    assert order_report.report == []
+
+    clock.advance(540)
+    await asyncio.sleep(0)
+    order_report = await api.order_report_list(now.year, now.month)
+    assert [r.haihu_id for r in order_report.report] == [haihu_id]
+
+    await api.close()
+
+
+@pytest.mark.asyncio
+async def test_fake_api_error_injection(app: App):
+    from httpx import HTTPStatusError
+
+    from nonebot_plugin_nagabus.naga.errors import InvalidTokenError
+    from nonebot_plugin_nagabus.naga.model import NagaOrderStatus, NagaHanchanModelType
+    from nonebot_plugin_nagabus.naga.fake_api import (
+        FakeNagaApi,
+        VirtualClock,
+        FakeErrorRates,
+        fixed,
+    )
+
+    api = FakeNagaApi(error_rates=FakeErrorRates(server_error=1))
+    with pytest.raises(HTTPStatusError):
+        await api.get_rest_np()
+
+    api = FakeNagaApi(error_rates=FakeErrorRates(invalid_token=1))
+    with pytest.raises(InvalidTokenError):
+        await api.order_report_list(2023, 11)
+
+    clock = VirtualClock()
+    api = FakeNagaApi(
+        clock=clock,
+        order_delay=fixed(0),
+        report_delay=fixed(0),
+        error_rates=FakeErrorRates(failed_order=1),
+    )
+    await api.analyze_tenhou(
+        "2023111804gm-0029-0000-fake0001", 0, [NagaHanchanModelType.nishiki]
+    )
+    await asyncio.sleep(0)
+    now = datetime.now()
+    order_report = await api.order_report_list(now.year, now.month)
+    assert [o.status for o in order_report.order] == [NagaOrderStatus.failed]
+    assert order_report.report == []
+
+
+@pytest.mark.asyncio
+async def test_fake_api_seed_history(app: App):
+    from monthdelta import monthdelta
+
+    from nonebot_plugin_nagabus.naga.fake_api import FakeNagaApi, VirtualClock
+
+    clock = VirtualClock()
+    api = FakeNagaApi(clock=clock, seed=42)
+    api.seed_history(3000, days=90)
+
+    now = clock.now()
+    total = 0
+    for i in range(4):
+        t = now - monthdelta(months=i)
+        order_report = await api.order_report_list(t.year, t.month)
+        assert len(order_report.order) == len(order_report.report)
+        # 按时间倒序排列
+        assert order_report.order == sorted(
+            order_report.order, key=lambda o: o.haihu_id[:10], reverse=True
+        )
+        total += len(order_report.order)
+    assert total == 3000
+
+    # 相同的种子生成相同的历史
+    other = FakeNagaApi(clock=clock, seed=42)
+    other.seed_history(3000, days=90)
+    assert [o.haihu_id for o in other.order] == [o.haihu_id for o in api.order]
+
+    api = FakeNagaApi(clock=clock, seed=42, max_entries=100)
+    api.seed_history(3000, days=90)
+    assert len(api.order) == len(api.report) == 100
@@ -0,0 +1,41 @@
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_metrics_render(app: App):
+    from nonebot_plugin_nagabus.utils import metrics
+
+    c = metrics.counter("test_requests_total", "Test counter", ("path",))
+    c.inc(path="/a")
+    c.inc(2, path='/"b"')
+    assert metrics.counter("test_requests_total", "Test counter", ("path",)) is c
+    with pytest.raises(ValueError, match="already registered"):
+        metrics.gauge("test_requests_total", "Test counter", ("path",))
+    with pytest.raises(ValueError, match="expects labels"):
+        c.inc(method="GET")
+
+    g = metrics.gauge("test_queue_size", "Test gauge")
+    g.set_function(lambda: 3)
+
+    h = metrics.histogram("test_duration_seconds", "Test histogram", buckets=(0.1, 1))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5)
+
+    assert metrics.render("test_") == (
+        "# HELP test_duration_seconds Test histogram\n"
+        "# TYPE test_duration_seconds histogram\n"
+        'test_duration_seconds_bucket{le="0.1"} 1\n'
+        'test_duration_seconds_bucket{le="1"} 2\n'
+        'test_duration_seconds_bucket{le="+Inf"} 3\n'
+        "test_duration_seconds_sum 5.55\n"
+        "test_duration_seconds_count 3\n"
+        "# HELP test_queue_size Test gauge\n"
+        "# TYPE test_queue_size gauge\n"
+        "test_queue_size 3\n"
+        "# HELP test_requests_total Test counter\n"
+        "# TYPE test_requests_total counter\n"
+        'test_requests_total{path="/a"} 1\n'
+        'test_requests_total{path="/\\"b\\""} 2\n'
+    )
@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_parse_analyze_targets(app: App):
+    from nonebot_plugin_nagabus.matchers.naga_analyze import (
+        TenhouTarget,
+        MajsoulTarget,
+        parse_analyze_targets,
+    )
+
+    uuid = "231126-23433728-1ce4-4a84-b945-7ab940d15d41"
+    uuid2 = "231127-13433728-1ce4-4a84-b945-7ab940d15d42"
+    text = (
+        f"https://game.maj-soul.com/1/?paipu={uuid}_a12345 东1局 南二局1本场"
+        " https://tenhou.net/0/?log=2023111804gm-0029-0000-1c8568b3&tw=2"
+        f" https://game.maj-soul.com/1/?paipu={uuid2}"
+        f"  https://game.maj-soul.com/1/?paipu={uuid}_a12345 东1局"
+    )
+    assert parse_analyze_targets(text) == [
+        MajsoulTarget(uuid, 0, -1),
+        MajsoulTarget(uuid, 5, 1),
+        TenhouTarget("2023111804gm-0029-0000-1c8568b3", 2),
+        MajsoulTarget(uuid2, -1, -1),
+    ]
+
+    assert parse_analyze_targets("") == []
+
+
+@pytest.mark.asyncio
+async def test_analyze_batch_concurrency(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.naga.errors import InvalidKyokuHonbaError
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaReportPlayer,
+        NagaServiceOrder,
+    )
+    from nonebot_plugin_nagabus.matchers.naga_analyze import (
+        TenhouTarget,
+        MajsoulTarget,
+        _analyze_target,
+        _get_user_semaphore,
+    )
+
+    monkeypatch.setattr(conf(), "naga_analyze_user_concurrency", 2)
+
+    running = 0
+    max_running = 0
+
+    async def analyze_tenhou(haihu_id, seat, session, progress=None):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        report = NagaReport(
+            haihu_id=haihu_id,
+            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+            report_id=f"report-{haihu_id}",
+            seat=seat,
+            model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+            rule=NagaGameRule.hanchan,
+        )
+        return NagaServiceOrder(report=report, cost_np=50)
+
+    async def analyze_majsoul(uuid, kyoku, honba, session, progress=None):
+        raise InvalidKyokuHonbaError([(0, 0), (4, 1)])
+
+    monkeypatch.setattr(naga, "analyze_tenhou", analyze_tenhou)
+    monkeypatch.setattr(naga, "analyze_majsoul", analyze_majsoul)
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+    sem = _get_user_semaphore(session)
+    assert _get_user_semaphore(session) is sem
+
+    results = await asyncio.gather(
+        *[
+            _analyze_target(session, sem, TenhouTarget(f"haihu-{i}", 0))
+            for i in range(6)
+        ],
+        _analyze_target(session, sem, MajsoulTarget("uuid", -1, -1)),
+    )
+    assert max_running == 2
+    for i in range(6):
+        msg, cost_np = results[i]
+        assert f"report-haihu-{i}.html" in msg
+        assert cost_np == 50
+    assert results[-1] == ("请输入正确的场次与本场（东1局0本场、南1局1本场）", 0)
+
+    # 未处理的异常转换为内部错误，不影响其他目标
+    async def analyze_majsoul_error(uuid, kyoku, honba, session, progress=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(naga, "analyze_majsoul", analyze_majsoul_error)
+    msg, cost_np = await _analyze_target(session, sem, MajsoulTarget("uuid", 0, 0))
+    assert msg.startswith("内部错误")
+    assert cost_np == 0
+
+    # 被取消时直接中止，而不是作为该目标的错误信息返回
+    task = asyncio.create_task(
+        _analyze_target(session, sem, TenhouTarget("haihu-cancelled", 0))
+    )
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.mark.asyncio
+async def test_analyze_single_concurrency(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_saa import MessageFactory
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.matchers.naga_analyze import (
+        TenhouTarget,
+        analyze_single,
+    )
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaReportPlayer,
+        NagaServiceOrder,
+    )
+
+    monkeypatch.setattr(conf(), "naga_analyze_user_concurrency", 1)
+
+    running = 0
+    max_running = 0
+
+    async def analyze_tenhou(haihu_id, seat, session, progress=None):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        report = NagaReport(
+            haihu_id=haihu_id,
+            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+            report_id=f"report-{haihu_id}",
+            seat=seat,
+            model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+            rule=NagaGameRule.hanchan,
+        )
+        return NagaServiceOrder(report=report, cost_np=50)
+
+    sent = []
+
+    async def send(self, *args, **kwargs):
+        sent.append(str(self))
+
+    monkeypatch.setattr(naga, "analyze_tenhou", analyze_tenhou)
+    monkeypatch.setattr(MessageFactory, "send", send)
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23457",
+        id2="34567",
+    )
+
+    # 同一用户同时发送的多条单个解析指令也受并发数限制
+    await asyncio.gather(
+        analyze_single(session, TenhouTarget("haihu-0", 0)),
+        analyze_single(session, TenhouTarget("haihu-1", 0)),
+    )
+    assert max_running == 1
+    assert len(sent) == 4
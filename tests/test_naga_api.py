@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_order_spans(app: App):
+    from httpx import Cookies, Request, Response, AsyncClient, MockTransport
+
+    from nonebot_plugin_nagabus.naga.api import NagaApi
+    from nonebot_plugin_nagabus.utils.trace import start_trace
+    from nonebot_plugin_nagabus.naga.model import NagaGameRule, NagaHanchanModelType
+
+    async def handler(request: Request) -> Response:
+        await asyncio.sleep(0.05)
+        if request.url.path.endswith("/order_form/"):
+            return Response(
+                200,
+                text='<input type="hidden" name="csrfmiddlewaretoken" value="token">',
+            )
+        return Response(200)
+
+    api = NagaApi(cookies_getter=lambda: Cookies({"csrftoken": "csrf"}))
+    api.client = AsyncClient(
+        base_url=NagaApi._BASE_URL, transport=MockTransport(handler)
+    )
+    try:
+        with start_trace() as trace:
+            await api.analyze_custom(
+                "[]", 0, NagaGameRule.hanchan, [NagaHanchanModelType.nishiki]
+            )
+    finally:
+        await api.close()
+
+    # 获取csrfmiddlewaretoken不计入下单的耗时，各阶段互不重叠
+    assert [s.phase for s in trace.spans] == ["csrf_fetch", "order_post"]
+    csrf_fetch, order_post = trace.spans
+    assert csrf_fetch.offset + csrf_fetch.duration <= order_post.offset
+    assert sum(s.duration for s in trace.spans) <= trace.duration
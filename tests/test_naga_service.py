@@ -1,9 +1,12 @@
 import json
+import asyncio
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 
 import pytest
 from nonebug import App
+from sqlalchemy import select
+from monthdelta import monthdelta
 
 
 @pytest.mark.asyncio
@@ -12,6 +15,7 @@ async def test_service(app: App):
 
     from nonebot_plugin_nagabus.naga import naga
     from nonebot_plugin_nagabus.utils.tz import TZ_TOKYO
+    from nonebot_plugin_nagabus.data.naga import _report_cache
     from nonebot_plugin_nagabus.data.mjs import _set_download_paipu_delegate
 
     async def download_paipu(uuid):
@@ -46,7 +50,1332 @@ async def test_service(app: App):
     assert order2.cost_np == 0
     assert order2.report == order.report
 
+    # 从数据库中解码报告
+    _report_cache.clear()
+    order2 = await naga.analyze_tenhou("2023111804gm-0029-0000-1c8568b3", 0, session)
+    assert order2.cost_np == 0
+    assert order2.report == order.report
+
     cur = datetime.now(tz=TZ_TOKYO)
     statistic = await naga.statistic(cur.year, cur.month)
     assert len(statistic) == 1
     assert statistic[0].cost_np == 60
+
+
+@pytest.mark.asyncio
+async def test_service_releases_connection(
+    app: App, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    import asyncio
+
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.data.base import SqlModel
+    from nonebot_plugin_nagabus.data.naga import NagaRepository
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+
+    # 连接池只有2个连接，若等待报告期间占用连接则会超时
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=2,
+        max_overflow=0,
+        pool_timeout=1,
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(SqlModel.metadata.create_all)
+    monkeypatch.setattr(
+        "nonebot_plugin_nagabus.naga.service.get_engine", lambda: engine
+    )
+    monkeypatch.setattr("nonebot_plugin_nagabus.data.naga.get_engine", lambda: engine)
+    # 刷新任务绑定在创建时的事件循环上
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    try:
+        # 多个请求等待同一个分析中的订单，以及多个新下的订单
+        tasks = [
+            asyncio.create_task(
+                naga.analyze_tenhou(f"2023111804gm-0029-0000-{i % 4:08x}", 0, session)
+            )
+            for i in range(16)
+        ]
+        await asyncio.sleep(3)
+        assert not any(t.done() for t in tasks)
+        assert engine.pool.checkedout() == 0
+
+        orders = await asyncio.gather(*tasks)
+        assert sum(order.cost_np for order in orders) == 50 * 4
+    finally:
+        await NagaRepository.flush_local_orders()
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_order_claim(app: App, monkeypatch: pytest.MonkeyPatch):
+    import asyncio
+
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.naga.service import NagaService, ObservableOrderReport
+
+    monkeypatch.setattr(conf(), "naga_order_claim", True)
+
+    # 模拟共享同一个数据库和NAGA账号的另一个进程
+    other = NagaService()
+    other.api = naga.api
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+    monkeypatch.setattr(other, "_order_report", ObservableOrderReport(naga.api))
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    try:
+        rest_np = await naga.get_rest_np()
+        haihu_id = "2023111804gm-0029-0000-claim000"
+        orders = await asyncio.gather(
+            naga.analyze_tenhou(haihu_id, 0, session),
+            other.analyze_tenhou(haihu_id, 0, session),
+        )
+        assert sorted(order.cost_np for order in orders) == [0, 50]
+        assert orders[0].report == orders[1].report
+        assert await naga.get_rest_np() == rest_np - 50
+    finally:
+        await other.close()
+
+
+@pytest.mark.asyncio
+async def test_order_claim_heartbeat(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.naga import service as service_module
+    from nonebot_plugin_nagabus.naga.service import NagaService, ObservableOrderReport
+
+    monkeypatch.setattr(conf(), "naga_order_claim", True)
+    monkeypatch.setattr(conf(), "naga_order_claim_timeout", 0.3)
+    monkeypatch.setattr(service_module, "DURATION", 0.05)
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+    monkeypatch.setattr(naga, "_tenhou_order_mutex", asyncio.Lock())
+
+    async def lookup(repo):
+        return None
+
+    # 下单耗时超过naga_order_claim_timeout时，下单权被续期，其他进程无法接管
+    owner = NagaService()
+    other = NagaService()
+    assert await owner._claim_order("heartbeat", lookup) == (True, None)
+    try:
+        await asyncio.sleep(0.6)
+        assert await other._claim_order("heartbeat", lookup) == (False, None)
+    finally:
+        await owner._release_order_claim("heartbeat")
+    assert await other._claim_order("heartbeat", lookup) == (True, None)
+    await other._release_order_claim("heartbeat")
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    # 等待其他进程下单时不持有下单锁，本进程的其他订单不受影响
+    haihu_id = "2023111804gm-0029-0000-claim001"
+    claim_key = f"tenhou:{haihu_id}:2,4"
+    assert await other._claim_order(claim_key, lookup) == (True, None)
+    try:
+        waiting = asyncio.create_task(naga.analyze_tenhou(haihu_id, 0, session))
+        await asyncio.sleep(0.1)
+        order = await asyncio.wait_for(
+            naga.analyze_tenhou("2023111804gm-0029-0000-claim002", 0, session), 30
+        )
+        assert order.cost_np == 50
+        assert not waiting.done()
+    finally:
+        await other._release_order_claim(claim_key)
+
+    # 其他进程放弃下单后，由本进程下单
+    order = await asyncio.wait_for(waiting, 30)
+    assert order.cost_np == 50
+
+
+@pytest.mark.asyncio
+async def test_service_close(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.naga.service import NagaService
+
+    monkeypatch.setattr(conf(), "naga_order_claim", True)
+    monkeypatch.setattr(conf(), "naga_rest_np_ttl", 0)
+
+    async def lookup(repo):
+        return None
+
+    service = NagaService()
+    assert await service._claim_order("close", lookup) == (True, None)
+    await service.get_cached_rest_np()
+    await service.get_cached_rest_np()  # 已过期，在后台刷新
+    service._order_report.observe_once(lambda order_report: None)
+
+    tasks = [
+        *service._claim_heartbeats.values(),
+        service._rest_np_refresh_worker,
+        service._order_report._refresh_worker,
+    ]
+    assert all(t is not None and not t.done() for t in tasks)
+
+    # 关闭时结束所有后台任务
+    await service.close()
+    assert all(t.done() for t in tasks)
+    await service._release_order_claim("close")
+
+
+@pytest.mark.asyncio
+async def test_analyze_progress(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.naga.errors import InvalidKyokuHonbaError
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+    from nonebot_plugin_nagabus.data.mjs import _set_download_paipu_delegate
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaOrderStatus,
+        NagaAnalyzeStage,
+        NagaAnalyzeProgress,
+    )
+
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    events = []
+
+    async def progress(event: NagaAnalyzeProgress):
+        events.append(event)
+        # 通知失败不影响解析
+        raise RuntimeError("failed to send")
+
+    haihu_id = "2023111804gm-0029-0000-prog0000"
+    order = await naga.analyze_tenhou(haihu_id, 0, session, progress=progress)
+    assert order.cost_np == 50
+    assert events == [
+        NagaAnalyzeProgress(NagaAnalyzeStage.order_placed, haihu_id),
+        NagaAnalyzeProgress(
+            NagaAnalyzeStage.status_changed, haihu_id, NagaOrderStatus.ok
+        ),
+        NagaAnalyzeProgress(NagaAnalyzeStage.report_ready, haihu_id),
+    ]
+
+    events.clear()
+    order = await naga.analyze_tenhou(haihu_id, 0, session, progress=progress)
+    assert order.cost_np == 0
+    assert events == [NagaAnalyzeProgress(NagaAnalyzeStage.report_ready, haihu_id)]
+
+    async def download_paipu(uuid):
+        sample_path = str(Path(__file__).parent / "sample_majsoul_paipu.json")
+        with open(sample_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    _set_download_paipu_delegate(download_paipu)
+
+    events.clear()
+    with pytest.raises(InvalidKyokuHonbaError):
+        await naga.analyze_majsoul(
+            "231126-23433728-1ce4-4a84-b945-7ab940d15d41",
+            -1,
+            -1,
+            session,
+            progress=progress,
+        )
+    assert events == [NagaAnalyzeProgress(NagaAnalyzeStage.paipu_downloaded)]
+
+
+@pytest.mark.asyncio
+async def test_cached_rest_np(app: App, monkeypatch: pytest.MonkeyPatch):
+    import asyncio
+
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+    monkeypatch.setattr(naga, "_rest_np", None)
+
+    fetch_times = 0
+    get_rest_np = naga.api.get_rest_np
+
+    async def counting_get_rest_np():
+        nonlocal fetch_times
+        fetch_times += 1
+        return await get_rest_np()
+
+    monkeypatch.setattr(naga.api, "get_rest_np", counting_get_rest_np)
+
+    rest_np = await naga.get_cached_rest_np()
+    assert not rest_np.approximate
+    assert fetch_times == 1
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+    await naga.analyze_tenhou("2023111804gm-0029-0000-restnp00", 0, session)
+
+    # 下单后本地记账，无需重新获取
+    rest_np2 = await naga.get_cached_rest_np()
+    assert rest_np2.value == rest_np.value - 50
+    assert not rest_np2.approximate
+    assert fetch_times == 1
+
+    # 超时后返回近似值，并在后台校正
+    monkeypatch.setattr(conf(), "naga_rest_np_ttl", 0)
+    rest_np3 = await naga.get_cached_rest_np()
+    assert rest_np3.approximate
+    await asyncio.sleep(0.1)
+    assert fetch_times == 2
+    assert naga._rest_np == await get_rest_np()
+
+
+@pytest.mark.asyncio
+async def test_rest_np_gauge(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nagabus.naga.service import NagaService
+    from nonebot_plugin_nagabus.naga import service as service_module
+
+    gauge = service_module._rest_np
+    monkeypatch.setattr(gauge, "_functions", {})
+
+    service = NagaService()
+    try:
+        await service.start()
+        monkeypatch.setattr(service, "_rest_np", 1234)
+
+        # 创建其他服务实例不影响已启动服务暴露的剩余NP
+        other = NagaService()
+        monkeypatch.setattr(other, "_rest_np", 0)
+        assert gauge.get() == 1234
+    finally:
+        await service.close()
+
+
+@pytest.mark.asyncio
+async def test_reap_stale_orders(app: App, monkeypatch: pytest.MonkeyPatch):
+    from datetime import timedelta
+
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+    from nonebot_plugin_nagabus.data.naga import (
+        NagaOrderOrm,
+        NagaRepository,
+        NagaOrderSource,
+    )
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaOrder,
+        NagaReport,
+        NagaGameRule,
+        NagaOrderStatus,
+        NagaReportPlayer,
+    )
+
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+
+    model = NagaModel(major=2, minor=2, old_type=0, type="2,4")
+    stale_time = datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    haihu_ids = {
+        key: f"2023111804gm-0029-0000-reap{i:04d}"
+        for i, key in enumerate(["completed", "failed", "analyzing", "lost", "fresh"])
+    }
+
+    async with AsyncSession(get_engine()) as sess:
+        for key, haihu_id in haihu_ids.items():
+            t = datetime.now(tz=timezone.utc) if key == "fresh" else stale_time
+            sess.add(
+                NagaOrderOrm(
+                    haihu_id=haihu_id,
+                    customer_id=1,
+                    cost_np=50,
+                    source=NagaOrderSource.tenhou,
+                    model_type="2,4",
+                    status=NagaOrderStatus.analyzing,
+                    create_time=t,
+                    update_time=t,
+                )
+            )
+        await sess.commit()
+
+    report = NagaReport(
+        haihu_id=haihu_ids["completed"],
+        players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+        report_id="reap-report",
+        seat=0,
+        model=model,
+        rule=NagaGameRule.hanchan,
+    )
+    monkeypatch.setattr(naga.api, "report", [report])
+    monkeypatch.setattr(
+        naga.api,
+        "order",
+        [
+            NagaOrder(
+                haihu_id=haihu_ids[key],
+                status=status,
+                model=model,
+                rule=NagaGameRule.hanchan,
+            )
+            for key, status in [
+                ("completed", NagaOrderStatus.ok),
+                ("failed", NagaOrderStatus.failed),
+                ("analyzing", NagaOrderStatus.analyzing),
+            ]
+        ],
+    )
+
+    await naga.reap_stale_orders()
+
+    async with AsyncSession(get_engine()) as sess:
+        status = {
+            key: await sess.scalar(
+                select(NagaOrderOrm.status).where(NagaOrderOrm.haihu_id == haihu_id)
+            )
+            for key, haihu_id in haihu_ids.items()
+        }
+        assert status == {
+            "completed": NagaOrderStatus.ok,
+            "failed": NagaOrderStatus.failed,
+            "analyzing": NagaOrderStatus.analyzing,
+            "lost": None,
+            "fresh": NagaOrderStatus.analyzing,
+        }
+        assert await NagaRepository.get_report(haihu_ids["completed"], "2,4") == report
+
+        # 读取时忽略失败与超时的订单，且不产生副作用
+        repo = NagaRepository(sess)
+        assert await repo.get_local_order(haihu_ids["failed"], "2,4") is None
+        assert await repo.get_local_order(haihu_ids["analyzing"], "2,4") is None
+        assert await repo.get_local_order(haihu_ids["fresh"], "2,4") is not None
+        assert await sess.get(NagaOrderOrm, haihu_ids["analyzing"]) is not None
+
+        # 新订单替换失败的订单
+        await repo.new_local_order(haihu_ids["failed"], 1, NagaGameRule.hanchan, "2,4")
+        assert await repo.get_local_order(haihu_ids["failed"], "2,4") is not None
+
+
+@pytest.mark.asyncio
+async def test_reconcile_orders(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+    from nonebot_plugin_nagabus.data.naga import NagaOrderOrm, NagaOrderSource
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaOrderStatus,
+        NagaReportPlayer,
+    )
+
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+
+    # 重启前仍在等待报告（或已被标记为失败）的订单
+    haihu_ids = {
+        NagaOrderStatus.analyzing: "2023111804gm-0029-0000-reco0000",
+        NagaOrderStatus.failed: "2023111804gm-0029-0000-reco0001",
+    }
+    async with AsyncSession(get_engine()) as sess:
+        for status, haihu_id in haihu_ids.items():
+            sess.add(
+                NagaOrderOrm(
+                    haihu_id=haihu_id,
+                    customer_id=1,
+                    cost_np=50,
+                    source=NagaOrderSource.tenhou,
+                    model_type="2,4",
+                    status=status,
+                    create_time=datetime.now(tz=timezone.utc),
+                    update_time=datetime.now(tz=timezone.utc),
+                )
+            )
+        await sess.commit()
+
+    monkeypatch.setattr(
+        naga.api,
+        "report",
+        [
+            NagaReport(
+                haihu_id=haihu_id,
+                players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+                report_id=f"reco-report-{i}",
+                seat=0,
+                model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+                rule=NagaGameRule.hanchan,
+            )
+            for i, haihu_id in enumerate(haihu_ids.values())
+        ],
+    )
+
+    await naga.reconcile_orders()
+
+    async with AsyncSession(get_engine()) as sess:
+        for haihu_id in haihu_ids.values():
+            order_orm = await sess.get(NagaOrderOrm, haihu_id)
+            assert order_orm.status == NagaOrderStatus.ok
+
+
+@pytest.mark.asyncio
+async def test_order_completion_buffer(app: App):
+    from sqlalchemy import event
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaOrderStatus,
+        NagaReportPlayer,
+    )
+    from nonebot_plugin_nagabus.data.naga import (
+        NagaOrderOrm,
+        NagaRepository,
+        NagaOrderSource,
+        NagaMonthlyUsageOrm,
+        _month_key,
+    )
+
+    reports = [
+        NagaReport(
+            haihu_id=f"2023111804gm-0029-0000-buff{i:04d}",
+            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+            report_id=f"buff-report-{i}",
+            seat=0,
+            model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+            rule=NagaGameRule.hanchan,
+        )
+        for i in range(3)
+    ]
+    customer_id = 7
+    async with AsyncSession(get_engine()) as sess:
+        repo = NagaRepository(sess)
+        for report in reports:
+            await repo.new_local_order(
+                report.haihu_id, customer_id, NagaGameRule.hanchan, "2,4"
+            )
+        for report in reports:
+            await repo.update_local_order(report.haihu_id, report)
+
+    async with AsyncSession(get_engine()) as sess:
+        repo = NagaRepository(sess)
+        for report in reports:
+            # 尚未写入数据库，但读取时视为已完成
+            assert (
+                await sess.scalar(
+                    select(NagaOrderOrm.status).where(
+                        NagaOrderOrm.haihu_id == report.haihu_id
+                    )
+                )
+                == NagaOrderStatus.analyzing
+            )
+            order_orm = await repo.get_local_order(report.haihu_id, "2,4")
+            assert order_orm.status == NagaOrderStatus.ok
+            assert await NagaRepository.get_report(report.haihu_id, "2,4") == report
+
+    # 一次写入的语句数与订单数无关
+    statements = []
+
+    def on_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = get_engine()
+    event.listen(engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        await NagaRepository.flush_local_orders()
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", on_execute)
+    assert len(statements) == 4, statements
+
+    async with AsyncSession(get_engine()) as sess:
+        for report in reports:
+            order_orm = await sess.get(NagaOrderOrm, report.haihu_id)
+            assert order_orm.status == NagaOrderStatus.ok
+            assert order_orm.source == NagaOrderSource.tenhou
+
+        # 同一用户的订单合并计入汇总
+        usage = await sess.get(
+            NagaMonthlyUsageOrm,
+            (customer_id, _month_key(order_orm.create_time), NagaOrderSource.tenhou),
+        )
+        assert (usage.cost_np, usage.order_count) == (50 * len(reports), len(reports))
+
+
+@pytest.mark.asyncio
+async def test_order_completion_buffer_failure(
+    app: App, monkeypatch: pytest.MonkeyPatch
+):
+    from sqlalchemy import delete
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.data.naga import (
+        NagaOrderOrm,
+        NagaRepository,
+        _completion_buffer,
+    )
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaOrderStatus,
+        NagaReportPlayer,
+    )
+
+    monkeypatch.setattr(conf(), "naga_order_flush_interval", 0.01)
+    monkeypatch.setattr(conf(), "naga_order_flush_batch_size", 1)
+    monkeypatch.setattr(conf(), "naga_order_flush_max_attempts", 3)
+    # 之前测试的事件循环中创建的写入任务已经无法运行
+    monkeypatch.setattr(_completion_buffer, "_flush_worker", None)
+
+    attempts = 0
+
+    async def reap_local_orders(self, completed, failed, lost):
+        nonlocal attempts
+        attempts += 1
+        raise RuntimeError("database is unavailable")
+
+    monkeypatch.setattr(NagaRepository, "reap_local_orders", reap_local_orders)
+
+    report = NagaReport(
+        haihu_id="2023111804gm-0029-0000-fail0000",
+        players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+        report_id="fail-report",
+        seat=0,
+        model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+        rule=NagaGameRule.hanchan,
+    )
+    async with AsyncSession(get_engine()) as sess:
+        repo = NagaRepository(sess)
+        await repo.new_local_order(report.haihu_id, 1, NagaGameRule.hanchan, "2,4")
+        # 缓冲满时写入失败，但不影响已经完成的请求
+        await repo.update_local_order(report.haihu_id, report)
+    assert attempts == 1
+    assert await NagaRepository.get_report(report.haihu_id, "2,4") == report
+
+    # 后台任务退避重试，超过重试次数后放弃，订单交由清理任务处理
+    async def wait_flush_worker():
+        while _completion_buffer._flush_worker is not None:
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(wait_flush_worker(), 5)
+    assert attempts == 3
+    assert _completion_buffer.get(report.haihu_id) is None
+
+    async with AsyncSession(get_engine()) as sess:
+        order_orm = await sess.get(NagaOrderOrm, report.haihu_id)
+        assert order_orm.status == NagaOrderStatus.analyzing
+        await sess.execute(
+            delete(NagaOrderOrm).where(NagaOrderOrm.haihu_id == report.haihu_id)
+        )
+        await sess.commit()
+
+
+@pytest.mark.asyncio
+async def test_analytics(app: App):
+    from datetime import date, timedelta
+
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.data.naga import NagaRepository
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaUsage,
+        NagaReport,
+        NagaGameRule,
+        NagaReportPlayer,
+    )
+
+    def make_report(haihu_id: str, model_type: str) -> NagaReport:
+        return NagaReport(
+            haihu_id=haihu_id,
+            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+            report_id=f"report-{haihu_id}",
+            seat=0,
+            model=NagaModel(major=2, minor=2, old_type=0, type=model_type),
+            rule=NagaGameRule.hanchan,
+        )
+
+    today = date.today()
+    before = await naga.analytics(today, today)
+
+    async with AsyncSession(get_engine()) as sess:
+        repo = NagaRepository(sess)
+        await repo.new_local_order("analytics-1", 9001, NagaGameRule.hanchan, "2,4")
+        await repo.new_local_order("analytics-2", 9001, NagaGameRule.tonpuu, "0")
+        await repo.new_local_majsoul_order(
+            "analytics-3", 9002, "analytics-uuid", 0, 0, "2,4"
+        )
+        # 未完成的订单不计入统计
+        await repo.new_local_order("analytics-4", 9002, NagaGameRule.hanchan, "2,4")
+        await repo.update_local_order("analytics-1", make_report("analytics-1", "2,4"))
+        await repo.update_local_order("analytics-2", make_report("analytics-2", "0"))
+        await repo.update_local_order("analytics-3", make_report("analytics-3", "2,4"))
+        # 重复完成不重复计入
+        await repo.update_local_order("analytics-1", make_report("analytics-1", "2,4"))
+
+    # 缓冲中的已完成订单也计入统计
+    analytics = await naga.analytics(today - timedelta(days=2), today)
+
+    assert analytics.by_customer[9001] == NagaUsage(80, 2)
+    assert analytics.by_customer[9002] == NagaUsage(10, 1)
+    assert analytics.total == NagaUsage(
+        before.total.cost_np + 90, before.total.order_count + 3
+    )
+
+    def delta(after: dict, before: dict, key) -> NagaUsage:
+        a = after.get(key, NagaUsage(0, 0))
+        b = before.get(key, NagaUsage(0, 0))
+        return NagaUsage(a.cost_np - b.cost_np, a.order_count - b.order_count)
+
+    by_source = (analytics.by_source, before.by_source)
+    assert delta(*by_source, "tenhou") == NagaUsage(80, 2)
+    assert delta(*by_source, "majsoul") == NagaUsage(10, 1)
+    by_model_type = (analytics.by_model_type, before.by_model_type)
+    assert delta(*by_model_type, "2,4") == NagaUsage(60, 2)
+    assert delta(*by_model_type, "0") == NagaUsage(30, 1)
+
+    assert [d.day for d in analytics.daily] == [
+        today - timedelta(days=2),
+        today - timedelta(days=1),
+        today,
+    ]
+    assert analytics.daily[-1].cost_np == analytics.total.cost_np
+    assert analytics.daily[0].order_count == 0
+
+    # 不包含今天的范围
+    analytics = await naga.analytics(
+        today - timedelta(days=7), today - timedelta(days=1)
+    )
+    assert 9001 not in analytics.by_customer
+    assert len(analytics.daily) == 7
+
+
+@pytest.mark.asyncio
+async def test_archive_reports(app: App):
+    from sqlalchemy import delete
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.naga.errors import OrderError
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaOrderStatus,
+        NagaReportPlayer,
+    )
+    from nonebot_plugin_nagabus.data.naga import (
+        NagaOrderOrm,
+        NagaRepository,
+        NagaOrderSource,
+        NagaReportArchiveOrm,
+        _report_cache,
+    )
+
+    create_time = datetime.now(tz=timezone.utc) - monthdelta(months=12)
+    reports = [
+        NagaReport(
+            haihu_id=f"2023111804gm-0029-0000-arch{i:04d}",
+            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+            report_id=f"arch-report-{i}",
+            seat=0,
+            model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+            rule=NagaGameRule.hanchan,
+        )
+        for i in range(5)
+    ]
+    async with AsyncSession(get_engine()) as sess:
+        for report in reports:
+            sess.add(
+                NagaOrderOrm(
+                    haihu_id=report.haihu_id,
+                    customer_id=1,
+                    cost_np=50,
+                    source=NagaOrderSource.tenhou,
+                    model_type="2,4",
+                    status=NagaOrderStatus.ok,
+                    naga_report=report,
+                    create_time=create_time,
+                    update_time=create_time,
+                )
+            )
+        await sess.commit()
+
+    assert await naga.archive_reports() == len(reports)
+    assert await naga.archive_reports() == 0
+
+    _report_cache.clear()
+    async with AsyncSession(get_engine()) as sess:
+        for report in reports:
+            order_orm = await sess.get(NagaOrderOrm, report.haihu_id)
+            assert order_orm.naga_report is None
+            assert order_orm.cost_np == 50
+            assert await NagaRepository.get_report(report.haihu_id, "2,4") == report
+
+    # 已有订单的报告被归档后，解析时从归档中读取
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+    _report_cache.clear()
+    order = await naga.analyze_tenhou(reports[0].haihu_id, 0, session)
+    assert order.report == reports[0]
+    assert order.cost_np == 0
+
+    # 本地和归档中都没有报告时报错，而不是返回空的报告
+    async with AsyncSession(get_engine()) as sess:
+        await sess.execute(
+            delete(NagaReportArchiveOrm).where(
+                NagaReportArchiveOrm.haihu_id == reports[1].haihu_id
+            )
+        )
+        await sess.commit()
+    _report_cache.clear()
+    with pytest.raises(OrderError):
+        await naga.analyze_tenhou(reports[1].haihu_id, 0, session)
+
+
+@pytest.mark.asyncio
+async def test_export_orders(app: App, monkeypatch: pytest.MonkeyPatch):
+    import csv
+    import json
+    from datetime import date, timedelta
+
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.data.naga import (
+        NagaOrderOrm,
+        NagaRepository,
+        MajsoulOrderOrm,
+        NagaOrderSource,
+    )
+    from nonebot_plugin_nagabus.naga.model import (
+        NagaModel,
+        NagaReport,
+        NagaGameRule,
+        NagaOrderStatus,
+        NagaReportPlayer,
+    )
+
+    monkeypatch.setattr(conf(), "naga_export_chunk_size", 2)
+
+    day = date.today() - timedelta(days=400)
+    create_time = datetime(day.year, day.month, day.day, 12).astimezone(timezone.utc)
+    haihu_ids = [f"2023111804gm-0029-0000-expo{i:04d}" for i in range(5)]
+    async with AsyncSession(get_engine()) as sess:
+        for i, haihu_id in enumerate(haihu_ids):
+            ok = i != 4
+            sess.add(
+                NagaOrderOrm(
+                    haihu_id=haihu_id,
+                    customer_id=i,
+                    cost_np=10 if i == 0 else 50,
+                    source=(
+                        NagaOrderSource.majsoul if i == 0 else NagaOrderSource.tenhou
+                    ),
+                    model_type="2,4",
+                    status=NagaOrderStatus.ok if ok else NagaOrderStatus.pending,
+                    naga_report=(
+                        NagaReport(
+                            haihu_id=haihu_id,
+                            players=[NagaReportPlayer(nickname="AI", pt=0)] * 4,
+                            report_id=f"expo-report-{i}",
+                            seat=0,
+                            model=NagaModel(major=2, minor=2, old_type=0, type="2,4"),
+                            rule=NagaGameRule.hanchan,
+                        )
+                        if ok
+                        else None
+                    ),
+                    # 前两个订单的create_time相同，验证分页时不会遗漏
+                    create_time=create_time + timedelta(minutes=max(i, 1)),
+                    update_time=create_time,
+                )
+            )
+        sess.add(
+            MajsoulOrderOrm(
+                naga_haihu_id=haihu_ids[0],
+                paipu_uuid="expo-uuid",
+                kyoku=1,
+                honba=2,
+                model_type="2,4",
+            )
+        )
+        await sess.commit()
+
+        # 归档后的报告也应被导出
+        await NagaRepository(sess).archive_reports(
+            create_time + timedelta(minutes=2), 100
+        )
+
+    result = await naga.export_orders(day, day, "jsonl", with_report=True)
+    try:
+        assert result.count == len(haihu_ids)
+        with open(result.path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        assert [r["haihu_id"] for r in records] == haihu_ids
+        assert records[0]["source"] == "majsoul"
+        assert records[0]["paipu_uuid"] == "expo-uuid"
+        assert (records[0]["kyoku"], records[0]["honba"]) == (1, 2)
+        assert records[1]["paipu_uuid"] is None
+        assert records[4]["status"] == "pending"
+        assert records[4]["naga_report"] is None
+        for i in range(4):
+            assert records[i]["naga_report"]["report_id"] == f"expo-report-{i}"
+    finally:
+        result.path.unlink()
+
+    result = await naga.export_orders(day - timedelta(days=1), day)
+    try:
+        assert result.path.suffix == ".csv"
+        with open(result.path, encoding="utf-8", newline="") as f:
+            records = list(csv.DictReader(f))
+        assert [r["haihu_id"] for r in records] == haihu_ids
+        assert "naga_report" not in records[0]
+        assert [int(r["cost_np"]) for r in records] == [10, 50, 50, 50, 50]
+    finally:
+        result.path.unlink()
+
+    result = await naga.export_orders(day + timedelta(days=1), day + timedelta(days=1))
+    try:
+        assert result.count == 0
+    finally:
+        result.path.unlink()
+
+
+@pytest.mark.asyncio
+async def test_majsoul_paipu_index(app: App):
+    from nonebot_plugin_nagabus.naga.model import NagaGameRule
+    from nonebot_plugin_nagabus.data.mjs import (
+        get_majsoul_paipu,
+        get_majsoul_kyoku_log,
+        get_majsoul_paipu_index,
+        _set_download_paipu_delegate,
+    )
+
+    sample_path = str(Path(__file__).parent / "sample_majsoul_paipu.json")
+    with open(sample_path, encoding="utf-8") as f:
+        sample = json.load(f)
+
+    async def download_paipu(uuid):
+        return sample
+
+    _set_download_paipu_delegate(download_paipu)
+
+    uuid = "230808-2e2c24ee-b480-4789-b689-470aba0ef2e4"
+    index = await get_majsoul_paipu_index(uuid)
+    assert index.game_rule == NagaGameRule.hanchan
+    assert index.available_kyoku_honba == [(x[0][0], x[0][1]) for x in sample["log"]]
+
+    for log in sample["log"]:
+        kyoku_index = index.find_kyoku(log[0][0], log[0][1])
+        assert kyoku_index is not None
+        assert await get_majsoul_kyoku_log(uuid, kyoku_index) == log
+
+    assert index.find_kyoku(100, 0) is None
+    assert await get_majsoul_paipu(uuid) == sample
+
+
+@pytest.mark.asyncio
+async def test_majsoul_paipu_touch(app: App, monkeypatch: pytest.MonkeyPatch):
+    from sqlalchemy import event
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.data import mjs
+    from nonebot_plugin_nagabus.data.mjs import (
+        MajsoulPaipuRepository,
+        _paipu_index_cache,
+        get_majsoul_paipu_index,
+        _set_download_paipu_delegate,
+    )
+
+    sample_path = str(Path(__file__).parent / "sample_majsoul_paipu.json")
+    with open(sample_path, encoding="utf-8") as f:
+        sample = json.load(f)
+
+    async def download_paipu(uuid):
+        return sample
+
+    _set_download_paipu_delegate(download_paipu)
+
+    now = 0.0
+    monkeypatch.setattr(mjs, "monotonic", lambda: now)
+
+    uuid = "230808-2e2c24ee-b480-4789-b689-470aba0ef2e4-touch"
+    await get_majsoul_paipu_index(uuid)
+    monkeypatch.setattr(mjs, "_shared_paipu_touched", {})
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = get_engine()
+    event.listen(engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        # 命中本地文件时，窗口内只在第一次更新共享缓存的访问时间
+        for _ in range(3):
+            _paipu_index_cache.invalidate(uuid)
+            await get_majsoul_paipu_index(uuid)
+        assert len(statements) == 1, statements
+
+        # 超过窗口后再次更新
+        now += MajsoulPaipuRepository._TOUCH_INTERVAL.total_seconds() + 1
+        _paipu_index_cache.invalidate(uuid)
+        await get_majsoul_paipu_index(uuid)
+        assert len(statements) == 2, statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", on_execute)
+
+
+@pytest.mark.asyncio
+async def test_majsoul_paipu_corrupted(app: App):
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot_plugin_datastore.db import get_engine
+
+    from nonebot_plugin_nagabus.data.mjs import (
+        MajsoulPaipuRepository,
+        _get_paipu_file,
+        _quarantine_paipu,
+        get_majsoul_paipu,
+        _paipu_index_cache,
+        get_majsoul_kyoku_log,
+        get_majsoul_paipu_index,
+        sweep_shared_majsoul_paipu,
+        _set_download_paipu_delegate,
+    )
+
+    sample_path = str(Path(__file__).parent / "sample_majsoul_paipu.json")
+    with open(sample_path, encoding="utf-8") as f:
+        sample = json.load(f)
+
+    download_times = 0
+    download_delay = 0
+
+    async def download_paipu(uuid):
+        nonlocal download_times
+        download_times += 1
+        await asyncio.sleep(download_delay)
+        return sample
+
+    _set_download_paipu_delegate(download_paipu)
+
+    uuid = "230808-2e2c24ee-b480-4789-b689-470aba0ef2e4-corrupted"
+    for f in _get_paipu_file(uuid).parent.glob(f"{uuid}*"):
+        f.unlink()
+
+    index = await get_majsoul_paipu_index(uuid)
+    assert download_times == 1
+
+    # 截断的文件在读取索引时被发现
+    paipu_file = _get_paipu_file(uuid)
+    content = paipu_file.read_bytes()
+    paipu_file.write_bytes(content[: len(content) // 2])
+
+    _paipu_index_cache.invalidate(uuid)
+    index = await get_majsoul_paipu_index(uuid)
+    assert download_times == 1  # 从数据库中的共享缓存恢复
+
+    # 索引已在内存中时，截断的文件在读取整个牌谱时被发现
+    paipu_file.write_bytes(content[: len(content) // 2])
+    assert await get_majsoul_paipu(uuid) == sample
+    assert download_times == 1
+
+    # 长度不变但内容损坏的文件在读取小局时被发现
+    kyoku_index = index.kyoku[0]
+    content = bytearray(paipu_file.read_bytes())
+    content[kyoku_index.offset + 1] = ord("x")
+    paipu_file.write_bytes(content)
+
+    assert await get_majsoul_kyoku_log(uuid, kyoku_index) == sample["log"][0]
+    assert download_times == 1
+
+    # 共享缓存中也不存在时重新下载
+    assert await sweep_shared_majsoul_paipu() == 0
+    async with AsyncSession(get_engine()) as sess:
+        await MajsoulPaipuRepository(sess).sweep_paipu(datetime.now(timezone.utc))
+    await _quarantine_paipu(uuid)
+    _paipu_index_cache.invalidate(uuid)
+    assert await get_majsoul_paipu(uuid) == sample
+    assert download_times == 2
+
+    # 加载时发现文件损坏并隔离，不影响并发的调用等待同一次加载
+    async with AsyncSession(get_engine()) as sess:
+        await MajsoulPaipuRepository(sess).sweep_paipu(datetime.now(timezone.utc))
+    paipu_file.write_bytes(b"")
+    _paipu_index_cache.invalidate(uuid)
+    download_delay = 0.1
+    first = asyncio.create_task(get_majsoul_paipu_index(uuid))
+    await asyncio.sleep(0.05)
+    assert await get_majsoul_paipu_index(uuid) == await first
+    assert download_times == 3
+
+
+@pytest.mark.asyncio
+async def test_service_metrics(app: App, monkeypatch: pytest.MonkeyPatch):
+    import nonebot
+    from nonebot.drivers import Request
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.utils import metrics
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+    from nonebot_plugin_nagabus.matchers.naga_metrics import _handle_metrics
+
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    # 取得已注册的指标
+    orders = metrics.counter("nagabus_orders_total", "", ("source", "result"))
+    np_spent = metrics.counter("nagabus_np_spent_total", "", ("source",))
+    poll_duration = metrics.histogram("nagabus_order_report_poll_duration_seconds", "")
+    query_duration = metrics.histogram(
+        "nagabus_db_query_duration_seconds", "", ("query",)
+    )
+
+    new_orders = orders.get(source="tenhou", result="new")
+    cached_orders = orders.get(source="tenhou", result="cached")
+    spent = np_spent.get(source="tenhou")
+    polls = poll_duration.get_count()
+    queries = query_duration.get_count(query="get_local_order")
+
+    haihu_id = "2023111804gm-0029-0000-4d7e2a01"
+    await naga.analyze_tenhou(haihu_id, 0, session)
+    await naga.analyze_tenhou(haihu_id, 0, session)
+
+    assert orders.get(source="tenhou", result="new") == new_orders + 1
+    assert orders.get(source="tenhou", result="cached") == cached_orders + 1
+    assert np_spent.get(source="tenhou") == spent + 50
+    assert poll_duration.get_count() > polls
+    assert query_duration.get_count(query="get_local_order") > queries
+
+    driver = nonebot.get_driver()
+    assert "/nagabus/metrics" in [route.path for route in driver.server_app.routes]
+
+    resp = await _handle_metrics(Request("GET", "http://localhost/nagabus/metrics"))
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = resp.content
+    assert 'nagabus_orders_total{source="tenhou",result="new"}' in text
+    assert 'nagabus_cache_requests_total{cache="naga_report"' in text
+    assert "nagabus_order_report_waiters 0" in text
+
+
+@pytest.mark.asyncio
+async def test_trace_latency(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_orm import AsyncSession
+    from nonebot.adapters.onebot.v11 import Message
+    from nonebot_plugin_datastore.db import get_engine
+    from nonebot.internal.matcher import current_matcher
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.naga import naga
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.data.trace import NagaTraceOrm
+    from nonebot_plugin_nagabus.data.naga import NagaOrderSource
+    from nonebot_plugin_nagabus.matchers.naga_trace import naga_trace
+    from nonebot_plugin_nagabus.naga.service import ObservableOrderReport
+    from nonebot_plugin_nagabus.data.mjs import _set_download_paipu_delegate
+
+    monkeypatch.setattr(naga, "_order_report", ObservableOrderReport(naga.api))
+    # 请求记录默认开启
+    assert conf().naga_trace
+
+    async def download_paipu(uuid):
+        sample_path = str(Path(__file__).parent / "sample_majsoul_paipu.json")
+        with open(sample_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    _set_download_paipu_delegate(download_paipu)
+
+    session = Session(
+        bot_id="12345",
+        bot_type="OneBot V11",
+        platform="qq",
+        level=SessionLevel.LEVEL2,
+        id1="23456",
+        id2="34567",
+    )
+
+    t_begin = datetime.now(timezone.utc)
+    uuid = "231126-23433728-1ce4-4a84-b945-7ab940d15d46"
+    order = await naga.analyze_majsoul(uuid, 0, 0, session)
+
+    # 由后台任务写入数据库
+    await asyncio.sleep(conf().naga_order_flush_interval + 0.5)
+    async with AsyncSession(get_engine()) as sess:
+        traces = (
+            await sess.scalars(
+                select(NagaTraceOrm).where(NagaTraceOrm.begin_time >= t_begin)
+            )
+        ).all()
+    assert len(traces) == 1
+    assert traces[0].source == NagaOrderSource.majsoul
+    assert traces[0].haihu_id == order.report.haihu_id
+    assert traces[0].result == "new"
+    phases = [phase for phase, _, _ in traces[0].spans]
+    assert set(phases) == {
+        "db_lookup",
+        "lock_wait",
+        "paipu_download",
+        "order_post",
+        "order_correlation",
+        "report_wait",
+        "db_update",
+    }
+    assert sum(d for _, _, d in traces[0].spans) <= traces[0].duration
+
+    await naga.analyze_majsoul(uuid, 0, 0, session)
+    t_end = datetime.now(timezone.utc)
+
+    latency = await naga.trace_latency(t_begin, t_end)
+    assert latency["total"].count == 2
+    # 第二次请求命中已完成的订单，但仍需读取牌谱索引
+    assert latency["db_lookup"].count == 2
+    assert latency["paipu_download"].count == 2
+    for phase in (
+        "lock_wait",
+        "order_post",
+        "order_correlation",
+        "report_wait",
+        "db_update",
+    ):
+        assert latency[phase].count == 1
+    x = latency["report_wait"]
+    assert 0 < x.p50 <= x.p90 <= x.p99 <= x.max <= latency["total"].max
+
+    assert await naga.trace_latency(t_begin, t_end, NagaOrderSource.tenhou) == {}
+
+    # /naga-trace汇总同样的数据
+    sent = []
+
+    class _Matcher:
+        async def send(self, message):
+            sent.append(message)
+
+    matcher = _Matcher()
+    token = current_matcher.set(matcher)
+    try:
+        await naga_trace(matcher, Message("1"))
+    finally:
+        current_matcher.reset(token)
+
+    t_end = datetime.now(timezone.utc)
+    latency = await naga.trace_latency(t_end - timedelta(hours=1), t_end)
+    lines = sent[0].splitlines()
+    assert lines[0] == "最近1小时的解析请求耗时（秒）："
+    assert [line.split(":")[0] for line in lines[1:]] == list(latency.keys())
+    x = latency["total"]
+    assert lines[1] == (
+        f"total: {x.count}次 p50={x.p50:.3f} p90={x.p90:.3f} "
+        f"p99={x.p99:.3f} max={x.max:.3f}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_trace_buffer(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.data.trace import _TraceBuffer
+
+    monkeypatch.setattr(conf(), "naga_order_flush_batch_size", 2)
+    monkeypatch.setattr(conf(), "naga_order_flush_interval", 60)
+
+    buffer = _TraceBuffer()
+    flushed = []
+
+    async def flush():
+        rows, buffer._rows = buffer._rows, []
+        flushed.append([row["trace_id"] for row in rows])
+
+    monkeypatch.setattr(buffer, "flush", flush)
+
+    # 缓冲满时也不在调用者中写入，而是交给后台任务
+    buffer.add({"trace_id": "1"})
+    buffer.add({"trace_id": "2"})
+    assert flushed == []
+    await asyncio.sleep(0.01)
+    assert flushed == [["1", "2"]]
+    assert buffer._flush_worker is None
+
+    # 后台任务等待期间缓冲满时被唤醒，无需等到naga_order_flush_interval
+    buffer.add({"trace_id": "3"})
+    await asyncio.sleep(0.01)
+    assert flushed == [["1", "2"]]
+    buffer.add({"trace_id": "4"})
+    assert flushed == [["1", "2"]]
+    await asyncio.sleep(0.01)
+    assert flushed == [["1", "2"], ["3", "4"]]
+    assert buffer._flush_worker is None
+
+    # 关闭时写入剩余的请求记录并等待后台任务结束
+    buffer.add({"trace_id": "5"})
+    await buffer.close()
+    assert flushed == [["1", "2"], ["3", "4"], ["5"]]
+    assert buffer._flush_worker is None
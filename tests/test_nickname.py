@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_customer_nicknames(app: App, monkeypatch: pytest.MonkeyPatch):
+    from sqlalchemy.exc import NoResultFound
+    from nonebot_plugin_session import Session, SessionLevel
+
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.utils import nickname
+    from nonebot_plugin_nagabus.data.utils import atomic_cache
+
+    now = 0.0
+    monkeypatch.setattr(atomic_cache, "monotonic", lambda: now)
+    nickname._session_cache.clear()
+    nickname._nickname_cache.clear()
+
+    missing_customer_id = 404
+    session_calls = []
+    nickname_calls = []
+    running = 0
+    max_running = 0
+
+    async def get_session_by_persist_id(customer_id: int) -> Session:
+        session_calls.append(customer_id)
+        if customer_id == missing_customer_id:
+            raise NoResultFound()
+        return Session(
+            bot_id="12345",
+            bot_type="OneBot V11",
+            platform="qq",
+            level=SessionLevel.LEVEL1,
+            id1=f"user{customer_id}",
+        )
+
+    async def get_user_nickname(session: Session) -> str:
+        nonlocal running, max_running
+        nickname_calls.append(session.id1)
+        running += 1
+        max_running = max(max_running, running)
+        # 让后发起的请求先完成，检查结果的顺序
+        await asyncio.sleep(0.01 * (20 - int(session.id1[4:])))
+        running -= 1
+        return f"nickname of {session.id1}"
+
+    monkeypatch.setattr(
+        nickname, "get_session_by_persist_id", get_session_by_persist_id
+    )
+    monkeypatch.setattr(
+        nickname,
+        "platform_func",
+        lambda bot_type: SimpleNamespace(get_user_nickname=get_user_nickname),
+    )
+    bot = SimpleNamespace(type="OneBot V11", self_id="12345")
+
+    # 并发获取的结果与逐个获取的结果一致，且按传入的顺序排列
+    customer_ids = [*range(1, 11), missing_customer_id]
+    expected = [*(f"nickname of user{i}" for i in range(1, 11)), "404"]
+    assert await nickname.get_customer_nicknames(bot, customer_ids) == expected
+    assert 1 < max_running <= conf().naga_nickname_concurrency
+    assert len(session_calls) == len(customer_ids)
+    assert len(nickname_calls) == 10
+
+    session_calls.clear()
+    nickname_calls.clear()
+    sequential = [
+        (await nickname.get_customer_nicknames(bot, [customer_id]))[0]
+        for customer_id in customer_ids
+    ]
+    assert sequential == expected
+
+    # 命中缓存，找不到的session也被缓存
+    assert session_calls == []
+    assert nickname_calls == []
+
+    # 超过负缓存的时间后重新查询找不到的session，昵称仍然命中缓存
+    now += nickname._NEGATIVE_TTL + 1
+    assert await nickname.get_customer_nicknames(bot, customer_ids) == expected
+    assert session_calls == [missing_customer_id]
+    assert nickname_calls == []
+
+    # 昵称过期后重新获取，session与persist_id的对应关系仍然命中缓存
+    session_calls.clear()
+    now += conf().naga_nickname_cache_ttl + 1
+    assert await nickname.get_customer_nicknames(bot, [1, 2]) == expected[:2]
+    assert session_calls == []
+    assert sorted(nickname_calls) == ["user1", "user2"]
@@ -0,0 +1,101 @@
+import time
+import asyncio
+from pathlib import Path
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_profiler(app: App, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.utils import profiler as profiler_module
+
+    monkeypatch.setattr(profiler_module, "_get_profile_dir", lambda: tmp_path)
+    monkeypatch.setattr(conf(), "naga_profiler_threshold", 0.1)
+    monkeypatch.setattr(conf(), "naga_profiler_stall_threshold", 0.2)
+    monkeypatch.setattr(conf(), "naga_profiler_interval", 0.005)
+    monkeypatch.setattr(conf(), "naga_profiler_max_files", 3)
+
+    def block_event_loop():
+        time.sleep(0.5)
+
+    profiler = profiler_module.Profiler()
+
+    # 未开启时不采样
+    async with profiler.profile("disabled"):
+        block_event_loop()
+    assert list(tmp_path.iterdir()) == []
+
+    profiler.enable()
+    try:
+        async with profiler.profile("fast"):
+            await asyncio.sleep(0.01)
+        async with profiler.profile("slow"):
+            block_event_loop()
+        # 等待采样线程发现阻塞已经结束
+        await asyncio.sleep(0.2)
+
+        files = sorted(tmp_path.iterdir())
+        assert len(files) == 2
+        slow = next(f for f in files if "-slow-slow-" in f.name)
+        stall = next(f for f in files if "-stall-loop-" in f.name)
+        for f in (slow, stall):
+            stacks = f.read_text(encoding="utf-8").splitlines()
+            assert any("block_event_loop (test_profiler.py:" in s for s in stacks)
+
+        # 只保留最新的naga_profiler_max_files个文件
+        for _ in range(2):
+            async with profiler.profile("idle"):
+                await asyncio.sleep(0.15)
+        files = sorted(tmp_path.iterdir())
+        assert len(files) == 3
+        assert slow not in files
+        assert ["-slow-idle-" in f.name for f in files] == [False, True, True]
+    finally:
+        profiler.disable()
+    assert not profiler.enabled
+
+
+@pytest.mark.asyncio
+async def test_profiler_samples_frozen(
+    app: App, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.utils import profiler as profiler_module
+
+    monkeypatch.setattr(profiler_module, "_get_profile_dir", lambda: tmp_path)
+    monkeypatch.setattr(conf(), "naga_profiler_threshold", 0)
+    monkeypatch.setattr(conf(), "naga_profiler_stall_threshold", 10)
+    monkeypatch.setattr(conf(), "naga_profiler_interval", 0.001)
+
+    fold_stack = profiler_module._fold_stack
+
+    def slow_fold_stack(frame):
+        # 拉长采样线程取得调用栈到记录之间的时间
+        time.sleep(0.02)
+        return fold_stack(frame)
+
+    monkeypatch.setattr(profiler_module, "_fold_stack", slow_fold_stack)
+
+    changed = []
+    write_profile = profiler_module._write_profile
+
+    def checked_write_profile(kind, name, seconds, samples):
+        before = dict(samples)
+        time.sleep(0.1)
+        changed.append(dict(samples) != before)
+        return write_profile(kind, name, seconds, samples)
+
+    monkeypatch.setattr(profiler_module, "_write_profile", checked_write_profile)
+
+    # 写入文件时，采样线程不再修改已结束的请求的采样结果
+    profiler = profiler_module.Profiler()
+    profiler.enable()
+    try:
+        for _ in range(5):
+            async with profiler.profile("busy"):
+                await asyncio.sleep(0.05)
+    finally:
+        profiler.disable()
+    assert changed == [False] * 5
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+from nonebug import App
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import ClauseElement
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, stmt):
+        self.statement = stmt
+
+
+@compiles(Explain, "sqlite")
+def _explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, "postgresql")
+def _explain_postgresql(element, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+def _lookup_stmts():
+    from nonebot_plugin_nagabus.data.naga import NagaRepository
+
+    return [
+        (
+            NagaRepository._get_local_majsoul_order_stmt(
+                "231126-23433728-1ce4-4a84-b945-7ab940d15d41", 0, 0, "2,4"
+            ),
+            "ix_nonebot_plugin_nagabus_majsoul_order_lookup",
+        ),
+        (
+            NagaRepository._get_local_order_stmt(
+                "2023111804gm-0029-0000-1c8568b3", "2,4"
+            ),
+            "pk_nonebot_plugin_nagabus_order",
+        ),
+        (
+            NagaRepository._get_stale_orders_stmt(),
+            "ix_nonebot_plugin_nagabus_order_status_create_time",
+        ),
+    ]
+
+
+async def _explain(conn, stmt) -> str:
+    rows = (await conn.execute(Explain(stmt))).all()
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+@pytest.mark.asyncio
+async def test_query_plan_sqlite(app: App):
+    from nonebot_plugin_datastore.db import get_engine
+
+    async with get_engine().connect() as conn:
+        for stmt, index in _lookup_stmts():
+            plan = await _explain(conn, stmt)
+            # sqlite中主键索引显示为sqlite_autoindex_*
+            if index.startswith("pk_"):
+                assert "sqlite_autoindex_nonebot_plugin_nagabus_order" in plan, plan
+            else:
+                assert index in plan, plan
+            assert "SCAN nonebot_plugin_nagabus" not in plan, plan
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    "NAGABUS_TEST_POSTGRESQL_URL" not in os.environ,
+    reason="NAGABUS_TEST_POSTGRESQL_URL is not set",
+)
+async def test_query_plan_postgresql(app: App):
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    from nonebot_plugin_nagabus.data.naga import NagaOrderOrm, MajsoulOrderOrm
+
+    engine = create_async_engine(os.environ["NAGABUS_TEST_POSTGRESQL_URL"])
+    tables = [NagaOrderOrm.__table__, MajsoulOrderOrm.__table__]
+    try:
+        async with engine.connect() as conn:
+            await conn.run_sync(
+                lambda sync_conn: NagaOrderOrm.metadata.create_all(
+                    sync_conn, tables=tables
+                )
+            )
+            # 表中没有数据时，不禁用顺序扫描的话总会选择顺序扫描
+            await conn.execute(text("SET enable_seqscan = off"))
+
+            for stmt, index in _lookup_stmts():
+                plan = await _explain(conn, stmt)
+                assert index in plan, plan
+
+            await conn.rollback()
+    finally:
+        await engine.dispose()
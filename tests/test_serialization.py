@@ -0,0 +1,38 @@
+import threading
+
+import pytest
+from nonebug import App
+
+
+@pytest.mark.asyncio
+async def test_run_serialization_offload(app: App, monkeypatch: pytest.MonkeyPatch):
+    from nonebot_plugin_nagabus.config import conf
+    from nonebot_plugin_nagabus.utils.serialization import (
+        run_serialization,
+        get_serialization_statistic,
+    )
+
+    monkeypatch.setattr(conf(), "naga_serialization_offload_threshold", 1024)
+    loop_thread = threading.get_ident()
+
+    # 超过阈值或大小未知时在线程池中执行，否则直接在事件循环线程中执行
+    assert await run_serialization("test.small", 10, threading.get_ident) == (
+        loop_thread
+    )
+    assert await run_serialization("test.large", 1024, threading.get_ident) != (
+        loop_thread
+    )
+    assert await run_serialization("test.unknown", None, threading.get_ident) != (
+        loop_thread
+    )
+
+    # 阈值为负数时不使用线程池
+    monkeypatch.setattr(conf(), "naga_serialization_offload_threshold", -1)
+    assert await run_serialization("test.large", None, threading.get_ident) == (
+        loop_thread
+    )
+
+    statistic = get_serialization_statistic()
+    assert statistic["test.small"][:2] == (1, 0)
+    assert statistic["test.large"][:2] == (2, 1)
+    assert statistic["test.unknown"][:2] == (1, 1)